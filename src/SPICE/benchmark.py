@@ -0,0 +1,267 @@
+"""
+Offline benchmark of the sweep hot loop on synthetic kernels
+
+Writes synthetic kernels (see kernels/synthetic_kernels.py) and sweeps a synthetic instrument over a random catalogue
+of pits for several pit counts and timesteps, each case in a fresh process. Steps per second, DSK calls per second and
+peak memory are appended as JSON lines tagged with the git commit, so runs on different commits can be compared:
+
+    python src/SPICE/benchmark.py --output baseline.jsonl
+    python src/SPICE/benchmark.py --output current.jsonl --compare baseline.jsonl
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import resource
+import subprocess
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, asdict
+from datetime import datetime, timezone
+from functools import partial
+from typing import Dict, List, Optional
+
+sys.path.insert(0, "/".join(__file__.split("/")[:-3]))
+
+import numpy as np
+import pandas as pd
+import spiceypy as spice
+
+from src.SPICE.config import TIME_STEP, SIMULATION_BATCH_SIZE, BENCHMARK_DESTINATION, BENCHMARK_REGRESSION_TOLERANCE
+from src.SPICE.sweep_iterator import SweepIterator
+from src.SPICE.instruments.base_instrument import Instrument
+from src.SPICE.kernels.synthetic_kernels import (
+    SYNTHETIC_DSK,
+    SYNTHETIC_INSTRUMENT_FRAME,
+    SYNTHETIC_INSTRUMENT_IDS,
+    SYNTHETIC_SPACECRAFT,
+    write_synthetic_kernels,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def synthetic_pits(n_pits: int, seed: int = 0) -> pd.DataFrame:
+    """Pits uniformly distributed over the lunar sphere, in the format of Sessions.get_all_pits_points"""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "name": [f"synthetic_pit_{i}" for i in range(n_pits)],
+            "latitude": np.degrees(np.arcsin(rng.uniform(-1, 1, n_pits))),
+            "longitude": rng.uniform(-180, 180, n_pits),
+        }
+    ).set_index("name")
+
+
+class SyntheticSweepIterator(SweepIterator):
+    destination = BENCHMARK_DESTINATION
+    lone_kernels = []
+    dsk_path = os.path.join(BENCHMARK_DESTINATION, SYNTHETIC_DSK)
+    meta_kernel_destination = os.path.join(BENCHMARK_DESTINATION, "meta_kernels")
+
+
+class SyntheticInstrument(Instrument):
+    name = "SYNTHETIC"
+    sweep_iterator_class = SyntheticSweepIterator
+    instrument_ids = SYNTHETIC_INSTRUMENT_IDS
+    frame = SYNTHETIC_INSTRUMENT_FRAME
+    satellite_frame = SYNTHETIC_SPACECRAFT
+    offset_days = 0
+    subinstrumen_offset = 1
+    distance_tolerance = 10
+    fov_offset = 1
+    pit_source = staticmethod(partial(synthetic_pits, 1000))
+    pit_distance_field_destination = os.path.join(BENCHMARK_DESTINATION, "pit_distance_field")
+    pit_surface_destination = os.path.join(BENCHMARK_DESTINATION, "pit_surface_points")
+    pit_catalog_destination = os.path.join(BENCHMARK_DESTINATION, "pit_catalog")
+    # When set, the timestep is kept constant instead of adapted to the distance from pits
+    fixed_timestep: Optional[float] = None
+
+    def adjust_timestep(self, min_distance: float, boresight_point: Optional[np.ndarray] = None):
+        if self.fixed_timestep is None:
+            return super().adjust_timestep(min_distance, boresight_point)
+        self.computation_timestep = self.fixed_timestep
+
+
+@dataclass
+class BenchmarkCase:
+    n_pits: int
+    # None for the adaptive timestep
+    timestep: Optional[float]
+
+    def __str__(self) -> str:
+        return f"pits={self.n_pits} timestep={'adaptive' if self.timestep is None else self.timestep}"
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(case: BenchmarkCase, destination: str, duration: float, repeat: int, batch_size: Optional[int], seed: int) -> Dict:
+    """Sweeps `duration` seconds `repeat` times with a fresh instrument, returns results of the fastest run"""
+    logging.getLogger("src.SPICE.sweep_metrics").setLevel(logging.WARNING)
+    SyntheticSweepIterator.destination = destination
+    SyntheticSweepIterator.dsk_path = os.path.join(destination, SYNTHETIC_DSK)
+    SyntheticSweepIterator.meta_kernel_destination = os.path.join(destination, "meta_kernels")
+    SyntheticInstrument.pit_source = staticmethod(partial(synthetic_pits, case.n_pits, seed))
+    SyntheticInstrument.pit_distance_field_destination = os.path.join(destination, "pit_distance_field")
+    SyntheticInstrument.pit_surface_destination = os.path.join(destination, "pit_surface_points")
+    SyntheticInstrument.pit_catalog_destination = os.path.join(destination, "pit_catalog")
+    SyntheticInstrument.fixed_timestep = case.timestep
+    SyntheticInstrument.state_aware_timestep = case.timestep is None
+
+    best: Optional[Dict] = None
+    for _ in range(repeat):
+        spice.kclear()
+        setup_start = time.perf_counter()
+        instrument = SyntheticInstrument()
+        setup_seconds = time.perf_counter() - setup_start
+        setup_rss_mb = _peak_rss_mb()
+
+        stop_et = instrument.current_simulation_timestamp_et + duration
+        sweep_start, cpu_start = time.perf_counter(), time.process_time()
+        found = sum(len(batch) for batch in instrument.sweep(batch_size=batch_size, stop_et=stop_et, show_progress=False))
+        sweep_seconds, cpu_seconds = time.perf_counter() - sweep_start, time.process_time() - cpu_start
+
+        result = {
+            "steps": instrument.current_simulation_step,
+            "steps_per_second": instrument.current_simulation_step / sweep_seconds,
+            "dsk_calls": instrument._dsk_calls_cnt,
+            "dsk_calls_per_second": instrument._dsk_calls_cnt / sweep_seconds,
+            "simulated_seconds_per_second": duration / sweep_seconds,
+            "found": found,
+            "failed": instrument._failed_timestamps_cnt,
+            "setup_seconds": setup_seconds,
+            "sweep_seconds": sweep_seconds,
+            "cpu_seconds": cpu_seconds,
+            "setup_rss_mb": setup_rss_mb,
+            "stages": {name: timer.seconds for name, timer in instrument.metrics.stages.items()},
+        }
+        if best is None or result["sweep_seconds"] < best["sweep_seconds"]:
+            best = result
+    best["peak_rss_mb"] = _peak_rss_mb()
+    return best
+
+
+def _git_revision() -> Dict:
+    repository = "/".join(__file__.split("/")[:-3]) or "."
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repository, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"], cwd=repository, capture_output=True, text=True, check=True
+        ).stdout
+        return {"commit": commit, "dirty": bool(status.strip())}
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+
+
+def _case_key(record: Dict) -> tuple:
+    """Records are comparable only for the same case, sweep settings and kernels"""
+    return (
+        record["case"]["n_pits"],
+        record["case"]["timestep"],
+        record["duration"],
+        record["batch_size"],
+        record["seed"],
+        json.dumps(record["kernels"], sort_keys=True),
+    )
+
+
+def compare(records: List[Dict], baseline_records: List[Dict], tolerance: float) -> List[str]:
+    """Logs relative changes against the latest baseline record of each case, returns cases which regressed"""
+    baseline = {_case_key(record): record for record in baseline_records}
+    regressions = []
+    for record in records:
+        if (reference := baseline.get(_case_key(record))) is None:
+            logger.info("%s: no baseline", BenchmarkCase(**record["case"]))
+            continue
+        # Throughput of simulated time, steps per second alone would favour changes taking more (cheaper) steps
+        change = record["simulated_seconds_per_second"] / reference["simulated_seconds_per_second"] - 1
+        logger.info(
+            "%s: %.0f -> %.0f simulated s/s (%+.1f%%), %.0f -> %.0f steps/s, %.0f -> %.0f DSK calls/s, peak RSS %.0f -> %.0f MB (baseline %s)",
+            BenchmarkCase(**record["case"]),
+            reference["simulated_seconds_per_second"],
+            record["simulated_seconds_per_second"],
+            100 * change,
+            reference["steps_per_second"],
+            record["steps_per_second"],
+            reference["dsk_calls_per_second"],
+            record["dsk_calls_per_second"],
+            reference["peak_rss_mb"],
+            record["peak_rss_mb"],
+            (reference["commit"] or "unknown")[:10],
+        )
+        if change < -tolerance:
+            regressions.append(str(BenchmarkCase(**record["case"])))
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the sweep on synthetic kernels")
+    parser.add_argument("--destination", default=BENCHMARK_DESTINATION, help="Folder of synthetic kernels")
+    parser.add_argument("--output", default=os.path.join(BENCHMARK_DESTINATION, "results.jsonl"), help="JSON lines file results are appended to")
+    parser.add_argument("--compare", default=None, help="JSON lines file with baseline results")
+    parser.add_argument("--tolerance", type=float, default=BENCHMARK_REGRESSION_TOLERANCE, help="Relative drop of simulated s/s reported as regression")
+    parser.add_argument("--pits", type=int, nargs="+", default=[100, 1000, 10000], help="Numbers of pits")
+    parser.add_argument("--timesteps", nargs="+", default=["adaptive", str(TIME_STEP), "10"], help="Timesteps (s) or 'adaptive'")
+    parser.add_argument("--duration", type=float, default=6 * 3600, help="Swept interval (s) of each case")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each case, the fastest one is reported")
+    parser.add_argument("--batch-size", type=int, default=SIMULATION_BATCH_SIZE)
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the pit catalogue")
+    parser.add_argument("--bump-amplitude", type=float, default=0.0, help="Relief (km) of the synthetic DSK, 0 for a sphere")
+    args = parser.parse_args()
+
+    days = int(np.ceil(args.duration / spice.spd())) + 1
+    kernels = write_synthetic_kernels(args.destination, days=days, bump_amplitude=args.bump_amplitude)
+    revision = _git_revision()
+    cases = [
+        BenchmarkCase(n_pits, None if timestep == "adaptive" else float(timestep)) for n_pits in args.pits for timestep in args.timesteps
+    ]
+
+    records = []
+    for case in cases:
+        # Fresh process for each case, so SPICE kernel pool and peak memory are not carried over
+        with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context("spawn")) as executor:
+            result = executor.submit(run_case, case, args.destination, args.duration, args.repeat, args.batch_size, args.seed).result()
+        record = {
+            **revision,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "kernels": kernels,
+            "duration": args.duration,
+            "batch_size": args.batch_size,
+            "seed": args.seed,
+            "case": asdict(case),
+            **result,
+        }
+        logger.info(
+            "%s: %.0f steps/s, %.0f DSK calls/s, %.0f simulated s/s, peak RSS %.0f MB",
+            case,
+            record["steps_per_second"],
+            record["dsk_calls_per_second"],
+            record["simulated_seconds_per_second"],
+            record["peak_rss_mb"],
+        )
+        records.append(record)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    logger.info("Results appended to %s", args.output)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            baseline_records = [json.loads(line) for line in f if line.strip()]
+        if regressions := compare(records, baseline_records, args.tolerance):
+            logger.warning("Regressions over %.0f%%: %s", 100 * args.tolerance, ", ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,6 @@
 import re
 import os
+import tempfile
 import numpy as np
 
 ###############################################
@@ -146,6 +147,38 @@ LRO_STR_ID = "LUNAR RECONNAISSANCE ORBITER"
 
 # Additional simulation configuration
 ABBERRATION_CORRECTION = "CN+S"
+COARSE_ABBERRATION_CORRECTION = "NONE"  # Correction of sincpt intercepts far from points of interest, ABBERRATION_CORRECTION applies to hits and overflight windows
 TIME_STEP = 1.024  # Step through trajectory computation in seconds
 MAX_TIME_STEP = 3600
 MAX_LOADED_SPICE = 3  # Maximum number of dynamic SPICE kernels loaded at once
+COVERAGE_WINDOW_SIZE = 100_000  # Size of SPICE cells (interval endpoints, object ids) read from a single kernel by ckcov/spkcov
+KERNEL_PREFETCH_DEPTH = 1  # Number of following dynamic kernels read into the page cache in the background before they're furnished
+KERNEL_PREFETCH_CHUNK_SIZE = 8 * 1024 * 1024  # Bytes read at once when prefetching a kernel
+KERNEL_INDEX_FILENAME = "kernel_index.sqlite"  # Persistent index of dynamic kernel labels in the root of the kernel archive
+META_KERNEL_DESTINATION = os.path.join(DESTINATION, "meta_kernels")  # Meta-kernels of static kernels required by sweeps, generated by KernelPlanner
+KERNEL_PLAN_MARGIN = 86400  # Seconds static SPK and PCK kernels have to cover beyond the swept interval to be furnished
+SIMULATION_BATCH_SIZE = 256  # Maximum number of epochs projected at once when sweeping near points of interest
+SIMULATION_FLUSH_SIZE = 1000  # Number of found points buffered before they are inserted into DB
+TIMESTEP_HISTORY_SIZE = 10_000  # Number of the latest adjusted timesteps and distances an instrument keeps for inspection
+SWEEP_SHARDS_PER_PROCESS = 4  # Time shards per worker process in parallel sweeps, more shards balance the load better
+SWEEP_SHARD_OVERRUN = 3600  # Seconds past the stop of a shard static kernels are planned for, open windows are swept past it
+STEP_SPEED_SAFETY_FACTOR = 1.2  # Footprint ground speed is assumed at most this times the current one during a timestep
+MIN_EMISSION_COSINE = 0.05  # Closer to grazing views the footprint speed is considered unbounded
+MAX_SPACECRAFT_ANGULAR_RATE = np.radians(0.2)  # Slew limit (rad/s) of the spacecraft attitude, footprint speed bounds assume it for whole timesteps
+STEP_CHECK_CADENCE = 60.0  # Seconds between epochs within a timestep its footprint speed bound is verified at
+OVERFLIGHT_WINDOW_TOLERANCE = 1e-3  # Precision (s) of refined overflight window entry, exit and closest approach epochs
+SIMULATION_CHECKPOINT_INTERVAL = 300  # Wall clock seconds after which found points are flushed and the sweep checkpointed
+GEOMETRY_CACHE_DESTINATION = os.path.join(DESTINATION, "geometry_cache")  # Memory-mapped samples of spacecraft state and attitude
+GEOMETRY_CACHE_CADENCE = 4.0  # Sampling cadence (s) of the geometry cache, position is Hermite and attitude SLERP interpolated
+PIT_DISTANCE_FIELD_DESTINATION = os.path.join(DESTINATION, "pit_distance_field")  # Memory-mapped distances to the closest pit over the lunar surface
+PIT_DISTANCE_FIELD_RESOLUTION = 2.0  # Size (km) of equal-area cells of the pit distance field
+PIT_SURFACE_DESTINATION = os.path.join(DESTINATION, "pit_surface_points")  # DSK intercepts of pits, keyed by the DSK and the pit catalogue
+PIT_CATALOG_DESTINATION = os.path.join(DESTINATION, "pit_catalog")  # Memory-mapped catalogues of pits shared by sweep processes
+TARGET_RADIUS_CLASS_RATIO = 1.25  # Pits with detection radii within this ratio share a KD-Tree of candidate queries
+PIT_QUERY_CADENCE = 60.0  # Sampling cadence (s) of sub-spacecraft points when searching passes over queried pits
+PIT_QUERY_CROSS_TRACK_MARGIN = 20  # Distance (km) beyond the rough treshold of an instrument the nadir ground track has to pass a queried pit within, covers off-nadir pointing
+PIT_QUERY_PASS_MARGIN = 60  # Seconds swept before and after each pass found by the pit query
+SWEEP_METRICS_INTERVAL = 60  # Wall clock seconds between logged snapshots of sweep stage timers and counters
+SWEEP_METRICS_PROMETHEUS_PORT = None  # When set, sweep metrics are exported to Prometheus on this port
+BENCHMARK_DESTINATION = os.path.join(tempfile.gettempdir(), "lavatubesniffer_benchmark")  # Synthetic kernels and results of sweep benchmarks
+BENCHMARK_REGRESSION_TOLERANCE = 0.1  # Relative drop of simulated seconds swept per second reported as a regression by the sweep benchmark
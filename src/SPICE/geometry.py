@@ -0,0 +1,71 @@
+"""
+Vectorized geometry helpers complementing SPICE routines, evaluated for whole batches of epochs at once
+"""
+from typing import Tuple
+
+import numpy as np
+
+
+def ellipsoid_intercepts(vertices: np.ndarray, directions: np.ndarray, radii: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Analytic ray - ellipsoid intersection, counterpart of sincpt with ELLIPSOID method and no aberration correction
+
+    Vertices and directions of rays are (N, 3) arrays in the body-fixed frame of the ellipsoid with given radii.
+    Returns (N, 3) array of the nearest intercepts (NaN if the ray misses) and a boolean found mask
+    """
+    # Scale the ellipsoid into a unit sphere and solve the quadratic equation |v + t * d| = 1
+    scaled_vertices = vertices / radii
+    scaled_directions = directions / radii
+    a = np.einsum("ij,ij->i", scaled_directions, scaled_directions)
+    b = 2 * np.einsum("ij,ij->i", scaled_vertices, scaled_directions)
+    c = np.einsum("ij,ij->i", scaled_vertices, scaled_vertices) - 1
+    discriminant = b**2 - 4 * a * c
+
+    with np.errstate(invalid="ignore"):
+        t = (-b - np.sqrt(discriminant)) / (2 * a)
+    found = (discriminant >= 0) & (t >= 0)
+
+    points = np.full(vertices.shape, np.nan)
+    points[found] = vertices[found] + t[found, None] * directions[found]
+    return points, found
+
+
+def polygon_distances(points: np.ndarray, polygons: np.ndarray) -> np.ndarray:
+    """
+    Distances of surface points to footprint polygons, zero for points inside
+
+    Points are (M, 3) and polygons (P, V, 3) arrays of vertices (in order) in the body-fixed frame. Both are projected
+    into the tangent plane at the centre of each polygon, which is accurate for footprints small w.r.t. the body.
+    Returns (M, P) distances, inf for polygons with missing (NaN) vertices
+    """
+    centres = polygons.mean(axis=1)
+    normals = centres / np.linalg.norm(centres, axis=1)[:, None]
+    # Tangent plane basis, the reference axis must not be parallel to the normal
+    reference = np.where(np.abs(normals[:, 2:3]) < 0.9, [[0.0, 0.0, 1.0]], [[1.0, 0.0, 0.0]])
+    east = np.cross(reference, normals)
+    east /= np.linalg.norm(east, axis=1)[:, None]
+    north = np.cross(normals, east)
+    basis = np.stack([east, north], axis=1)  # (P, 2, 3)
+
+    vertices = np.einsum("pkj,pvj->pvk", basis, polygons - centres[:, None])  # (P, V, 2)
+    projected = np.einsum("pkj,mpj->mpk", basis, points[:, None] - centres[None])  # (M, P, 2)
+
+    a = vertices[None]  # (1, P, V, 2)
+    b = np.roll(vertices, -1, axis=1)[None]
+    p = projected[:, :, None]  # (M, P, 1, 2)
+    edge = b - a
+    edge_length2 = np.einsum("...k,...k->...", edge, edge)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = np.clip(np.einsum("...k,...k->...", p - a, edge) / edge_length2, 0, 1)
+    t = np.where(edge_length2 > 0, t, 0)
+    distances = np.linalg.norm(p - a - t[..., None] * edge, axis=-1).min(axis=-1)
+
+    # Crossing number test, a horizontal ray from the point crosses odd number of edges when inside
+    ay, by, px = a[..., 1], b[..., 1], p[..., 0]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        crossing_x = a[..., 0] + (p[..., 1] - ay) * edge[..., 0] / edge[..., 1]
+    crossings = ((ay > p[..., 1]) != (by > p[..., 1])) & (px < crossing_x)
+    inside = crossings.sum(axis=-1) % 2 == 1
+
+    distances = np.where(inside, 0.0, distances)
+    return np.where(np.isnan(distances), np.inf, distances)
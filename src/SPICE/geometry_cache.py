@@ -0,0 +1,211 @@
+"""
+Cache of spacecraft state and instrument attitude sampled at a fixed cadence over the whole mission
+
+Samples are stored as memory-mapped NumPy arrays, one file per dynamic kernel segment, so repeated sweeps
+(with different tresholds, points of interest or DSKs) evaluate geometry by interpolation instead of SPICE.
+Position is interpolated by cubic Hermite polynomials (from positions and velocities), attitude by SLERP.
+"""
+import os
+import sys
+import json
+import logging
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, "/".join(__file__.split("/")[:-3]))
+
+import numpy as np
+import spiceypy as spice
+from tqdm import tqdm
+
+from src.global_config import TQDM_NCOLS
+from src.SPICE.config import (
+    MOON_STR_ID,
+    MOON_REF_FRAME_STR_ID,
+    GEOMETRY_CACHE_DESTINATION,
+    GEOMETRY_CACHE_CADENCE,
+)
+
+logger = logging.getLogger(__name__)
+
+# Columns of a sample - state (position, velocity) w.r.t. the Moon and quaternion of the frame -> MOON_ME rotation
+STATE_COLUMNS = slice(0, 6)
+QUATERNION_COLUMNS = slice(6, 10)
+INDEX_FILENAME = "index.json"
+
+
+def quaternions_to_matrices(quaternions: np.ndarray) -> np.ndarray:
+    """Vectorized counterpart of spice.q2m for (N, 4) SPICE-style quaternions (cosine first)"""
+    q0, q1, q2, q3 = quaternions.T
+    matrices = np.empty((len(quaternions), 3, 3))
+    matrices[:, 0, 0] = 1 - 2 * (q2 * q2 + q3 * q3)
+    matrices[:, 0, 1] = 2 * (q1 * q2 - q0 * q3)
+    matrices[:, 0, 2] = 2 * (q1 * q3 + q0 * q2)
+    matrices[:, 1, 0] = 2 * (q1 * q2 + q0 * q3)
+    matrices[:, 1, 1] = 1 - 2 * (q1 * q1 + q3 * q3)
+    matrices[:, 1, 2] = 2 * (q2 * q3 - q0 * q1)
+    matrices[:, 2, 0] = 2 * (q1 * q3 - q0 * q2)
+    matrices[:, 2, 1] = 2 * (q2 * q3 + q0 * q1)
+    matrices[:, 2, 2] = 1 - 2 * (q1 * q1 + q2 * q2)
+    return matrices
+
+
+def slerp(q0: np.ndarray, q1: np.ndarray, s: np.ndarray) -> np.ndarray:
+    """Spherical linear interpolation between (N, 4) unit quaternions at fractions s in [0, 1]"""
+    dot = np.einsum("ij,ij->i", q0, q1)
+    # Both q and -q are the same rotation, interpolate along the shorter arc
+    q1 = np.where(dot[:, None] < 0, -q1, q1)
+    dot = np.clip(np.abs(dot), -1.0, 1.0)
+    theta = np.arccos(dot)
+    sin_theta = np.sin(theta)
+    # Nearly identical quaternions are interpolated linearly
+    close = sin_theta < 1e-9
+    with np.errstate(invalid="ignore", divide="ignore"):
+        w0 = np.where(close, 1 - s, np.sin((1 - s) * theta) / sin_theta)
+        w1 = np.where(close, s, np.sin(s * theta) / sin_theta)
+    quaternions = w0[:, None] * q0 + w1[:, None] * q1
+    return quaternions / np.linalg.norm(quaternions, axis=1)[:, None]
+
+
+def hermite(p0: np.ndarray, v0: np.ndarray, p1: np.ndarray, v1: np.ndarray, s: np.ndarray, h: float):
+    """Cubic Hermite interpolation of (N, 3) positions with velocities at fractions s of steps long h, returns positions and velocities"""
+    s = s[:, None]
+    h00, h10, h01, h11 = 2 * s**3 - 3 * s**2 + 1, s**3 - 2 * s**2 + s, -2 * s**3 + 3 * s**2, s**3 - s**2
+    d00, d10, d01, d11 = 6 * s**2 - 6 * s, 3 * s**2 - 4 * s + 1, -6 * s**2 + 6 * s, 3 * s**2 - 2 * s
+    positions = h00 * p0 + h10 * h * v0 + h01 * p1 + h11 * h * v1
+    velocities = (d00 * p0 + d01 * p1) / h + d10 * v0 + d11 * v1
+    return positions, velocities
+
+
+class GeometryCache:
+    """
+    Interpolating lookup of spacecraft state and attitude of a frame from precomputed samples
+
+    Build the cache once with `GeometryCache.build` (furnishes dynamic kernels segment by segment), later open it
+    with `GeometryCache(satellite, frame)`. Epochs not covered by the cache (or kernel gaps, stored as NaNs) yield NaNs
+    """
+
+    def __init__(self, satellite: str, frame: str, destination: str = GEOMETRY_CACHE_DESTINATION):
+        self.satellite = satellite
+        self.frame = frame
+        self.directory = GeometryCache.cache_directory(satellite, frame, destination)
+        with open(os.path.join(self.directory, INDEX_FILENAME), "r") as f:
+            index = json.load(f)
+        self.cadence = index["cadence"]
+        self.fingerprint = index["fingerprint"]
+        self._chunk_files = [chunk["file"] for chunk in index["chunks"]]
+        self._chunk_starts = np.array([chunk["et_start"] for chunk in index["chunks"]])
+        self._chunk_stops = np.array([chunk["et_stop"] for chunk in index["chunks"]])
+        self._chunks: Dict[int, np.ndarray] = {}
+
+    @staticmethod
+    def cache_directory(satellite: str, frame: str, destination: str = GEOMETRY_CACHE_DESTINATION) -> str:
+        return os.path.join(destination, f"{satellite}_{frame}".replace(" ", "_"))
+
+    @staticmethod
+    def _sample(sweep_iterator, satellite: str, frame: str, ets: np.ndarray) -> np.ndarray:
+        """Samples state and attitude through SPICE, NaN rows where kernels don't cover the epoch"""
+        samples = np.full((len(ets), 10), np.nan)
+        for i, et in enumerate(ets):
+            sweep_iterator.step(et)
+            try:
+                samples[i, STATE_COLUMNS], _ = spice.spkezr(satellite, et, MOON_REF_FRAME_STR_ID, "NONE", MOON_STR_ID)
+                samples[i, QUATERNION_COLUMNS] = spice.m2q(spice.pxform(frame, MOON_REF_FRAME_STR_ID, et))
+            except spice.SpiceyError:
+                samples[i] = np.nan
+        # Both q and -q are the same rotation, keep consecutive quaternions on the same hemisphere for SLERP
+        quaternions = samples[:, QUATERNION_COLUMNS]
+        flips = np.einsum("ij,ij->i", quaternions[1:], quaternions[:-1]) < 0
+        quaternions[1:] *= np.where(np.cumsum(flips) % 2 == 1, -1, 1)[:, None]
+        return samples
+
+    @classmethod
+    def build(
+        cls,
+        sweep_iterator,
+        satellite: str,
+        frame: str,
+        destination: str = GEOMETRY_CACHE_DESTINATION,
+        cadence: float = GEOMETRY_CACHE_CADENCE,
+    ) -> "GeometryCache":
+        """Samples the whole interval covered by dynamic kernels of `sweep_iterator`, one chunk per kernel segment"""
+        directory = cls.cache_directory(satellite, frame, destination)
+        os.makedirs(directory, exist_ok=True)
+
+        start_et, stop_et = sweep_iterator.min_loaded_time, sweep_iterator.max_loaded_time
+        boundaries = [start_et, *sweep_iterator.kernel_boundaries(start_et, stop_et), stop_et]
+        chunks: List[Dict] = []
+        for i, (chunk_start, chunk_stop) in enumerate(
+            tqdm(list(zip(boundaries[:-1], boundaries[1:])), ncols=TQDM_NCOLS, desc=f"Sampling {frame} geometry")
+        ):
+            # The last sample of a chunk reaches the end of it, so any epoch within can be interpolated
+            ets = chunk_start + np.arange(int(np.ceil((chunk_stop - chunk_start) / cadence)) + 1) * cadence
+            samples = cls._sample(sweep_iterator, satellite, frame, ets)
+            filename = f"chunk_{i:05d}.npy"
+            np.save(os.path.join(directory, filename), samples)
+            chunks.append({"file": filename, "et_start": float(chunk_start), "et_stop": float(ets[-1])})
+
+        with open(os.path.join(directory, INDEX_FILENAME), "w") as f:
+            json.dump(
+                {
+                    "satellite": satellite,
+                    "frame": frame,
+                    "cadence": cadence,
+                    "fingerprint": sweep_iterator.dynamic_kernels_fingerprint,
+                    "chunks": chunks,
+                },
+                f,
+            )
+        logger.info("Geometry cache of %s with %d chunks stored in %s", frame, len(chunks), directory)
+        return cls(satellite, frame, destination)
+
+    def _chunk(self, i: int) -> np.ndarray:
+        if i not in self._chunks:
+            # Plain ndarray view of the memory map, it's cheaper to index
+            self._chunks[i] = np.asarray(np.load(os.path.join(self.directory, self._chunk_files[i]), mmap_mode="r"))
+        return self._chunks[i]
+
+    def _neighbours(self, ets: np.ndarray):
+        """Samples enclosing each epoch - (left samples, right samples, fractions of the step), NaNs for uncovered epochs"""
+        ets = np.atleast_1d(np.asarray(ets, dtype=float))
+        left = np.full((len(ets), 10), np.nan)
+        right = np.full((len(ets), 10), np.nan)
+        fractions = np.zeros(len(ets))
+
+        chunk_ids = np.searchsorted(self._chunk_starts, ets, side="right") - 1
+        for chunk_id in [chunk_ids[0]] if (chunk_ids == chunk_ids[0]).all() else np.unique(chunk_ids):
+            if chunk_id < 0:
+                continue
+            mask = (chunk_ids == chunk_id) & (ets <= self._chunk_stops[chunk_id])
+            samples = self._chunk(chunk_id)
+            position = (ets[mask] - self._chunk_starts[chunk_id]) / self.cadence
+            indices = np.minimum(position.astype(int), len(samples) - 2)
+            left[mask], right[mask] = samples[indices], samples[indices + 1]
+            fractions[mask] = position - indices
+        return left, right, fractions
+
+    def evaluate(self, ets: np.ndarray, rates: bool = False, delta: float = 1e-3) -> Tuple[np.ndarray, ...]:
+        """
+        States (N, 6) of the spacecraft w.r.t. the Moon and rotations (N, 3, 3) from the frame of the cache, both in
+        the lunar body-fixed frame. With `rates`, time derivatives of the rotations (the lower left block of sxform)
+        are returned as well, by central differences
+        """
+        left, right, fractions = self._neighbours(ets)
+        positions, velocities = hermite(left[:, :3], left[:, 3:6], right[:, :3], right[:, 3:6], fractions, self.cadence)
+        states = np.hstack([positions, velocities])
+
+        q0, q1 = left[:, QUATERNION_COLUMNS], right[:, QUATERNION_COLUMNS]
+        if not rates:
+            return states, quaternions_to_matrices(slerp(q0, q1, fractions))
+
+        # The rotation rate is constant within a step, so the differences can reach over its ends
+        step = delta / self.cadence
+        n = len(fractions)
+        rotations = quaternions_to_matrices(
+            slerp(np.tile(q0, (3, 1)), np.tile(q1, (3, 1)), np.concatenate([fractions, fractions + step, fractions - step]))
+        )
+        return states, rotations[:n], (rotations[n : 2 * n] - rotations[2 * n :]) / (2 * delta)
+
+    def positions(self, ets: np.ndarray) -> np.ndarray:
+        """(N, 3) positions of the spacecraft w.r.t. the Moon in the lunar body-fixed frame"""
+        left, right, fractions = self._neighbours(ets)
+        return hermite(left[:, :3], left[:, 3:6], right[:, :3], right[:, 3:6], fractions, self.cadence)[0]
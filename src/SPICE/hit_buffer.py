@@ -0,0 +1,123 @@
+"""
+Columnar buffer of sweep hits - epochs with points of interest within the detection treshold
+
+Hits are appended into a preallocated NumPy structured array (grown by doubling), documents for the database are
+created only when the buffer is flushed, with UTC timestamps converted for all hits at once (see ets_to_datetimes).
+"""
+import sys
+from datetime import datetime
+from typing import Dict, List, Optional
+
+sys.path.insert(0, "/".join(__file__.split("/")[:-3]))
+
+import numpy as np
+
+from src.SPICE.config import SIMULATION_FLUSH_SIZE
+
+HIT_DTYPE = np.dtype(
+    [
+        ("et", "f8"),
+        # Distance of the boresight to the closest point of interest (km)
+        ("min_distance", "f8"),
+        # Distance and id of the closest detected point of interest
+        ("detection_distance", "f8"),
+        ("target_id", "i4"),
+        ("boresight", "f8", (3,)),
+        # Solar illumination at the boresight (see IlluminationGate), gate is -1 where it wasn't evaluated
+        ("incidence", "f8"),
+        ("local_time", "f8"),
+        ("illumination_gate", "i1"),
+        # Light time and stellar aberration correction the boresight and distances were computed with (see sincpt)
+        ("aberration_correction", "U5"),
+    ]
+)
+
+
+class HitBuffer:
+    """Growable structured array of hits, see HIT_DTYPE"""
+
+    def __init__(self, capacity: int = SIMULATION_FLUSH_SIZE):
+        self._hits = np.empty(capacity, dtype=HIT_DTYPE)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def hits(self) -> np.ndarray:
+        """View of the buffered hits"""
+        return self._hits[: self._size]
+
+    def _reserve(self, n: int) -> np.ndarray:
+        """Slice of `n` rows following the buffered hits, the buffer is doubled if they don't fit"""
+        if self._size + n > len(self._hits):
+            grown = np.empty(max(2 * len(self._hits), self._size + n), dtype=HIT_DTYPE)
+            grown[: self._size] = self._hits[: self._size]
+            self._hits = grown
+        rows = self._hits[self._size : self._size + n]
+        self._size += n
+        return rows
+
+    def extend(
+        self,
+        ets: np.ndarray,
+        min_distances: np.ndarray,
+        detection_distances: np.ndarray,
+        target_ids: np.ndarray,
+        boresights: np.ndarray,
+        incidences: Optional[np.ndarray] = None,
+        local_times: Optional[np.ndarray] = None,
+        illumination_gates: Optional[np.ndarray] = None,
+        aberration_corrections: Optional[np.ndarray] = None,
+    ):
+        """Appends hits given column-wise, illumination columns default to not evaluated and corrections to "NONE" (geometric)"""
+        rows = self._reserve(len(ets))
+        rows["et"] = ets
+        rows["min_distance"] = min_distances
+        rows["detection_distance"] = detection_distances
+        rows["target_id"] = target_ids
+        rows["boresight"] = boresights
+        rows["incidence"] = np.nan if incidences is None else incidences
+        rows["local_time"] = np.nan if local_times is None else local_times
+        rows["illumination_gate"] = -1 if illumination_gates is None else illumination_gates
+        rows["aberration_correction"] = "NONE" if aberration_corrections is None else aberration_corrections
+
+    def clear(self):
+        self._size = 0
+
+    def to_documents(self, instrument: str, target_names: np.ndarray, timestamps: List[datetime]) -> List[Dict]:
+        """
+        Documents of the buffered hits (in the format of Sessions.insert_simulation_results), `timestamps` are UTC
+        timestamps of all buffered hits (see ets_to_datetimes)
+        """
+        hits = self.hits
+        if not len(hits):
+            return []
+        gates = hits["illumination_gate"].tolist()
+        metas = [
+            {} if gate < 0 else {"incidence": incidence, "local_time": local_time, "illumination_gate": bool(gate)}
+            for gate, incidence, local_time in zip(gates, hits["incidence"].tolist(), hits["local_time"].tolist())
+        ]
+        return [
+            {
+                "instrument": instrument,
+                "et": et,
+                "min_distance": min_distance,
+                "detection_distance": detection_distance,
+                "pit": str(pit),
+                "boresight": boresight,
+                "meta": meta,
+                "aberration_correction": aberration_correction,
+                "timestamp_utc": timestamp,
+            }
+            for et, min_distance, detection_distance, pit, boresight, meta, aberration_correction, timestamp in zip(
+                hits["et"].tolist(),
+                hits["min_distance"].tolist(),
+                hits["detection_distance"].tolist(),
+                target_names[hits["target_id"]],
+                hits["boresight"].tolist(),
+                metas,
+                hits["aberration_correction"].tolist(),
+                timestamps,
+            )
+        ]
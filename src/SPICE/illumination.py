@@ -0,0 +1,72 @@
+"""
+Solar illumination of the lunar surface - solar incidence and local solar time, evaluated for whole batches at once
+"""
+import sys
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+sys.path.insert(0, "/".join(__file__.split("/")[:-3]))
+
+import numpy as np
+import spiceypy as spice
+
+from src.SPICE.config import MOON_STR_ID, MOON_REF_FRAME_STR_ID, ABBERRATION_CORRECTION
+
+SUN_STR_ID = "SUN"
+
+
+def sun_positions(ets: np.ndarray) -> np.ndarray:
+    """(N, 3) positions of the Sun w.r.t. the Moon in the lunar body-fixed frame"""
+    positions, _ = spice.spkpos(SUN_STR_ID, np.asarray(ets, dtype=float), MOON_REF_FRAME_STR_ID, ABBERRATION_CORRECTION, MOON_STR_ID)
+    return np.asarray(positions).reshape(-1, 3)
+
+
+def solar_incidences(points: np.ndarray, suns: np.ndarray) -> np.ndarray:
+    """
+    Angles (deg) between the local vertical of (N, 3) surface points and directions to the Sun, over 90 on the night
+    side. The vertical is radial, so the local slope of the terrain is not considered
+    """
+    normals = points / np.linalg.norm(points, axis=1)[:, None]
+    to_sun = suns - points
+    cosines = np.einsum("ij,ij->i", normals, to_sun) / np.linalg.norm(to_sun, axis=1)
+    return np.degrees(np.arccos(np.clip(cosines, -1, 1)))
+
+
+def local_solar_times(points: np.ndarray, suns: np.ndarray) -> np.ndarray:
+    """Local solar times (hours, noon at the sub-solar longitude) of (N, 3) surface points, as spice.et2lst"""
+    longitudes = np.arctan2(points[:, 1], points[:, 0])
+    sun_longitudes = np.arctan2(suns[:, 1], suns[:, 0])
+    return np.mod(12 + np.degrees(longitudes - sun_longitudes) / 15, 24)
+
+
+def within_window(values: np.ndarray, window: Optional[Tuple[float, float]]) -> np.ndarray:
+    """Mask of values within the (start, end) window, start > end wraps around (e.g. (18, 6) local time), None passes all"""
+    values = np.asarray(values)
+    if window is None:
+        return np.ones(values.shape, dtype=bool)
+    start, end = window
+    if start <= end:
+        return (values >= start) & (values <= end)
+    return (values >= start) | (values <= end)
+
+
+@dataclass
+class IlluminationGate:
+    """
+    Passes hits with local solar time and solar incidence within given windows
+
+    Local time window is in hours, e.g. (18, 6) for the night or (3, 6) for the pre-dawn, incidence window in degrees.
+    None doesn't restrict the quantity. With `drop`, hits outside the windows are dropped, otherwise they are only tagged
+    """
+
+    local_time_window: Optional[Tuple[float, float]] = None
+    incidence_window: Optional[Tuple[float, float]] = None
+    drop: bool = True
+
+    def evaluate(self, ets: np.ndarray, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Mask of passed hits, solar incidences (deg) and local solar times (h) of (N, 3) surface points at epochs `ets`"""
+        suns = sun_positions(ets)
+        incidences = solar_incidences(points, suns)
+        local_times = local_solar_times(points, suns)
+        passed = within_window(local_times, self.local_time_window) & within_window(incidences, self.incidence_window)
+        return passed, incidences, local_times
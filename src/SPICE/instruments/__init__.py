@@ -1,6 +1,6 @@
 import sys
 sys.path.insert(0, "/".join(__file__.split("/")[:-4]))
 
-from src.SPICE.instruments.lro import DIVINERInstrument
+from src.SPICE.instruments.diviner import DIVINERInstrument
 
-__all__ = ["DIVINERInstrument", "LROSweepIterator"]
\ No newline at end of file
+__all__ = ["DIVINERInstrument"]
\ No newline at end of file
@@ -1,14 +1,18 @@
+import os
 import sys
+import time
+import hashlib
 import logging
-from scipy.spatial import cKDTree
+from collections import deque
+from datetime import datetime
 from tqdm import tqdm
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Tuple, List, Dict, Optional
+from typing import Callable, Tuple, List, Dict, Optional, Iterator
 
 import numpy as np
+import pandas as pd
 import spiceypy as spice
-from astropy.time import Time, TimeDelta
 
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -19,20 +23,60 @@ sys.path.insert(0, "/".join(__file__.split("/")[:-4]))
 from src.SPICE.config import (
     MOON_STR_ID,
     ABBERRATION_CORRECTION,
+    COARSE_ABBERRATION_CORRECTION,
     MOON_REF_FRAME_STR_ID,
     TIME_STEP,
     MAX_TIME_STEP,
     LRO_SPEED,
-    LUNAR_MODEL,
+    SIMULATION_BATCH_SIZE,
+    SIMULATION_FLUSH_SIZE,
+    TIMESTEP_HISTORY_SIZE,
+    OVERFLIGHT_WINDOW_TOLERANCE,
+    SIMULATION_CHECKPOINT_INTERVAL,
+    GEOMETRY_CACHE_DESTINATION,
+    PIT_DISTANCE_FIELD_DESTINATION,
+    PIT_SURFACE_DESTINATION,
+    PIT_CATALOG_DESTINATION,
+    TARGET_RADIUS_CLASS_RATIO,
+    SWEEP_METRICS_PROMETHEUS_PORT,
 )
 from src.global_config import TQDM_NCOLS
 from src.db.mongo.interface import Sessions
+from src.db.mongo.background_writer import BackgroundWriter
+from src.SPICE.geometry import ellipsoid_intercepts, polygon_distances
+from src.SPICE.step_controller import StepController
+from src.SPICE.overflight import OverflightWindowFinder
+from src.SPICE.geometry_cache import GeometryCache
+from src.SPICE.pit_distance_field import PitDistanceField
+from src.SPICE.pit_catalog import PitCatalog
+from src.SPICE.hit_buffer import HitBuffer, HIT_DTYPE
+from src.SPICE.target_index import RadiusClassIndex
+from src.SPICE.illumination import IlluminationGate
+from src.SPICE.sweep_metrics import SweepMetrics, start_prometheus_exporter
 
 
 class HandledExpeption(Exception):
     pass
 
 
+def ets_to_datetimes(ets: np.ndarray) -> List[datetime]:
+    """Converts ephemeris times into UTC datetimes in a single pass"""
+    if not len(ets):
+        return []
+    utc = spice.et2utc(np.asarray(ets, dtype=float), "ISOC", 6)
+    # datetime can not represent a leap second (hh:mm:60), such epochs are clipped to the end of the minute
+    return np.char.replace(utc, ":60.", ":59.").astype("datetime64[us]").tolist()
+
+
+def attach_utc_timestamps(results: List[Dict], et_keys: Optional[Dict[str, str]] = None) -> List[Dict]:
+    """Fills UTC timestamps of simulation results from their ephemeris times (`et_keys` maps ET key to UTC key, `et` to `timestamp_utc` by default), converted for the whole batch at once"""
+    et_keys = {"et": "timestamp_utc"} if et_keys is None else et_keys
+    for et_key, utc_key in et_keys.items():
+        for result, timestamp in zip(results, ets_to_datetimes([result[et_key] for result in results])):
+            result[utc_key] = timestamp
+    return results
+
+
 
 class Instrument(ABC):
 
@@ -84,6 +128,46 @@ class Instrument(ABC):
     _universal_subinstrument_frame = None
     # Here we aggregate the mean of subinstrument boresight in 
     _boresight = None
+    # Two-tier intercepts - cheap analytic ellipsoid intercepts drive the distance test and timestep adjustment,
+    # rays are intersected with the DSK only when closer than rough_treshold + coarse_intercept_margin to a target
+    tiered_intercepts = True
+    # Has to cover the difference between the ellipsoid and DSK intercept given by the lunar relief (km)
+    coarse_intercept_margin = 12
+    # Derive timestep from the footprint ground speed (see StepController), otherwise from constant LRO_SPEED
+    state_aware_timestep = True
+    # Sweep yields one refined window per overflight of a point of interest instead of every epoch within the treshold
+    overflight_windows = True
+    # When set (see use_geometry_cache), spacecraft geometry is interpolated from precomputed samples instead of SPICE
+    geometry_cache: Optional[GeometryCache] = None
+    # Points of interest are detected within finer_treshold from FOV polygons of sub-instruments projected onto the DSK,
+    # otherwise within rough_treshold from the boresight. Rough treshold still preselects the candidates
+    footprint_hits = True
+    _footprint_bounds = None
+    # Returns points of interest as a DataFrame indexed by name with latitude and longitude columns (degrees)
+    pit_source: Callable[[], pd.DataFrame] = staticmethod(Sessions.get_all_pits_points)
+    # Surface points of pits are intersected with the DSK once per catalogue and DSK, then loaded from here
+    pit_surface_destination = PIT_SURFACE_DESTINATION
+    # Memory-mapped catalogues of pits (see PitCatalog), shared by all processes sweeping the same catalogue and DSK
+    pit_catalog_destination = PIT_CATALOG_DESTINATION
+    # Distances to points of interest are looked up in a precomputed field (see PitDistanceField), the KD-Tree is
+    # queried only for points closer than rough_treshold + coarse_intercept_margin + pit_distance_field_exact_margin
+    pit_distance_field_lookups = True
+    pit_distance_field_destination = PIT_DISTANCE_FIELD_DESTINATION
+    # Lower bounds from the field are off by up to two cell radii, exact distances keep timesteps long while approaching
+    pit_distance_field_exact_margin = 25
+    # Each pit gets its own distance tolerance - its radius (from the funnel or inner diameter in the atlas) plus
+    # target_tolerance_margin (km), covering pointing uncertainty and footprint of a single detector. The tolerance is
+    # at most distance_tolerance, which also applies to pits of unknown size
+    per_target_tolerances = True
+    target_tolerance_margin = 1
+    # When set, hits are gated by solar illumination at the boresight (overflight windows at the pit and their
+    # closest approach) before they are stored, e.g. IlluminationGate(local_time_window=(18, 6)) for night passes
+    illumination_gate: Optional[IlluminationGate] = None
+    # Light time and stellar aberration corrections (see sincpt). The coarse one is used far from points of interest
+    # ("NONE" or "LT", batched DSK intercepts are always geometric), epochs with detections are evaluated again with
+    # the refined one, as are overflight windows. Footprints are shifted by the correction of the boresight intercept
+    coarse_aberration_correction = COARSE_ABBERRATION_CORRECTION
+    refined_aberration_correction = ABBERRATION_CORRECTION
 
     @property
     def boresight(self):
@@ -111,28 +195,98 @@ class Instrument(ABC):
     def finer_treshold(self) -> float:
         return self.distance_tolerance
 
+    @property
+    def detection_treshold(self) -> float:
+        """Largest detection treshold, tresholds of individual points of interest are in _detection_tresholds"""
+        return self.finer_treshold if self.footprint_hits else self.rough_treshold
+
+    @property
+    def target_tolerances(self) -> np.ndarray:
+        """Distance tolerances (km) of points of interest by their ids, counterpart of distance_tolerance"""
+        if not self.per_target_tolerances:
+            return np.full(len(self._target_points), float(self.distance_tolerance))
+        tolerances = np.minimum(self._target_radii + self.target_tolerance_margin, self.distance_tolerance)
+        return np.where(np.isnan(tolerances), self.distance_tolerance, tolerances)
+
+    @property
+    def footprint_bounds(self) -> np.ndarray:
+        """FOV bound vectors of all sub-instruments (S, V, 3) in the uniform frame"""
+        if self._footprint_bounds is None:
+            n_vertices = max(len(sub.bounds) for sub in self.sub_instruments.values())
+            # Polygons with less vertices are padded by repeating the last one (a zero length edge)
+            self._footprint_bounds = np.stack(
+                [
+                    np.vstack([sub.bounds, np.repeat(sub.bounds[-1:], n_vertices - len(sub.bounds), axis=0)])
+                    for sub in self.sub_instruments.values()
+                ]
+            )
+        return self._footprint_bounds
 
-    def __init__(self):
-        self.sweep_iterator = self.sweep_iterator_class()
-        self.computation_timedelta = TimeDelta(TIME_STEP, format="sec")
-        self.current_simulation_timestamp = self.sweep_iterator.min_loaded_time + self.computation_timedelta
-        self.current_simulation_timestamp_et = spice.str2et(self.current_simulation_timestamp.utc.iso)
+    @property
+    def aberration_correction(self) -> str:
+        """Correction of hits and overflight windows, intercepts from the geometry cache are geometric"""
+        return "NONE" if self.geometry_cache is not None else self.refined_aberration_correction
+
+    @property
+    def run_fingerprint(self) -> str:
+        """Identifies the DSK and dynamic kernels the sweep runs on, checkpoints can't be resumed with different ones"""
+        dsk_stat = os.stat(self.sweep_iterator.dsk_path)
+        fingerprint = hashlib.sha1(f"{os.path.basename(self.sweep_iterator.dsk_path)}:{dsk_stat.st_size}:{dsk_stat.st_mtime_ns}".encode())
+        fingerprint.update(self.sweep_iterator.dynamic_kernels_fingerprint.encode())
+        return fingerprint.hexdigest()
+
+
+    def __init__(
+        self,
+        shared_from: Optional["Instrument"] = None,
+        pit_catalog: Optional[PitCatalog] = None,
+        start_et: Optional[float] = None,
+        stop_et: Optional[float] = None,
+    ):
+        """
+        Instruments swept together (see Sweeper) share the kernel pool and points of interest with `shared_from`,
+        workers of parallel sweeps attach to `pit_catalog` built by the main process instead of fetching pits.
+        Static kernels are planned only for sweeps between `start_et` and `stop_et` (see SweepIterator), the clock
+        is set to `start_et` so no dynamic kernels outside of the range are furnished
+        """
+        self.sweep_iterator = self.sweep_iterator_class(start_et, stop_et) if shared_from is None else shared_from.sweep_iterator
+        self.metrics = SweepMetrics(self.name)
+        self.moon_radii = spice.bodvrd(MOON_STR_ID, "RADII", 3)[1]
+        self.step_controller = StepController(self)
+        # Simulation clock runs in ephemeris time (TDB seconds past J2000), UTC is computed only for found points
+        self.computation_timestep = TIME_STEP
+        self.current_simulation_timestamp_et = self.sweep_iterator.min_loaded_time + self.computation_timestep
         self.current_simulation_step = 0
 
         # Get points of interest and build a KD-Tree for fast spatial searches
-        self._load_target_points()
-
-        # Set simulation start time considering instrument offset
-        self._set_time(self.sweep_iterator.min_loaded_time + TimeDelta(self.offset_days, format="jd"))
-        self.sweep_iterator.initiate_sweep(self.current_simulation_timestamp)
+        if shared_from is None:
+            self._load_target_points(pit_catalog)
+        else:
+            self.pit_catalog = shared_from.pit_catalog
+            self._target_points, self._target_names = shared_from._target_points, shared_from._target_names
+            self._target_ids, self.kd_tree = shared_from._target_ids, shared_from.kd_tree
+            self._target_radii, self.pit_distance_field = shared_from._target_radii, shared_from.pit_distance_field
+        # Counterparts of finer, rough and detection tresholds for each point of interest, tolerances differ by instrument
+        tolerances = self.target_tolerances
+        rough_tresholds = self.subinstrumen_offset + tolerances + self.fov_offset
+        self._detection_tresholds = tolerances if self.footprint_hits else rough_tresholds
+        self.target_index = RadiusClassIndex(self._target_points, rough_tresholds, TARGET_RADIUS_CLASS_RATIO)
+        self.window_finder = OverflightWindowFinder(self._detection_tresholds, self._target_distance, OVERFLIGHT_WINDOW_TOLERANCE)
+
+        # Set simulation start time considering instrument offset, sweeps of a given range start at its first covered epoch
+        if start_et is None:
+            start_et = self.sweep_iterator.min_loaded_time + self.offset_days * spice.spd()
+        elif (covered_et := self.sweep_iterator.coverage.next_covered(start_et)) is not None:
+            start_et = covered_et
+        self._set_time(start_et)
+        self.sweep_iterator.initiate_sweep(self.current_simulation_timestamp_et)
 
         self.sub_instruments: Dict[int, Tuple[str, np.ndarray, np.ndarray]] = {}
         self.instantiate_subinstruments()
         # Setting the uniform frame for all sub-instruments to skip on tranformation matrix computation for each subinstrument
-        self.uniform_sub_instrument_frame = self.sub_instruments[0].frame if self._universal_subinstrument_frame is None else self._universal_subinstrument_frame
-        if len(set(self.sub_instrument_frames)) == 1 and self._universal_subinstrument_frame is not None:
-            self._transformation_matrix = (-1, None)
-        else:
+        self.uniform_sub_instrument_frame = next(iter(self.sub_instruments.values())).frame if self._universal_subinstrument_frame is None else self._universal_subinstrument_frame
+        self._transformation_matrix = (-1, None)
+        if len(set(self.sub_instrument_frames)) != 1 or self._universal_subinstrument_frame is not None:
             # Convert the rest of the sensors into the same frame
             for sub_instrument in self.sub_instruments.values():
                 projection_matrix = spice.pxform(sub_instrument.frame, self.uniform_sub_instrument_frame, self.current_simulation_timestamp_et)
@@ -144,9 +298,29 @@ class Instrument(ABC):
         self._found_timestamps, self._found_timestamps_cnt = [], 0
         self._boresight_projections = []
         self._failed_timestamps, self._failed_timestamps_cnt = [], 0
-        self.adjusted_timesteps = []
-        self.min_distances = []
+        self._dsk_calls_cnt, self._dsk_calls_avoided_cnt = 0, 0
+        self._illumination_gated_cnt = 0
+        # Only the latest timesteps are kept for inspection, the sweep takes hundreds of millions of them
+        self.adjusted_timesteps = deque(maxlen=TIMESTEP_HISTORY_SIZE)
+        self.min_distances = deque(maxlen=TIMESTEP_HISTORY_SIZE)
+        # Epochs with detected points of interest, until they're flushed as documents (see HitBuffer)
+        self.hits = HitBuffer()
+
+
+    def use_geometry_cache(self, destination: str = GEOMETRY_CACHE_DESTINATION):
+        """
+        Evaluates spacecraft geometry from the cache built by GeometryCache.build for the uniform sub-instrument frame.
+        Dynamic kernels are not furnished during the sweep anymore and DSK intercepts are geometric
+        """
+        geometry_cache = GeometryCache(self.satellite_frame, self.uniform_sub_instrument_frame, destination)
+        if geometry_cache.fingerprint != self.sweep_iterator.dynamic_kernels_fingerprint:
+            raise ValueError(f"Geometry cache in {geometry_cache.directory} was built from different kernels, rebuild it")
+        self.geometry_cache = geometry_cache
 
+    def _refresh_kernels(self, et: float):
+        if self.geometry_cache is None:
+            with self.metrics.stage("kernel_refresh"):
+                self.sweep_iterator.step(et)
 
     def instantiate_subinstruments(self):
         for naif_id in self.instrument_ids:
@@ -155,38 +329,278 @@ class Instrument(ABC):
             self.sub_instruments[naif_id] = self.SubInstrument(naif_id, frame, np.array(bounds), np.array(boresight))
 
 
-    def project_vector(self, et, vector) -> np.array:
-        # spice.sincpt("DSK/UNPRIORITIZED", MOON_STR_ID, et, MOON_REF_FRAME_STR_ID, ABBERRATION_CORRECTION, self.satellite_frame, self.frame, vector)
-        # import pdb; pdb.set_trace()
-        return spice.sincpt(
-            "DSK/UNPRIORITIZED",
-            MOON_STR_ID,
-            et,  # Time (just a number, the astro time)
-            MOON_REF_FRAME_STR_ID,
-            ABBERRATION_CORRECTION,
-            self.satellite_frame,
-            self.frame,
-            vector,
-        )
+    def project_vector(self, et, vector, aberration_correction: str = ABBERRATION_CORRECTION) -> np.array:
+        with self.metrics.stage("sincpt"):
+            return spice.sincpt(
+                "DSK/UNPRIORITIZED",
+                MOON_STR_ID,
+                et,  # Time (just a number, the astro time)
+                MOON_REF_FRAME_STR_ID,
+                aberration_correction,
+                self.satellite_frame,
+                self.frame,
+                vector,
+            )
 
     def transformation_matrix(self, et) -> Optional[np.array]:
         if et == self._transformation_matrix[0]:
             return self._transformation_matrix[1]
         else:
-            matrix = spice.pxform(self.uniform_sub_instrument_frame, self.frame, et)
+            with self.metrics.stage("pxform"):
+                matrix = spice.pxform(self.uniform_sub_instrument_frame, self.frame, et)
             self._transformation_matrix = (et, matrix)
             return matrix
 
-    def compute_views_instrument_boresight(self, et) -> Dict[str, Dict]:
+    def compute_views_instrument_boresight(self, et, aberration_correction: str = ABBERRATION_CORRECTION) -> Dict[str, Dict]:
         """
         Compute views for the instrument at given time
         Where on the Lunar surface are we looking at
         """
         boresight_point, boresight_trgepc, _ = self.project_vector(
-            et, spice.mxv(self.transformation_matrix(et), self.boresight)
+            et, spice.mxv(self.transformation_matrix(et), self.boresight), aberration_correction
         )
         return {"et": et, "boresight": boresight_point, "boresight_trgepc": boresight_trgepc}
 
+    def project_boresight(self, et: float, aberration_correction: Optional[str] = None) -> Optional[np.ndarray]:
+        """
+        Surface intercept of the boresight at given epoch, None if there is none (used to refine overflight windows).
+        The correction defaults to aberration_correction, with geometry cache the intercept is always geometric
+        (see compute_views_instrument_boresight_batch)
+        """
+        try:
+            if self.geometry_cache is not None:
+                points, found, _ = self.compute_views_instrument_boresight_batch([et])
+                return points[0] if found[0] else None
+            self._dsk_calls_cnt += 1
+            return self.compute_views_instrument_boresight(et, aberration_correction or self.aberration_correction)["boresight"]
+        except spice.SpiceyError:
+            return None
+
+    def spacecraft_positions_batch(self, ets: np.ndarray) -> np.ndarray:
+        """Positions of the spacecraft w.r.t. the Moon in the lunar body-fixed frame (N, 3), NaN where SPK coverage is missing"""
+        if self.geometry_cache is not None:
+            with self.metrics.stage("geometry_cache"):
+                return self.geometry_cache.positions(ets)
+        positions = np.full((len(ets), 3), np.nan)
+        with self.metrics.stage("spkpos"):
+            try:
+                positions[:], _ = spice.spkpos(self.satellite_frame, ets, MOON_REF_FRAME_STR_ID, "NONE", MOON_STR_ID)
+            except spice.SpiceyError:
+                # Some epochs are not covered, fall back to per-epoch queries to find out which
+                for i, et in enumerate(ets if len(ets) > 1 else []):
+                    try:
+                        positions[i], _ = spice.spkpos(self.satellite_frame, et, MOON_REF_FRAME_STR_ID, "NONE", MOON_STR_ID)
+                    except spice.SpiceyError:
+                        pass
+        return positions
+
+    def spacecraft_geometry_batch(self, ets: np.ndarray, positions: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Fetch spacecraft positions and instrument attitude for all epochs at once
+
+        Returns positions of the spacecraft w.r.t. the Moon in the lunar body-fixed frame (N, 3), rotation matrices
+        from the uniform sub-instrument frame into the lunar body-fixed frame (N, 3, 3) and a mask of epochs for
+        which both were available (missing CK/SPK coverage yields NaNs). Positions shared by instruments on the same
+        spacecraft can be passed in, so they are not computed again
+        """
+        if self.geometry_cache is not None:
+            with self.metrics.stage("geometry_cache"):
+                states, rotations = self.geometry_cache.evaluate(ets)
+            positions = states[:, :3] if positions is None else positions
+            return positions, rotations, ~(np.isnan(positions).any(axis=1) | np.isnan(rotations).any(axis=(1, 2)))
+        positions = self.spacecraft_positions_batch(ets) if positions is None else positions
+        rotations = np.full((len(ets), 3, 3), np.nan)
+        valid = ~np.isnan(positions).any(axis=1)
+
+        with self.metrics.stage("pxform"):
+            for i in np.flatnonzero(valid):
+                try:
+                    rotations[i] = spice.pxform(self.uniform_sub_instrument_frame, MOON_REF_FRAME_STR_ID, ets[i])
+                except spice.SpiceyError:
+                    valid[i] = False
+        return positions, rotations, valid
+
+    def compute_views_instrument_boresight_coarse(self, ets: np.ndarray, positions: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Intersects the boresight with the reference ellipsoid of the Moon for all epochs at once
+
+        Returns (N, 3) array of ellipsoid intercepts (NaN where no intercept), a boolean hit mask, spacecraft positions
+        and boresight directions in the lunar body-fixed frame (so the rays could be intersected with the DSK later)
+        """
+        ets = np.asarray(ets, dtype=float)
+        points = np.full((len(ets), 3), np.nan)
+        found = np.zeros(len(ets), dtype=bool)
+
+        positions, rotations, valid = self.spacecraft_geometry_batch(ets, positions)
+        directions = np.einsum("nij,j->ni", rotations, self.boresight)
+        if valid.any():
+            points[valid], found[valid] = ellipsoid_intercepts(positions[valid], directions[valid], self.moon_radii)
+        return points, found, positions, directions
+
+    def compute_views_instrument_boresight_batch(self, ets: np.ndarray, positions: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Batched counterpart of compute_views_instrument_boresight
+
+        With tiered intercepts, rays are intersected with the reference ellipsoid first and only those landing
+        within rough_treshold + coarse_intercept_margin from a point of interest are intersected with the DSK,
+        otherwise all of them are. DSK intercepts are computed in a single dskxv call and are geometric (no light
+        time or stellar aberration correction), which amounts to meters for LRO altitudes.
+
+        Returns (N, 3) array of surface intercepts (NaN where no intercept), a boolean hit mask and distances
+        to the closest point of interest (inf where no intercept). For rays not intersected with the DSK,
+        the distance is lowered by coarse_intercept_margin, so it's a safe lower bound for timestep adjustment
+        """
+        ets = np.asarray(ets, dtype=float)
+        points, found, positions, directions = self.compute_views_instrument_boresight_coarse(ets, positions)
+        min_distances = np.full(len(ets), np.inf)
+
+        if self.tiered_intercepts:
+            min_distances[found] = self._closest_target_distances(points[found])
+            refine = found & (min_distances < self.rough_treshold + self.coarse_intercept_margin)
+            min_distances[found & ~refine] -= self.coarse_intercept_margin
+            self._dsk_calls_avoided_cnt += int((found & ~refine).sum())
+        else:
+            refine = ~np.isnan(directions).any(axis=1)
+
+        if refine.any():
+            with self.metrics.stage("dskxv"):
+                intercepts, intercept_found = spice.dskxv(
+                    False, MOON_STR_ID, [], float(ets[refine][0]), MOON_REF_FRAME_STR_ID, positions[refine], directions[refine]
+                )
+            self._dsk_calls_cnt += int(refine.sum())
+            intercept_found = np.asarray(intercept_found, dtype=bool)
+            refined_indices = np.flatnonzero(refine)
+            points[refined_indices] = np.where(intercept_found[:, None], intercepts, np.nan)
+            found[refined_indices] = intercept_found
+            min_distances[refined_indices] = np.inf
+            if intercept_found.any():
+                min_distances[refined_indices[intercept_found]] = self._closest_target_distances(intercepts[intercept_found])
+        return points, found, min_distances
+
+    @property
+    def _exact_distance_radius(self) -> float:
+        return self.rough_treshold + self.coarse_intercept_margin + self.pit_distance_field_exact_margin
+
+    def _closest_target_distances(self, points: np.ndarray) -> np.ndarray:
+        """
+        Distances of (N, 3) surface points to the closest point of interest. With the pit distance field, only those
+        closer than _exact_distance_radius are exact, others are lower bounds
+        """
+        if self.pit_distance_field is None:
+            with self.metrics.stage("kd_query"):
+                return self.kd_tree.query(points)[0]
+        with self.metrics.stage("distance_field"):
+            distances = self.pit_distance_field.lookup(points)[0]
+        exact = distances < self._exact_distance_radius
+        if exact.any():
+            with self.metrics.stage("kd_query"):
+                distances[exact] = self.kd_tree.query(points[exact])[0]
+        return distances
+
+    def _closest_target_distance(self, point: np.ndarray) -> float:
+        """Scalar counterpart of _closest_target_distances"""
+        if self.pit_distance_field is not None:
+            with self.metrics.stage("distance_field"):
+                distance = self.pit_distance_field.lookup_one(point)[0]
+            if distance >= self._exact_distance_radius:
+                return distance
+        with self.metrics.stage("kd_query"):
+            return float(self.kd_tree.query(point)[0])
+
+    def compute_footprints_batch(
+        self, ets: np.ndarray, positions: Optional[np.ndarray] = None, aberration_correction: str = "NONE"
+    ) -> np.ndarray:
+        """
+        Projects FOV bounds of all sub-instruments onto the DSK for all epochs at once, in a single dskxv call
+
+        Returns (N, S, V, 3) array of footprint polygon vertices, NaN where a bound vector misses the surface.
+        Like compute_views_instrument_boresight_batch, intercepts are geometric. With a correction, each footprint
+        is shifted by the difference of the corrected (sincpt) and geometric boresight intercepts - light time and
+        stellar aberration move the whole footprint of a few km alike. Footprints stay geometric where either
+        boresight intercept is missing
+        """
+        ets = np.asarray(ets, dtype=float)
+        bounds = self.footprint_bounds
+        footprints = np.full((len(ets), *bounds.shape), np.nan)
+        positions, rotations, valid = self.spacecraft_geometry_batch(ets, positions)
+        if not valid.any():
+            return footprints
+
+        directions = np.einsum("nij,svj->nsvi", rotations[valid], bounds)
+        vertices = np.broadcast_to(positions[valid][:, None, None], directions.shape).reshape(-1, 3)
+        rays = directions.reshape(-1, 3)
+        corrected = aberration_correction != "NONE" and self.geometry_cache is None
+        if corrected:
+            # Geometric boresight intercepts are computed along with the bounds
+            vertices = np.vstack([vertices, positions[valid]])
+            rays = np.vstack([rays, np.einsum("nij,j->ni", rotations[valid], self.boresight)])
+        with self.metrics.stage("dskxv"):
+            intercepts, found = spice.dskxv(
+                False, MOON_STR_ID, [], float(ets[valid][0]), MOON_REF_FRAME_STR_ID, np.ascontiguousarray(vertices), np.ascontiguousarray(rays)
+            )
+        self._dsk_calls_cnt += len(intercepts)
+        intercepts = np.where(np.asarray(found, dtype=bool)[:, None], intercepts, np.nan)
+        if corrected:
+            intercepts, geometric_boresights = intercepts[: len(directions.reshape(-1, 3))], intercepts[len(directions.reshape(-1, 3)) :]
+            offsets = np.zeros_like(geometric_boresights)
+            for k, et in enumerate(ets[valid]):
+                if (boresight := self.project_boresight(float(et), aberration_correction)) is not None:
+                    offsets[k] = np.nan_to_num(boresight - geometric_boresights[k])
+            intercepts = intercepts.reshape(directions.shape) + offsets[:, None, None]
+        footprints[valid] = intercepts.reshape(directions.shape)
+        return footprints
+
+    def _detection_distances(
+        self,
+        ets: np.ndarray,
+        boresights: np.ndarray,
+        min_distances: np.ndarray,
+        positions: Optional[np.ndarray] = None,
+        aberration_correction: str = "NONE",
+    ) -> List[Dict[int, float]]:
+        """
+        Distances of detected points of interest by their ids, for each epoch
+
+        Candidates are points within their own rough treshold from the boresight (see target_tolerances). With
+        footprint_hits, they are detected within their tolerance from the footprint of any sub-instrument (zero
+        inside), tested for all candidates at once. Footprints are projected only for epochs with candidates, with
+        given correction (boresights are expected to have the same one)
+        """
+        detections = [{} for _ in range(len(ets))]
+        near = np.flatnonzero(min_distances < self.rough_treshold)
+        if not len(near):
+            return detections
+
+        with self.metrics.stage("kd_query"):
+            candidates = self.target_index.query_ball_point(boresights[near])
+        has_candidates = np.array([len(target_ids) > 0 for target_ids in candidates])
+        near, candidates = near[has_candidates], [target_ids for target_ids in candidates if len(target_ids)]
+        if not len(near):
+            return detections
+        if self.footprint_hits:
+            footprints = self.compute_footprints_batch(
+                np.asarray(ets)[near], None if positions is None else positions[near], aberration_correction
+            )
+        with self.metrics.stage("footprint_test"):
+            for k, (i, target_ids) in enumerate(zip(near, candidates)):
+                if self.footprint_hits:
+                    distances = polygon_distances(self._target_points[target_ids], footprints[k]).min(axis=1)
+                else:
+                    distances = np.linalg.norm(self._target_points[target_ids] - boresights[i], axis=1)
+                detected = distances < self._detection_tresholds[target_ids]
+                detections[i] = {int(target_id): float(distance) for target_id, distance in zip(target_ids[detected], distances[detected])}
+        return detections
+
+    def _target_distance(self, et: float, target_id: int) -> Optional[float]:
+        """Distance of a point of interest at given epoch as used for detection, None if it can't be evaluated"""
+        if self.footprint_hits:
+            footprints = self.compute_footprints_batch([et], aberration_correction=self.aberration_correction)
+            distance = polygon_distances(self._target_points[[target_id]], footprints[0]).min()
+            return None if np.isinf(distance) else float(distance)
+        if (boresight := self.project_boresight(et)) is None:
+            return None
+        return float(np.linalg.norm(boresight - self._target_points[target_id]))
+
     def compute_views_subinstruments_boresight(self, et) -> Dict[int, Dict]:
         """
         Compute views for the instrument at given time
@@ -227,105 +641,389 @@ class Instrument(ABC):
             }
         return bounds
 
-    def _load_target_points(self):
-        """Fetches crater points and converts lat/lon to Cartesian coordinates using DSK."""
-        points = Sessions.get_all_pits_points()
-        lat_rad = np.radians(points["latitude"])
-        lon_rad = np.radians(points["longitude"])
-
-        # Load DSK file and get a valid handle
-        dsk_handle = spice.dasopr(LUNAR_MODEL['dsk_path'])  # Open the DSK file
-        # Find the DSK segment descriptor
-        dladsc = spice.dlabfs(dsk_handle)  # Get the first segment in the file
-
-        cartesian_points = []
-        for lat, lon in zip(lat_rad, lon_rad):
-            # Convert lat/lon to a unit vector for the ray direction
-            cartesians = np.array(spice.latrec(1.0, lon, lat))  # Ensure it's an array
-
-            # We have to simulate observer above the ground, looking at [0,0,0], because interception could not be calculated from within
-            _, spoint, found = spice.dskx02(dsk_handle, dladsc, cartesians * 10_000, (-1) * cartesians)
-
-            if found:
-                cartesian_points.append(spoint)
-            else:
-                logger.warning(f"No surface intercept found for lat: {lat}, lon: {lon}")
-                cartesian_points.append([np.nan, np.nan, np.nan])  # Mark missing points
-
-        # Close the DSK file
-        spice.dascls(dsk_handle)
-
-        # Store computed points
-        points["X"], points["Y"], points["Z"] = np.array(cartesian_points).T
-        self._target_points = points[["X", "Y", "Z"]].values
+    def _load_target_points(self, pit_catalog: Optional[PitCatalog] = None):
+        """Fetches crater points from pit_source and converts lat/lon to Cartesian coordinates using DSK (see PitCatalog)."""
+        if pit_catalog is None:
+            pit_catalog = PitCatalog.load_or_build(
+                self.pit_source(), self.sweep_iterator.dsk_path, self.pit_catalog_destination, self.pit_surface_destination
+            )
+        self.pit_catalog = pit_catalog
+        self._target_points = pit_catalog.points
+        self._target_names = pit_catalog.names
         self._target_ids = np.arange(len(self._target_points))
-        self.kd_tree = cKDTree(self._target_points)
+        self._target_radii = pit_catalog.radii
+        self.kd_tree = pit_catalog.kd_tree
+        self.pit_distance_field = (
+            PitDistanceField.load_or_build(self._target_points, self.moon_radii.mean(), destination=self.pit_distance_field_destination)
+            if self.pit_distance_field_lookups
+            else None
+        )
 
 
 
     def _step_time(self):
-        self.current_simulation_timestamp += self.computation_timedelta
-        self.current_simulation_timestamp_et = spice.str2et(self.current_simulation_timestamp.utc.iso)
+        self.current_simulation_timestamp_et = self._skip_coverage_gap(self.current_simulation_timestamp_et + self.computation_timestep)
         self.current_simulation_step += 1
-        self.sweep_iterator.step(self.current_simulation_timestamp)
+        self._refresh_kernels(self.current_simulation_timestamp_et)
 
-    def _set_time(self, time: Time, timestep: Optional[int] = None):
-        self.current_simulation_timestamp = time
-        self.current_simulation_timestamp_et = spice.str2et(time.utc.iso)
+    def _skip_coverage_gap(self, et: float) -> float:
+        """
+        The start of the next interval covered by dynamic kernels if `et` falls into a coverage gap (see CoverageMap),
+        `et` otherwise. Samples on both sides of a gap are not contiguous, so jumping over it restarts the timestep,
+        step controller and overflight windows
+        """
+        covered_et = self.sweep_iterator.coverage.next_covered(et)
+        if covered_et is None or covered_et == et:
+            return et
+        self.metrics.count("coverage_gaps_skipped")
+        self.metrics.count("coverage_gap_seconds", covered_et - et)
+        self.computation_timestep = TIME_STEP
+        self.step_controller.reset()
+        self.window_finder.reset()
+        return covered_et
+
+    def _set_time(self, et: float, timestep: Optional[int] = None):
+        self.step_controller.reset()
+        self.window_finder.reset()
+        self.current_simulation_timestamp_et = et
         self.current_simulation_step = 0 if timestep is None else timestep
-        self.sweep_iterator.step(self.current_simulation_timestamp)
-
-
-    def adjust_timestep(self, min_distance: float):
-        new_time_step = (min_distance - self.rough_treshold) / LRO_SPEED
-        self.computation_timedelta = TimeDelta(min(max(TIME_STEP, new_time_step), MAX_TIME_STEP), format="sec")
+        self._refresh_kernels(self.current_simulation_timestamp_et)
+
+
+    def checkpoint_state(self) -> Dict:
+        """State of the simulation clock needed to resume the sweep right after the last evaluated epoch"""
+        return {
+            "et": self.current_simulation_timestamp_et,
+            "step": self.current_simulation_step,
+            "timestep": self.computation_timestep,
+            "step_controller": self.step_controller.state(),
+            "window_finder_last_et": self.window_finder.last_et,
+        }
+
+    def restore_checkpoint(self, checkpoint: Dict):
+        self._set_time(checkpoint["et"], checkpoint["step"])
+        self.computation_timestep = checkpoint["timestep"]
+        self.step_controller.restore(checkpoint["step_controller"])
+        self.window_finder.reset(checkpoint["window_finder_last_et"])
+
+    def adjust_timestep(self, min_distance: float, boresight_point: Optional[np.ndarray] = None):
+        if self.state_aware_timestep and boresight_point is not None:
+            new_time_step = self.step_controller.next_step(self.current_simulation_timestamp_et, boresight_point, min_distance)
+        else:
+            new_time_step = (min_distance - self.rough_treshold) / LRO_SPEED
+        self.computation_timestep = min(max(TIME_STEP, new_time_step), MAX_TIME_STEP)
         self.adjusted_timesteps.append(new_time_step)
         self.min_distances.append(min_distance)
 
+    def _accept_step(self, boresight_point: np.ndarray) -> bool:
+        """Validates the step leading to current epoch, rewinds the clock if it could have skipped a point of interest"""
+        if not self.state_aware_timestep or self.step_controller.accept(self.current_simulation_timestamp_et, boresight_point):
+            return True
+        self.current_simulation_timestamp_et = self.step_controller.last_et
+        self.computation_timestep = self.step_controller.next_step()
+        return False
+
     def simulation_step_inference(self):
         try:
-            #import pdb; pdb.set_trace()
+            if self.tiered_intercepts:
+                # Coarse ellipsoid intercept is good enough to adjust timestep far from points of interest
+                boresights, found, _, _ = self.compute_views_instrument_boresight_coarse([self.current_simulation_timestamp_et])
+                if not found[0]:
+                    raise HandledExpeption("No ellipsoid intercept found")
+                # Footprint tracked by the step controller stays on the ellipsoid, to be comparable between steps
+                footprint = boresights[0]
+                if not self._accept_step(footprint):
+                    return None
+                coarse_distance = self._closest_target_distance(footprint)
+                if coarse_distance >= self.rough_treshold + self.coarse_intercept_margin:
+                    self._dsk_calls_avoided_cnt += 1
+                    self.window_finder.update(self.current_simulation_timestamp_et, {})
+                    self.adjust_timestep(coarse_distance - self.coarse_intercept_margin, footprint)
+                    return None
+
             # Projects to the lunar surface and looks for closest points (may be empty)
-            intersection = self.compute_views_instrument_boresight(self.current_simulation_timestamp_et)
-            boresight = intersection["boresight"]
-            min_distance = self.kd_tree.query(boresight)[0]
-            self.adjust_timestep(min_distance)
-            if min_distance < self.rough_treshold:
-                self._found_timestamps_cnt += 1
-                return {
-                    "instrument": self.name,
-                    "et": self.current_simulation_timestamp_et,
-                    "timestamp_utc": self.current_simulation_timestamp.to_datetime(),
-                    "min_distance": min_distance,
-                    "boresight": boresight.tolist(),
-                    "meta": {}
-                }
+            if (boresight := self.project_boresight(self.current_simulation_timestamp_et, self.coarse_aberration_correction)) is None:
+                raise HandledExpeption("No surface intercept found")
+            if not self.tiered_intercepts:
+                footprint = boresight
+                if not self._accept_step(footprint):
+                    return None
+            ets, boresights = np.array([self.current_simulation_timestamp_et]), boresight[None]
+            min_distances = np.array([self._closest_target_distance(boresight)])
+            detections = self._detection_distances(ets, boresights, min_distances, aberration_correction=self.coarse_aberration_correction)
+            corrections = self._refine_hits(ets, boresights, min_distances, detections, self.coarse_aberration_correction)
+            illumination = self._gate_detections(ets, boresights, detections)
+            self.window_finder.update(self.current_simulation_timestamp_et, detections[0])
+            self.adjust_timestep(min_distances[0], footprint)
+            self._record_hits(ets, boresights, min_distances, detections, illumination, corrections)
         except Exception as e:
-            #self._failed_timestamps.append((self.current_simulation_timestamp, self.current_simulation_step))
+            #self._failed_timestamps.append((self.current_simulation_timestamp_et, self.current_simulation_step))
             self._failed_timestamps_cnt += 1
-            raise HandledExpeption(e)
+            raise HandledExpeption(e) from e
+
+
+    def _next_batch_ets(self, batch_size: int, max_et: float) -> np.ndarray:
+        """
+        Epochs of the next dense block, sampled at TIME_STEP cadence
+
+        The block is long enough to traverse the whole rough treshold neighbourhood (up to batch_size epochs)
+        """
+        block_size = min(batch_size, int(np.ceil(2 * self.rough_treshold / (LRO_SPEED * TIME_STEP))))
+        ets = self.current_simulation_timestamp_et + np.arange(block_size) * TIME_STEP
+        # Blocks end with coverage of dynamic kernels, the next step jumps over the gap
+        if (covered_stop := self.sweep_iterator.coverage.interval_stop(self.current_simulation_timestamp_et)) is not None:
+            max_et = min(max_et, covered_stop)
+        return ets[ets <= max_et]
+
+    def simulation_batch_inference(self, ets: np.ndarray) -> int:
+        """
+        Batched counterpart of simulation_step_inference
+
+        Projects all epochs in `ets`, moves the simulation clock to the last one of them and adjusts the timestep
+        according to its distance from the closest point of interest. Epochs with detected points of interest are
+        recorded into the hit buffer, returns their number
+        """
+        # Make sure kernels covering the end of the block are furnished as well
+        self._refresh_kernels(ets[-1])
+        try:
+            boresights, found, min_distances = self.compute_views_instrument_boresight_batch(ets)
+        except Exception as e:
+            self._failed_timestamps_cnt += len(ets)
+            raise HandledExpeption(e) from e
+        finally:
+            self.current_simulation_timestamp_et = float(ets[-1])
+            self.current_simulation_step += len(ets) - 1
+        return self.record_batch_inference(ets, boresights, found, min_distances)
+
+    def record_batch_inference(
+        self,
+        ets: np.ndarray,
+        boresights: np.ndarray,
+        found: np.ndarray,
+        min_distances: np.ndarray,
+        positions: Optional[np.ndarray] = None,
+    ) -> int:
+        """
+        Processes projections of epochs in `ets` (see compute_views_instrument_boresight_batch) ending at current epoch -
+        feeds overflight windows, adjusts the timestep and records epochs with detected points of interest (see _record_hits)
+        """
+        self._failed_timestamps_cnt += int((~found).sum())
+        if not found.any():
+            raise HandledExpeption("No surface intercept found in the whole block")
+        detections = self._detection_distances(ets, boresights, min_distances, positions)
+        corrections = self._refine_hits(ets, boresights, min_distances, detections, "NONE", positions)
+        illumination = self._gate_detections(ets, boresights, detections)
+        for i in np.flatnonzero(found):
+            self.window_finder.update(float(ets[i]), detections[i])
+
+        if found[-1]:
+            self.adjust_timestep(min_distances[-1], boresights[-1])
+        else:
+            # Distance at the end of the block is unknown, keep sampling densely
+            self.step_controller.reset()
+            self.computation_timestep = TIME_STEP
+
+        return self._record_hits(ets, boresights, min_distances, detections, illumination, corrections)
+
+    def _refine_hits(
+        self,
+        ets: np.ndarray,
+        boresights: np.ndarray,
+        min_distances: np.ndarray,
+        detections: List[Dict[int, float]],
+        aberration_correction: str,
+        positions: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        Evaluates epochs with detections computed with `aberration_correction` again with aberration_correction of
+        the instrument (see refined_aberration_correction). Boresights, distances and detections are replaced in place.
+        Returns the correction of each epoch, epochs whose corrected boresight misses the surface keep the original one
+        """
+        if self.geometry_cache is not None:
+            aberration_correction = "NONE"
+        corrections = np.full(len(ets), aberration_correction, dtype=HIT_DTYPE["aberration_correction"])
+        hits = np.flatnonzero([bool(detected) for detected in detections])
+        if aberration_correction == self.aberration_correction or not len(hits):
+            return corrections
+
+        corrected = {i: boresight for i in hits if (boresight := self.project_boresight(float(ets[i]), self.aberration_correction)) is not None}
+        if not corrected:
+            return corrections
+        refined = np.fromiter(corrected, dtype=int, count=len(corrected))
+        boresights[refined] = np.stack(list(corrected.values()))
+        min_distances[refined] = self._closest_target_distances(boresights[refined])
+        refined_detections = self._detection_distances(
+            np.asarray(ets)[refined], boresights[refined], min_distances[refined], None if positions is None else positions[refined], self.aberration_correction
+        )
+        for i, detected in zip(refined, refined_detections):
+            detections[i] = detected
+        corrections[refined] = self.aberration_correction
+        self.metrics.count("corrected_hits", len(refined))
+        return corrections
+
+    def _record_hits(
+        self,
+        ets: np.ndarray,
+        boresights: np.ndarray,
+        min_distances: np.ndarray,
+        detections: List[Dict[int, float]],
+        illumination: Tuple[np.ndarray, np.ndarray, np.ndarray],
+        aberration_corrections: np.ndarray,
+    ) -> int:
+        """
+        Appends epochs with detected points of interest into the hit buffer (only without overflight windows, which
+        replace the hits), returns their number
+        """
+        hits = np.flatnonzero([bool(detected) for detected in detections])
+        self._found_timestamps_cnt += len(hits)
+        if self.overflight_windows or not len(hits):
+            return len(hits)
+        with self.metrics.stage("results"):
+            closest = [min(detections[i].items(), key=lambda detection: detection[1]) for i in hits]
+            incidences, local_times, gates = illumination
+            self.hits.extend(
+                np.asarray(ets)[hits],
+                min_distances[hits],
+                [distance for _, distance in closest],
+                [target_id for target_id, _ in closest],
+                boresights[hits],
+                incidences[hits],
+                local_times[hits],
+                gates[hits],
+                aberration_corrections[hits],
+            )
+        return len(hits)
+
+    def _hit_documents(self) -> List[Dict]:
+        """Documents of buffered hits with UTC timestamps converted at once, the buffer is emptied"""
+        with self.metrics.stage("time_conversion"):
+            documents = self.hits.to_documents(self.name, self._target_names, ets_to_datetimes(self.hits.hits["et"]))
+        self.hits.clear()
+        return documents
+
+    def _gate_detections(
+        self, ets: np.ndarray, boresights: np.ndarray, detections: List[Dict[int, float]]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Evaluates illumination_gate at boresights of epochs with detections, returns solar incidences, local solar
+        times and gate results (1 passed, 0 failed, -1 not evaluated, without detections or gate) of each epoch.
+        Detections outside the gate are cleared when the gate drops them. With overflight windows, nothing is
+        evaluated - the finder needs all detections to find geometric entries and exits, whole windows are gated
+        (see _overflight_documents)
+        """
+        incidences, local_times = np.full(len(ets), np.nan), np.full(len(ets), np.nan)
+        gates = np.full(len(ets), -1, dtype=np.int8)
+        hits = np.flatnonzero([bool(detected) for detected in detections])
+        if self.illumination_gate is None or self.overflight_windows or not len(hits):
+            return incidences, local_times, gates
+        with self.metrics.stage("illumination"):
+            passed, incidences[hits], local_times[hits] = self.illumination_gate.evaluate(np.asarray(ets)[hits], boresights[hits])
+        gates[hits] = passed
+        if self.illumination_gate.drop:
+            for i in hits[~passed]:
+                detections[i] = {}
+        self._illumination_gated_cnt += int((~passed).sum())
+        return incidences, local_times, gates
+
+    def _overflight_documents(self, windows: List[Dict]) -> List[Dict]:
+        """
+        Completes overflight windows from the finder into documents of the simulation collection. Whole windows are
+        gated by illumination_gate at their closest approach
+        """
+        if self.illumination_gate is not None and windows:
+            with self.metrics.stage("illumination"):
+                passed, incidences, local_times = self.illumination_gate.evaluate(
+                    [window["et"] for window in windows], self._target_points[[window["target_id"] for window in windows]]
+                )
+            for window, gate, incidence, local_time in zip(windows, passed, incidences, local_times):
+                window["meta"].update(incidence=float(incidence), local_time=float(local_time), illumination_gate=bool(gate))
+            self._illumination_gated_cnt += int((~np.asarray(passed, dtype=bool)).sum())
+            if self.illumination_gate.drop:
+                windows = [window for window, gate in zip(windows, passed) if gate]
+        with self.metrics.stage("results"):
+            for window in windows:
+                window["instrument"] = self.name
+                window["pit"] = str(self._target_names[target_id := window.pop("target_id")])
+                window["min_distance"] = float(window["min_distance"])
+                window["meta"]["footprint"] = self.footprint_hits
+                window["meta"]["detection_treshold"] = float(self._detection_tresholds[target_id])
+                window["aberration_correction"] = self.aberration_correction
+        return windows
+
+    def log_metrics(self):
+        """Logs a JSON line snapshot of stage timers and counters of the sweep (see SweepMetrics)"""
+        self.metrics.log(
+            et=self.current_simulation_timestamp_et,
+            step=self.current_simulation_step,
+            timestep=self.computation_timestep,
+            found=self._found_timestamps_cnt,
+            failed=self._failed_timestamps_cnt,
+            dsk_calls=self._dsk_calls_cnt,
+            dsk_calls_avoided=self._dsk_calls_avoided_cnt,
+            rejected_steps=self.step_controller.rejected_steps_cnt,
+            skipped_intervals=len(self.step_controller.skip_intervals),
+            window_refinement_evaluations=self.window_finder.refinement_evaluations_cnt,
+            illumination_gated=self._illumination_gated_cnt,
+            kernels=self.sweep_iterator.kernel_stats(),
+        )
+
+    def sweep(
+        self,
+        max_steps: Optional[int] = None,
+        batch_size: Optional[int] = SIMULATION_BATCH_SIZE,
+        start_et: Optional[float] = None,
+        stop_et: Optional[float] = None,
+        show_progress: bool = True,
+        close_windows: bool = False,
+    ) -> Iterator[List[Dict]]:
+        """
+        Sweep through the time interval and yield batches of epochs with points of interest in the field of view
 
+        The interval defaults to the current simulation time and the end of loaded kernels. With batch_size set,
+        epochs near points of interest (where the adaptive timestep is TIME_STEP) are projected in dense blocks
+        (see simulation_batch_inference). Far from them, the sweep keeps jumping one epoch at a time
+
+        With overflight_windows set, one document per overflight of a pit is yielded instead, with `et_enter`,
+        `et_exit` and `et` (the closest approach) refined by OverflightWindowFinder
+
+        Batches are yielded at least every SIMULATION_CHECKPOINT_INTERVAL seconds (possibly empty) and never while an
+        overflight window is open, so the state of the instrument at each yield can be checkpointed (see run_simulation)
+
+        With `close_windows`, overflight windows still open at `stop_et` are swept past it until they close instead
+        of being cut at the stop, e.g. by shards of parallel sweeps (see sweep_shard)
+        """
+        if start_et is not None:
+            self.computation_timestep = TIME_STEP
+            self._set_time(start_et)
+        stop_et = self.max_time if stop_et is None else stop_et
 
-    def run_simulation(self, max_steps: Optional[int] = None, collection_slug: Optional[str] = None):
         # Prepare misc
-        total_seconds = (self.max_time - self.min_time).to_value("sec")
+        total_seconds = stop_et - self.current_simulation_timestamp_et
         pbar_format_string = ("" if max_steps is None else f"/{max_steps}")
 
-        # Here we store our points of interest to dump them into DB, eventually
+        # Here we store our points of interest to dump them into DB, eventually (hits are buffered in self.hits)
         points_of_interest_batch = []
+        last_flush_time = time.monotonic()
+        et_keys = {"et": "timestamp_utc"}
+        if self.overflight_windows:
+            et_keys.update(et_enter="timestamp_utc_enter", et_exit="timestamp_utc_exit")
 
-
-        simulation_collection = Sessions._prepare_simulation_collection(collection_slug)
         # Run the main simulation loop
-        with tqdm(total=total_seconds, ncols=TQDM_NCOLS, desc="Running simulation") as pbar:
+        with tqdm(total=total_seconds, ncols=TQDM_NCOLS, desc="Running simulation", disable=not show_progress) as pbar:
 
-            while self.current_simulation_timestamp <= self.max_time:
+            while self.current_simulation_timestamp_et <= stop_et or (
+                close_windows and self.window_finder.open_windows and self.current_simulation_timestamp_et <= self.max_time
+            ):
             
                 # TQDM instrumentation
-                pbar.update(self.computation_timedelta.to_value("sec"))
+                last_et = self.current_simulation_timestamp_et
                 if self.current_simulation_step % 256 == 0:
                     step_info = f"Simulation step:{self.current_simulation_step}"
                     failed_found_info = f"; failed: {self._failed_timestamps_cnt}; found: {self._found_timestamps_cnt}"
+                    if self.tiered_intercepts:
+                        failed_found_info += f"; DSK calls: {self._dsk_calls_cnt}; avoided: {self._dsk_calls_avoided_cnt}"
+                    if self.state_aware_timestep:
+                        failed_found_info += f"; rejected steps: {self.step_controller.rejected_steps_cnt}"
                     pbar.set_description(step_info + pbar_format_string + failed_found_info)
 
                 # Check if we reached the maximum number of steps
@@ -334,19 +1032,91 @@ class Instrument(ABC):
                 
                 try:
                     self._step_time()
-                    if (simulation_step_output := self.simulation_step_inference()) is not None:
-                        points_of_interest_batch.append(simulation_step_output)
+                    if batch_size is None or self.computation_timestep > TIME_STEP:
+                        self.simulation_step_inference()
+                    elif len(ets := self._next_batch_ets(batch_size, stop_et if self.current_simulation_timestamp_et <= stop_et else self.max_time)):
+                        self.simulation_batch_inference(ets)
                 except HandledExpeption as e:
-                    pass
+                    self.metrics.count_exception("failed", e)
                 except Exception as e:
                     self._failed_timestamps_cnt += 1
-
-                if len(points_of_interest_batch) > 1000:
-                    Sessions.insert_simulation_results(points_of_interest_batch, collection=simulation_collection)
+                    self.metrics.count_exception("failed", e)
+                pbar.update(self.current_simulation_timestamp_et - last_et)
+
+                if self.overflight_windows:
+                    # Windows replace the points, they are closed with the first epoch outside the treshold
+                    points_of_interest_batch.extend(self._overflight_documents(self.window_finder.pop_closed()))
+
+                flush = len(points_of_interest_batch) + len(self.hits) > SIMULATION_FLUSH_SIZE or time.monotonic() - last_flush_time > SIMULATION_CHECKPOINT_INTERVAL
+                if flush and not (self.overflight_windows and self.window_finder.open_windows):
+                    with self.metrics.stage("time_conversion"):
+                        attach_utc_timestamps(points_of_interest_batch, et_keys)
+                    yield points_of_interest_batch + self._hit_documents()
                     points_of_interest_batch = []
+                    last_flush_time = time.monotonic()
 
-            # Add the last batch of points
-            Sessions.insert_simulation_results(points_of_interest_batch, collection=simulation_collection)
+                if self.metrics.due():
+                    self.log_metrics()
 
-        return
+            if self.overflight_windows:
+                self.window_finder.finalize()
+                points_of_interest_batch.extend(self._overflight_documents(self.window_finder.pop_closed()))
+            # Add the last batch of points
+            if points_of_interest_batch or len(self.hits):
+                with self.metrics.stage("time_conversion"):
+                    attach_utc_timestamps(points_of_interest_batch, et_keys)
+                yield points_of_interest_batch + self._hit_documents()
+            self.log_metrics()
+
+    def run_simulation(
+        self,
+        max_steps: Optional[int] = None,
+        collection_slug: Optional[str] = None,
+        batch_size: Optional[int] = SIMULATION_BATCH_SIZE,
+        resume: bool = False,
+    ):
+        """
+        Sweep through the loaded time interval and store epochs with points of interest in the field of view
 
+        Batches are inserted by BackgroundWriter, each followed by a checkpoint, documents carry the `batch_id` they
+        were inserted with. Pending writes are flushed when the sweep ends, fails or is terminated.
+        With `resume`, the sweep continues right after the last checkpointed epoch of the same run (instrument,
+        collection slug and kernel fingerprint), and documents of batches the run inserted after it are discarded
+        first. Documents carry `run_fingerprint`, so results of other runs in the collection are never discarded
+        """
+        if SWEEP_METRICS_PROMETHEUS_PORT is not None:
+            start_prometheus_exporter(SWEEP_METRICS_PROMETHEUS_PORT)
+        simulation_collection = Sessions._prepare_simulation_collection(collection_slug)
+        run_key = {"instrument": self.name, "collection_slug": collection_slug, "fingerprint": self.run_fingerprint}
+
+        last_batch_id = -1
+        if resume:
+            if (checkpoint := Sessions.get_sweep_checkpoint(run_key)) is not None:
+                if checkpoint["finished"]:
+                    logger.info("Sweep of %s into %s already finished", self.name, collection_slug)
+                    return
+                last_batch_id = checkpoint["last_batch_id"]
+                self.restore_checkpoint(checkpoint)
+                logger.info("Resuming sweep at %s after batch %d", spice.et2utc(checkpoint["et"], "ISOC", 3), last_batch_id)
+                Sessions.discard_simulation_results(simulation_collection, run_key, last_batch_id)
+            else:
+                logger.info("No checkpoint of %s into %s found, starting the sweep from the beginning", self.name, collection_slug)
+
+        # Inserts and checkpoints are written in order by the background writer, the sweep waits only when it falls behind
+        with BackgroundWriter() as writer:
+            for points_of_interest_batch in self.sweep(max_steps=max_steps, batch_size=batch_size):
+                last_batch_id += 1
+                for point in points_of_interest_batch:
+                    point["batch_id"] = last_batch_id
+                    point["run_fingerprint"] = run_key["fingerprint"]
+                checkpoint = {**self.checkpoint_state(), "last_batch_id": last_batch_id, "finished": False}
+                with self.metrics.stage("writer_backpressure"):
+                    # Batches yielded only to be checkpointed are usually empty
+                    if points_of_interest_batch:
+                        writer.submit(
+                            Sessions.insert_simulation_results, points_of_interest_batch, simulation_collection, timer=self.metrics.stage("mongo_insert")
+                        )
+                    writer.submit(Sessions.save_sweep_checkpoint, run_key, checkpoint, timer=self.metrics.stage("checkpoint"))
+            writer.submit(
+                Sessions.save_sweep_checkpoint, run_key, {**self.checkpoint_state(), "last_batch_id": last_batch_id, "finished": max_steps is None}
+            )
@@ -9,6 +9,7 @@ from src.SPICE.config import (
     QUERY_RADIUS_MULTIPLIER,
 )
 from src.SPICE.instruments.base_instrument import Instrument
+from src.SPICE.sweep_iterator import SweepIterator
 
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -18,6 +19,7 @@ logger = logging.getLogger(__name__)
 
 class DIVINERInstrument(Instrument):
     name = "DIVINER"
+    sweep_iterator_class = SweepIterator
     instrument_ids = DIVINER_INSTRUMENT_IDS
     # Frame of the instrument
     frame = LRO_DIVINER_FRAME_STR_ID
@@ -0,0 +1,96 @@
+"""
+Coverage of dynamic kernels - time intervals in which all of them provide data, so the sweep can jump over gaps
+"""
+import bisect
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+def merge_intervals(intervals: np.ndarray) -> np.ndarray:
+    """Union of (K, 2) intervals as sorted disjoint intervals, touching ones are merged"""
+    intervals = np.asarray(intervals, dtype=float).reshape(-1, 2)
+    if not len(intervals):
+        return intervals
+    intervals = intervals[np.argsort(intervals[:, 0])]
+    merged = [list(intervals[0])]
+    for start, stop in intervals[1:]:
+        if start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return np.array(merged)
+
+
+def intersect_intervals(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Intersection of two sets of sorted disjoint (K, 2) intervals"""
+    intersection = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        start, stop = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+        if start <= stop:
+            intersection.append([start, stop])
+        # The interval ending first can't intersect anything else
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return np.array(intersection, dtype=float).reshape(-1, 2)
+
+
+class CoverageMap:
+    """
+    Sorted disjoint intervals (ephemeris time) covered by all dynamic kernels
+
+    Lookups bisect the interval starts, so an epoch anywhere in a multi-day gap is resolved in microseconds
+    """
+
+    def __init__(self, intervals: np.ndarray):
+        self.intervals = merge_intervals(intervals)
+        self._starts = self.intervals[:, 0].tolist()
+        self._stops = self.intervals[:, 1].tolist()
+
+    @classmethod
+    def intersection(cls, coverages: List[np.ndarray]) -> "CoverageMap":
+        """Intervals covered by each of `coverages` (sorted disjoint intervals, e.g. of one kernel loader)"""
+        intervals = merge_intervals(coverages[0])
+        for coverage in coverages[1:]:
+            intervals = intersect_intervals(intervals, merge_intervals(coverage))
+        return cls(intervals)
+
+    @property
+    def start(self) -> Optional[float]:
+        return self._starts[0] if self._starts else None
+
+    @property
+    def stop(self) -> Optional[float]:
+        return self._stops[-1] if self._stops else None
+
+    def _interval_index(self, et: float) -> int:
+        """Index of the last interval starting at or before `et`, -1 if none"""
+        return bisect.bisect_right(self._starts, et) - 1
+
+    def covered(self, et: float) -> bool:
+        return (i := self._interval_index(et)) >= 0 and et <= self._stops[i]
+
+    def next_covered(self, et: float) -> Optional[float]:
+        """`et` if it's covered, otherwise the start of the next covered interval, None past the last one"""
+        i = self._interval_index(et)
+        if i >= 0 and et <= self._stops[i]:
+            return et
+        return self._starts[i + 1] if i + 1 < len(self._starts) else None
+
+    def interval_stop(self, et: float) -> Optional[float]:
+        """End of the interval covering `et`, None if it's not covered"""
+        i = self._interval_index(et)
+        return self._stops[i] if i >= 0 and et <= self._stops[i] else None
+
+    def gaps(self, start_et: Optional[float] = None, stop_et: Optional[float] = None) -> List[Tuple[float, float]]:
+        """Uncovered intervals between covered ones, clipped to (start_et, stop_et)"""
+        gaps = []
+        for gap_start, gap_stop in zip(self._stops[:-1], self._starts[1:]):
+            gap_start = gap_start if start_et is None else max(gap_start, start_et)
+            gap_stop = gap_stop if stop_et is None else min(gap_stop, stop_et)
+            if gap_start < gap_stop:
+                gaps.append((gap_start, gap_stop))
+        return gaps
@@ -1,32 +1,88 @@
 import os
+import queue
+import bisect
 import logging
+import threading
 import spiceypy as spice
-import re
-from astropy.time import Time
-from typing import Optional, List, NamedTuple
+from time import perf_counter
+from typing import Optional, List, NamedTuple, Dict
+import numpy as np
 from tqdm import tqdm
 import sys
 
 sys.path.insert(0, "/".join(__file__.split("/")[:-3]))
-from src.SPICE.config import DESTINATION, MAX_LOADED_SPICE
+from src.SPICE.config import (
+    DESTINATION,
+    MAX_LOADED_SPICE,
+    COVERAGE_WINDOW_SIZE,
+    KERNEL_PREFETCH_DEPTH,
+    KERNEL_PREFETCH_CHUNK_SIZE,
+)
 from src.global_config import TQDM_NCOLS
+from src.SPICE.kernels.kernel_index import KernelIndex, parse_label
 
 logger = logging.getLogger(__name__)
 
 
 class SPICEFile(NamedTuple):
     filename: str
-    time_start: Time
-    time_stop: Time
+    # Coverage of the kernel in ephemeris time (TDB seconds past J2000)
+    time_start: float
+    time_stop: float
+
+
+class KernelPrefetcher:
+    """
+    Reads kernels in a background thread, so they're in the page cache by the time they're furnished
+
+    SPICE is not thread-safe, the thread only reads the files. Kernels are read at most once, `warmed` tells whether
+    reading a kernel has finished
+    """
+
+    def __init__(self, name: str, chunk_size: int = KERNEL_PREFETCH_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+        self._queue: queue.Queue = queue.Queue()
+        self._requested = set()
+        self._warmed = set()
+        self._thread = threading.Thread(target=self._run, name=f"kernel-prefetch-{name}", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        buffer = bytearray(self.chunk_size)
+        while True:
+            filename = self._queue.get()
+            try:
+                with open(filename, "rb", buffering=0) as f:
+                    if hasattr(os, "posix_fadvise"):
+                        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                    while n := f.readinto(buffer):
+                        self.bytes_read += n
+                self._warmed.add(filename)
+            except OSError as e:
+                logger.warning("Prefetching %s failed: %s", filename, e)
+
+    def prefetch(self, filename: str):
+        if filename not in self._requested:
+            self._requested.add(filename)
+            self._queue.put(filename)
+
+    def warmed(self, filename: str) -> bool:
+        return filename in self._warmed
 
 
 class DynamicKernelLoader:
+    # Number of kernels following the loaded one which are prefetched, 0 disables the prefetch thread
+    prefetch_depth = KERNEL_PREFETCH_DEPTH
+    # Coverage of kernels is read from the persistent index of labels (see KernelIndex) instead of parsing all of them
+    use_kernel_index = True
+
     @property
-    def min_loaded_time(self) -> Time:
+    def min_loaded_time(self) -> float:
         return self.kernel_pool[0].time_start
 
     @property
-    def max_loaded_time(self) -> Time:
+    def max_loaded_time(self) -> float:
         return self.kernel_pool[-1].time_stop
 
     def __init__(
@@ -37,69 +93,129 @@ class DynamicKernelLoader:
         filename_key: str = "^SPICE_KERNEL",
         time_start_key: str = "START_TIME",
         time_stop_key: str = "STOP_TIME",
+        destination: str = DESTINATION,
     ) -> None:
         self.name = kernels_id
+        self.destination = destination
+        self.resource = resource
         self.loaded_kernels: List[SPICEFile] = []
         self.active_kernel_id = -1
         self.kernel_pool = self.load_SPICE_metadata(resource, startswith, filename_key, time_start_key, time_stop_key)
         # self.remove_redundant_kernels()
+        # Interval index of the pool, kernels may overlap, so stops are kept as a running maximum as well
+        self._starts = [kernel.time_start for kernel in self.kernel_pool]
+        self._stops = [kernel.time_stop for kernel in self.kernel_pool]
+        self._max_stops = np.maximum.accumulate(self._stops).tolist() if self.kernel_pool else []
+        self.prefetcher = KernelPrefetcher(kernels_id.replace("/", "-")) if self.prefetch_depth > 0 else None
+        self.loads_cnt = 0
+        self.unloads_cnt = 0
+        self.prefetch_hits_cnt = 0
+        # Wall time the sweep spent in furnsh and unload
+        self.stall_seconds = 0.0
 
-    def refresh_SPICE_for_given_time(self, time: Time) -> bool:
+    def kernel_index(self, time: float) -> int:
+        """Index of the latest starting kernel of the pool covering given ephemeris time, -1 if there's none"""
+        i = bisect.bisect_right(self._starts, time) - 1
+        # Earlier kernels can only cover the time while the running maximum of their stops reaches it
+        while i >= 0 and self._max_stops[i] >= time:
+            if self._stops[i] >= time:
+                return i
+            i -= 1
+        return -1
+
+    def refresh_SPICE_for_given_time(self, time: float) -> bool:
+        """Make sure kernel covering given ephemeris time is furnished"""
         if self.loaded_kernels and self.loaded_kernels[-1].time_start <= time <= self.loaded_kernels[-1].time_stop:
             return True
-        kernel_to_load: Optional[SPICEFile] = None
         if (
-            self.kernel_pool[self.active_kernel_id + 1].time_start
-            <= time
-            <= self.kernel_pool[self.active_kernel_id + 1].time_stop
+            self.active_kernel_id + 1 < len(self.kernel_pool)
+            and self._starts[self.active_kernel_id + 1] <= time <= self._stops[self.active_kernel_id + 1]
         ):
             self.active_kernel_id += 1
-            kernel_to_load = self.kernel_pool[self.active_kernel_id]
-        else:
-            for i, kernel in enumerate(self.kernel_pool):
-                if kernel.time_start <= time <= kernel.time_stop:
-                    self.active_kernel_id = i
-                    kernel_to_load = kernel
-                    break
-        if kernel_to_load:
-            spice.furnsh(kernel_to_load.filename)
-            self.loaded_kernels.append(kernel_to_load)
-            if len(self.loaded_kernels) > MAX_LOADED_SPICE:
-                spice.unload(self.loaded_kernels[0].filename)
-                self.loaded_kernels.pop(0)
-            return True
+        elif (kernel_id := self.kernel_index(time)) >= 0:
+            self.active_kernel_id = kernel_id
         else:
             logger.debug("No SPICE available for %s at %s", self.name, time)
             return False
 
+        kernel_to_load = self.kernel_pool[self.active_kernel_id]
+        if self.prefetcher is not None and self.prefetcher.warmed(kernel_to_load.filename):
+            self.prefetch_hits_cnt += 1
+        started = perf_counter()
+        spice.furnsh(kernel_to_load.filename)
+        self.loaded_kernels.append(kernel_to_load)
+        self.loads_cnt += 1
+        if len(self.loaded_kernels) > MAX_LOADED_SPICE:
+            spice.unload(self.loaded_kernels[0].filename)
+            self.loaded_kernels.pop(0)
+            self.unloads_cnt += 1
+        self.stall_seconds += perf_counter() - started
+
+        if self.prefetcher is not None:
+            for kernel in self.kernel_pool[self.active_kernel_id + 1 : self.active_kernel_id + 1 + self.prefetch_depth]:
+                self.prefetcher.prefetch(kernel.filename)
+        return True
+
+    @property
+    def stats(self) -> Dict:
+        """Kernel loads, unloads, loads of prefetched kernels and wall time (s) the sweep waited for them"""
+        return {
+            "loads": self.loads_cnt,
+            "unloads": self.unloads_cnt,
+            "prefetch_hits": self.prefetch_hits_cnt,
+            "prefetched_bytes": self.prefetcher.bytes_read if self.prefetcher is not None else 0,
+            "stall_seconds": self.stall_seconds,
+        }
+
+    def coverage(self, from_kernels: bool = False) -> np.ndarray:
+        """
+        Intervals (K, 2) of ephemeris time covered by the kernel pool, from the labels. With `from_kernels`, intervals
+        are read from the kernels (ckcov at the interpolation interval level, spkcov) instead, which finds gaps within
+        them as well, but it reads every kernel. Coverage of a kernel is the union of coverages of all objects within
+        """
+        if not from_kernels:
+            return np.array([[kernel.time_start, kernel.time_stop] for kernel in self.kernel_pool], dtype=float).reshape(-1, 2)
+
+        intervals = []
+        for kernel in tqdm(self.kernel_pool, desc=f"Reading coverage of {self.name}", ncols=TQDM_NCOLS):
+            if self.resource == "ck":
+                objects = spice.ckobj(kernel.filename, spice.cell_int(COVERAGE_WINDOW_SIZE))
+                covers = [
+                    spice.ckcov(kernel.filename, idcode, False, "INTERVAL", 0.0, "TDB", spice.cell_double(COVERAGE_WINDOW_SIZE))
+                    for idcode in objects
+                ]
+            else:
+                objects = spice.spkobj(kernel.filename, spice.cell_int(COVERAGE_WINDOW_SIZE))
+                covers = [spice.spkcov(kernel.filename, idcode, spice.cell_double(COVERAGE_WINDOW_SIZE)) for idcode in objects]
+            intervals += [spice.wnfetd(cover, i) for cover in covers for i in range(spice.wncard(cover))]
+        return np.array(intervals, dtype=float).reshape(-1, 2)
+
     def load_SPICE_metadata(
         self, resource: str, startswith: Optional[str], filename_key: str, time_start_key: str, time_stop_key: str
     ) -> List[SPICEFile]:
-        folder_name = os.path.join(DESTINATION, resource)
+        """Parse coverage windows from .lbl files, leap seconds kernel has to be furnished already"""
+        if self.use_kernel_index:
+            kernel_index = KernelIndex(self.destination)
+            try:
+                labels = kernel_index.labels(resource, startswith, filename_key, time_start_key, time_stop_key)
+            finally:
+                kernel_index.close()
+            return [SPICEFile(*label) for label in labels]
+
+        folder_name = os.path.join(self.destination, resource)
         files = [
             f
             for f in os.listdir(folder_name)
             if f.endswith(".lbl") and (startswith is None or f.startswith(startswith))
         ]
         spice_series: List[SPICEFile] = []
-        pattern = re.compile(r"(\S+)\s*=\s*(.+)")
         for file in tqdm(files, desc=f"Processing {resource}", ncols=TQDM_NCOLS):
             try:
-                with open(os.path.join(folder_name, file), "r") as f:
-                    content = f.read()
-                metadata = {m.group(1): m.group(2).strip('"') for m in pattern.finditer(content)}
-                if not all(key in metadata for key in [filename_key, time_start_key, time_stop_key]):
+                if (parsed := parse_label(os.path.join(folder_name, file), filename_key, time_start_key, time_stop_key)) is None:
                     logger.warning("Skipping %s, insufficient data", file)
                     continue
-                spice_series.append(
-                    SPICEFile(
-                        filename=os.path.join(DESTINATION, resource, metadata[filename_key]),
-                        time_start=Time(metadata[time_start_key], format="isot", scale="utc"),
-                        time_stop=Time(metadata[time_stop_key], format="isot", scale="utc"),
-                    )
-                )
+                kernel, time_start, time_stop = parsed
+                spice_series.append(SPICEFile(os.path.join(folder_name, kernel), time_start, time_stop))
             except Exception as e:
                 logger.error("Skipping %s, error parsing metadata: %s", file, e)
         return sorted(spice_series, key=lambda x: x.time_start)
-
-
@@ -0,0 +1,172 @@
+"""
+Persistent index of kernel metadata, so SweepIterator doesn't parse every .lbl file on each startup
+
+The index is a SQLite database in the root of the kernel archive. Each row of `labels` holds a label (with its size
+and mtime), the kernel it describes, coverage of the kernel in ephemeris time and size and mtime of the kernel. Labels
+are parsed again only when they're new or changed, rows of removed labels are deleted. Rows of `coverages` hold
+coverage of binary SPK and PCK kernels by object, read from the kernels themselves (see KernelPlanner).
+"""
+import os
+import re
+import sys
+import json
+import sqlite3
+import logging
+from typing import Dict, Optional, List, Tuple
+
+sys.path.insert(0, "/".join(__file__.split("/")[:-4]))
+
+import spiceypy as spice
+from tqdm import tqdm
+
+from src.global_config import TQDM_NCOLS
+from src.SPICE.config import KERNEL_INDEX_FILENAME, COVERAGE_WINDOW_SIZE
+
+logger = logging.getLogger(__name__)
+
+LABEL_PATTERN = re.compile(r"(\S+)\s*=\s*(.+)")
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS coverages (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    coverage TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS labels (
+    resource TEXT NOT NULL,
+    label TEXT NOT NULL,
+    label_size INTEGER NOT NULL,
+    label_mtime_ns INTEGER NOT NULL,
+    keys TEXT NOT NULL,
+    kernel TEXT,
+    time_start REAL,
+    time_stop REAL,
+    kernel_size INTEGER,
+    kernel_mtime_ns INTEGER,
+    PRIMARY KEY (resource, label)
+);
+"""
+
+
+def parse_label(path: str, filename_key: str, time_start_key: str, time_stop_key: str) -> Optional[Tuple[str, float, float]]:
+    """Kernel filename and its coverage in ET from a .lbl file, None if some of the keys are missing"""
+    with open(path, "r") as f:
+        content = f.read()
+    metadata = {m.group(1): m.group(2).strip('"') for m in LABEL_PATTERN.finditer(content)}
+    if not all(key in metadata for key in [filename_key, time_start_key, time_stop_key]):
+        return None
+    return metadata[filename_key], spice.str2et(metadata[time_start_key]), spice.str2et(metadata[time_stop_key])
+
+
+def read_kernel_coverage(path: str) -> Dict[int, List[List[float]]]:
+    """
+    Coverage intervals (ET) of each body of a binary SPK (spkcov) or each frame of a binary PCK (pckcov), empty for
+    other kernels
+    """
+    if path.endswith(".bsp"):
+        objects = spice.spkobj(path, spice.cell_int(COVERAGE_WINDOW_SIZE))
+        covers = {idcode: spice.spkcov(path, idcode, spice.cell_double(COVERAGE_WINDOW_SIZE)) for idcode in objects}
+    elif path.endswith(".bpc"):
+        objects = spice.pckfrm(path, spice.cell_int(COVERAGE_WINDOW_SIZE))
+        covers = {idcode: spice.pckcov(path, idcode, spice.cell_double(COVERAGE_WINDOW_SIZE)) for idcode in objects}
+    else:
+        return {}
+    return {int(idcode): [list(spice.wnfetd(cover, i)) for i in range(spice.wncard(cover))] for idcode, cover in covers.items()}
+
+
+class KernelIndex:
+    """
+    Coverage of kernels read from their labels or from binary SPK/PCK kernels, cached in
+    `destination`/KERNEL_INDEX_FILENAME
+
+    When the archive isn't writable, the index is kept in memory only. Concurrent startups (e.g. sweep shards) share
+    the database, SQLite serializes their updates
+    """
+
+    def __init__(self, destination: str, filename: str = KERNEL_INDEX_FILENAME):
+        self.destination = destination
+        self.path = os.path.join(destination, filename)
+        try:
+            self.connection = sqlite3.connect(self.path, timeout=60)
+            self.connection.executescript(SCHEMA)
+        except sqlite3.Error as e:
+            logger.warning("Kernel index %s unavailable (%s), labels are parsed without caching", self.path, e)
+            self.connection = sqlite3.connect(":memory:")
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def labels(
+        self, resource: str, startswith: Optional[str], filename_key: str, time_start_key: str, time_stop_key: str
+    ) -> List[Tuple[str, float, float]]:
+        """
+        Paths of kernels described by .lbl files in `resource` folder (starting with `startswith`) and their coverage
+        in ET, sorted by start. Leap seconds kernel has to be furnished already, if some labels need to be parsed
+        """
+        folder_name = os.path.join(self.destination, resource)
+        keys = f"{filename_key}:{time_start_key}:{time_stop_key}"
+        files = {
+            entry.name: entry.stat()
+            for entry in os.scandir(folder_name)
+            if entry.name.endswith(".lbl") and (startswith is None or entry.name.startswith(startswith))
+        }
+        cached = {
+            row[0]: row[1:]
+            for row in self.connection.execute(
+                "SELECT label, label_size, label_mtime_ns, keys FROM labels WHERE resource = ?", (resource,)
+            )
+        }
+
+        changed = [
+            file
+            for file, stat in files.items()
+            if cached.get(file) != (stat.st_size, stat.st_mtime_ns, keys)
+        ]
+        rows = []
+        for file in tqdm(changed, desc=f"Indexing {resource}", ncols=TQDM_NCOLS, disable=not changed):
+            stat = files[file]
+            kernel, time_start, time_stop, kernel_size, kernel_mtime_ns = None, None, None, None, None
+            try:
+                if (parsed := parse_label(os.path.join(folder_name, file), filename_key, time_start_key, time_stop_key)) is None:
+                    logger.warning("Skipping %s, insufficient data", file)
+                else:
+                    kernel, time_start, time_stop = parsed
+                    if os.path.exists(kernel_path := os.path.join(folder_name, kernel)):
+                        kernel_stat = os.stat(kernel_path)
+                        kernel_size, kernel_mtime_ns = kernel_stat.st_size, kernel_stat.st_mtime_ns
+            except Exception as e:
+                logger.error("Skipping %s, error parsing metadata: %s", file, e)
+            # Labels which can't be parsed are stored as well, so they're skipped until they change
+            rows.append((resource, file, stat.st_size, stat.st_mtime_ns, keys, kernel, time_start, time_stop, kernel_size, kernel_mtime_ns))
+
+        removed = [
+            (resource, file)
+            for file in cached
+            if file not in files and (startswith is None or file.startswith(startswith))
+        ]
+        if rows or removed:
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self.connection.executemany("DELETE FROM labels WHERE resource = ? AND label = ?", removed)
+            logger.info("Kernel index of %s updated, %d labels parsed, %d removed", resource, len(rows), len(removed))
+
+        labels = [
+            (os.path.join(folder_name, kernel), time_start, time_stop)
+            for label, kernel, time_start, time_stop in self.connection.execute(
+                "SELECT label, kernel, time_start, time_stop FROM labels WHERE resource = ? AND kernel IS NOT NULL", (resource,)
+            )
+            if label in files
+        ]
+        return sorted(labels, key=lambda x: x[1])
+
+    def kernel_coverage(self, path: str) -> Dict[int, List[List[float]]]:
+        """Coverage of a kernel by object (see read_kernel_coverage), read again only when the kernel changes"""
+        stat = os.stat(path)
+        row = self.connection.execute("SELECT size, mtime_ns, coverage FROM coverages WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            return {int(idcode): intervals for idcode, intervals in json.loads(row[2]).items()}
+        coverage = read_kernel_coverage(path)
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO coverages VALUES (?, ?, ?, ?)", (path, stat.st_size, stat.st_mtime_ns, json.dumps(coverage)))
+        return coverage
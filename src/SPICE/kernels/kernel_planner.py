@@ -0,0 +1,90 @@
+"""
+Plans which static kernels a sweep needs and furnishes them from a generated meta-kernel
+
+Text kernels (LSK, SCLK, FK, IK, text PCK) and DSKs are small or always needed, they're always planned. Binary SPK
+and PCK kernels are planned only when they cover the swept interval (for given bodies, if any), e.g. just one part
+of a planetary ephemeris split by centuries. Kernels of dynamic kernel loaders are left to the loaders.
+"""
+import os
+import sys
+import hashlib
+import logging
+from typing import Iterable, List, Optional
+
+sys.path.insert(0, "/".join(__file__.split("/")[:-4]))
+
+import spiceypy as spice
+
+from src.SPICE.config import META_KERNEL_DESTINATION, KERNEL_PLAN_MARGIN
+from src.SPICE.kernels.kernel_index import KernelIndex
+
+logger = logging.getLogger(__name__)
+
+# Kernels with coverage by object, planned only if they cover the swept interval
+COVERAGE_SUFFIXES = (".bsp", ".bpc")
+# Text kernel strings longer than this are continued on the next line ("+" at the end, see FURNSH)
+META_KERNEL_STRING_LENGTH = 72
+
+
+def meta_kernel_strings(path: str, length: int = META_KERNEL_STRING_LENGTH) -> List[str]:
+    """Quoted strings of a path in a meta-kernel, each one but the last ends with the continuation character"""
+    parts = [path[i : i + length] for i in range(0, len(path), length)] or [""]
+    return [f"'{part}+'" for part in parts[:-1]] + [f"'{parts[-1]}'"]
+
+
+class KernelPlanner:
+    """
+    Selects static kernels required between two epochs, coverage of binary kernels is cached in KernelIndex
+
+    `kernels` are in the order they would be furnished (later ones take precedence), the plan keeps the order
+    """
+
+    def __init__(self, destination: str, kernels: List[str], exclude: Iterable[str] = (), margin: float = KERNEL_PLAN_MARGIN):
+        self.destination = destination
+        excluded = {os.path.abspath(kernel) for kernel in exclude}
+        self.kernels = [kernel for kernel in kernels if os.path.abspath(kernel) not in excluded]
+        self.margin = margin
+
+    def required(self, kernel: str, kernel_index: KernelIndex, start_et: float, stop_et: float, bodies: Optional[Iterable[int]]) -> bool:
+        if not kernel.endswith(COVERAGE_SUFFIXES):
+            return True
+        try:
+            coverage = kernel_index.kernel_coverage(kernel)
+        except Exception as e:
+            logger.warning("Coverage of %s unknown, planning it anyway: %s", kernel, e)
+            return True
+        # Frames of binary PCKs are not bodies, they're never filtered out by `bodies`
+        objects = coverage if bodies is None or kernel.endswith(".bpc") else {idcode: coverage[idcode] for idcode in bodies if idcode in coverage}
+        return any(
+            interval_start <= stop_et + self.margin and start_et - self.margin <= interval_stop
+            for intervals in objects.values()
+            for interval_start, interval_stop in intervals
+        )
+
+    def plan(self, start_et: float, stop_et: float, bodies: Optional[Iterable[int]] = None) -> List[str]:
+        """Kernels required between `start_et` and `stop_et`, SPKs only if they contain some of `bodies` (NAIF IDs)"""
+        bodies = None if bodies is None else set(bodies)
+        kernel_index = KernelIndex(self.destination)
+        try:
+            plan = [kernel for kernel in self.kernels if self.required(kernel, kernel_index, start_et, stop_et, bodies)]
+        finally:
+            kernel_index.close()
+        skipped = len(self.kernels) - len(plan)
+        logger.info("Planned %d static kernels, %d not required between %s and %s", len(plan), skipped, spice.et2utc(start_et, "ISOC", 0), spice.et2utc(stop_et, "ISOC", 0))
+        return plan
+
+    @staticmethod
+    def write_meta_kernel(kernels: List[str], destination: str = META_KERNEL_DESTINATION, description: str = "") -> str:
+        """Writes a meta-kernel loading `kernels` into `destination`, named by hash of its content, returns its path"""
+        lines = ["KPL/MK", "", description, "", "\\begindata", "", "KERNELS_TO_LOAD = ("]
+        lines += [f"    {string}" for kernel in kernels for string in meta_kernel_strings(os.path.abspath(kernel))]
+        lines += [")", "", "\\begintext", ""]
+        content = "\n".join(lines)
+        os.makedirs(destination, exist_ok=True)
+        path = os.path.join(destination, hashlib.sha1(content.encode()).hexdigest()[:16] + ".tm")
+        if not os.path.exists(path):
+            # Written under a temporary name first, concurrent sweeps may write the same meta-kernel
+            with open(temporary_path := f"{path}.{os.getpid()}", "w") as f:
+                f.write(content)
+            os.replace(temporary_path, path)
+        return path
@@ -0,0 +1,276 @@
+"""
+Small synthetic SPICE kernels for offline benchmarks of the sweep
+
+Mirrors the layout of the kernel archive (see fetch.py), so SweepIterator loads them the same way as the real ones:
+a fake orbiter on a circular polar orbit (one SPK per day), nadir pointing CKs of its bus, FK/IK of a fake instrument
+with two rectangular sub-instruments and a spherical (optionally bumpy) DSK of the Moon.
+"""
+import os
+import sys
+import json
+import shutil
+import logging
+from typing import Dict
+
+sys.path.insert(0, "/".join(__file__.split("/")[:-4]))
+
+import numpy as np
+import spiceypy as spice
+
+from src.SPICE.config import LUNAR_RADIUS, MOON_REF_FRAME_STR_ID, DSK_FILE_CENTER_BODY_ID, DSK_FILESURFACE_ID, DCLASS
+
+logger = logging.getLogger(__name__)
+
+SYNTHETIC_SPACECRAFT = "SYNTHETIC ORBITER"
+SYNTHETIC_SPACECRAFT_ID = -999
+SYNTHETIC_BUS_FRAME = "SYNTHETIC_BUS"
+SYNTHETIC_INSTRUMENT_FRAME = "SYNTHETIC_INSTRUMENT"
+SYNTHETIC_INSTRUMENT_IDS = [-999101, -999102]
+SYNTHETIC_START_UTC = "2010-01-01T00:00:00"
+SYNTHETIC_DSK = os.path.join("dsk", "synthetic_moon.dsk")
+
+MANIFEST_FILENAME = "synthetic.json"
+# Folders and files of the destination kernels are written into, nothing else in it is touched when they are rewritten
+KERNEL_FOLDERS = ["lsk", "sclk", "fk", "ik", "pck", "ck", "spk", "dsk"]
+PLANETS_SPK = "synthetic_planets.bsp"
+MOON_GM = 4902.8  # km^3/s^2
+SAMPLE_CADENCE = 30.0  # Seconds between SPK/CK records
+
+LSK = """KPL/LSK
+\\begindata
+DELTET/DELTA_T_A = 32.184
+DELTET/K = 1.657D-3
+DELTET/EB = 1.671D-2
+DELTET/M = ( 6.239996D0 1.99096871D-7 )
+DELTET/DELTA_AT = ( 10, @1972-JAN-1 11, @1972-JUL-1 12, @1973-JAN-1 13, @1974-JAN-1 14, @1975-JAN-1
+                    15, @1976-JAN-1 16, @1977-JAN-1 17, @1978-JAN-1 18, @1979-JAN-1 19, @1980-JAN-1
+                    20, @1981-JUL-1 21, @1982-JUL-1 22, @1983-JUL-1 23, @1985-JUL-1 24, @1988-JAN-1
+                    25, @1990-JAN-1 26, @1991-JAN-1 27, @1992-JUL-1 28, @1993-JUL-1 29, @1994-JUL-1
+                    30, @1996-JAN-1 31, @1997-JUL-1 32, @1999-JAN-1 33, @2006-JAN-1 34, @2009-JAN-1
+                    35, @2012-JUL-1 36, @2015-JUL-1 37, @2017-JAN-1 )
+\\begintext
+"""
+
+SCLK = f"""KPL/SCLK
+\\begindata
+SCLK_KERNEL_ID = ( @2000-01-01 )
+SCLK_DATA_TYPE_{-SYNTHETIC_SPACECRAFT_ID} = ( 1 )
+SCLK01_TIME_SYSTEM_{-SYNTHETIC_SPACECRAFT_ID} = ( 1 )
+SCLK01_N_FIELDS_{-SYNTHETIC_SPACECRAFT_ID} = ( 2 )
+SCLK01_MODULI_{-SYNTHETIC_SPACECRAFT_ID} = ( 4294967296 65536 )
+SCLK01_OFFSETS_{-SYNTHETIC_SPACECRAFT_ID} = ( 0 0 )
+SCLK01_OUTPUT_DELIM_{-SYNTHETIC_SPACECRAFT_ID} = ( 1 )
+SCLK_PARTITION_START_{-SYNTHETIC_SPACECRAFT_ID} = ( 0.0 )
+SCLK_PARTITION_END_{-SYNTHETIC_SPACECRAFT_ID} = ( 2.8147497671065E+14 )
+SCLK01_COEFFICIENTS_{-SYNTHETIC_SPACECRAFT_ID} = ( 0.0 0.0 1.0 )
+\\begintext
+"""
+
+# Body constants of the Moon are kept in the FK, the archive layout has no folder for text PCKs
+FK = f"""KPL/FK
+\\begindata
+BODY301_RADII = ( {LUNAR_RADIUS} {LUNAR_RADIUS} {LUNAR_RADIUS} )
+BODY301_POLE_RA = ( 0.0 0.0 0.0 )
+BODY301_POLE_DEC = ( 90.0 0.0 0.0 )
+BODY301_PM = ( 0.0 13.17635815 0.0 )
+BODY10_RADII = ( 696000.0 696000.0 696000.0 )
+FRAME_{MOON_REF_FRAME_STR_ID} = 31001
+FRAME_31001_NAME = '{MOON_REF_FRAME_STR_ID}'
+FRAME_31001_CLASS = 4
+FRAME_31001_CLASS_ID = 31001
+FRAME_31001_CENTER = 301
+TKFRAME_31001_RELATIVE = 'IAU_MOON'
+TKFRAME_31001_SPEC = 'MATRIX'
+TKFRAME_31001_MATRIX = ( 1 0 0 0 1 0 0 0 1 )
+OBJECT_301_FRAME = '{MOON_REF_FRAME_STR_ID}'
+FRAME_{SYNTHETIC_BUS_FRAME} = -999000
+FRAME_-999000_NAME = '{SYNTHETIC_BUS_FRAME}'
+FRAME_-999000_CLASS = 3
+FRAME_-999000_CLASS_ID = -999000
+FRAME_-999000_CENTER = {SYNTHETIC_SPACECRAFT_ID}
+CK_-999000_SCLK = {SYNTHETIC_SPACECRAFT_ID}
+CK_-999000_SPK = {SYNTHETIC_SPACECRAFT_ID}
+FRAME_{SYNTHETIC_INSTRUMENT_FRAME} = -999100
+FRAME_-999100_NAME = '{SYNTHETIC_INSTRUMENT_FRAME}'
+FRAME_-999100_CLASS = 4
+FRAME_-999100_CLASS_ID = -999100
+FRAME_-999100_CENTER = {SYNTHETIC_SPACECRAFT_ID}
+TKFRAME_-999100_RELATIVE = '{SYNTHETIC_BUS_FRAME}'
+TKFRAME_-999100_SPEC = 'MATRIX'
+TKFRAME_-999100_MATRIX = ( 1 0 0 0 1 0 0 0 1 )
+NAIF_BODY_NAME += ( '{SYNTHETIC_SPACECRAFT}' )
+NAIF_BODY_CODE += ( {SYNTHETIC_SPACECRAFT_ID} )
+\\begintext
+"""
+
+# Two adjacent square sub-instruments, boresight of the first one is the +Z axis of the bus (nadir)
+IK = f"""KPL/IK
+\\begindata
+INS{SYNTHETIC_INSTRUMENT_IDS[0]}_FOV_FRAME = '{SYNTHETIC_INSTRUMENT_FRAME}'
+INS{SYNTHETIC_INSTRUMENT_IDS[0]}_FOV_SHAPE = 'RECTANGLE'
+INS{SYNTHETIC_INSTRUMENT_IDS[0]}_BORESIGHT = ( 0.0 0.0 1.0 )
+INS{SYNTHETIC_INSTRUMENT_IDS[0]}_FOV_CLASS_SPEC = 'CORNERS'
+INS{SYNTHETIC_INSTRUMENT_IDS[0]}_FOV_BOUNDARY_CORNERS = ( 0.01 0.01 1.0 -0.01 0.01 1.0 -0.01 -0.01 1.0 0.01 -0.01 1.0 )
+INS{SYNTHETIC_INSTRUMENT_IDS[1]}_FOV_FRAME = '{SYNTHETIC_INSTRUMENT_FRAME}'
+INS{SYNTHETIC_INSTRUMENT_IDS[1]}_FOV_SHAPE = 'RECTANGLE'
+INS{SYNTHETIC_INSTRUMENT_IDS[1]}_BORESIGHT = ( 0.02 0.0 1.0 )
+INS{SYNTHETIC_INSTRUMENT_IDS[1]}_FOV_CLASS_SPEC = 'CORNERS'
+INS{SYNTHETIC_INSTRUMENT_IDS[1]}_FOV_BOUNDARY_CORNERS = ( 0.03 0.01 1.0 0.01 0.01 1.0 0.01 -0.01 1.0 0.03 -0.01 1.0 )
+\\begintext
+"""
+
+
+def _write_label(kernel_path: str, et_start: float, et_stop: float):
+    """PDS label with coverage of the kernel, as parsed by DynamicKernelLoader"""
+    with open(os.path.splitext(kernel_path)[0] + ".lbl", "w") as f:
+        f.write(
+            "PDS_VERSION_ID = PDS3\n"
+            f'^SPICE_KERNEL = "{os.path.basename(kernel_path)}"\n'
+            f"START_TIME = {spice.et2utc(et_start, 'ISOC', 3)}\n"
+            f"STOP_TIME = {spice.et2utc(et_stop, 'ISOC', 3)}\n"
+        )
+
+
+def _orbit_states(ets: np.ndarray, et0: float, altitude: float, inclination: float) -> np.ndarray:
+    """States (N, 6) of a circular orbit around the Moon in J2000"""
+    radius = LUNAR_RADIUS + altitude
+    mean_motion = np.sqrt(MOON_GM / radius**3)
+    anomaly = mean_motion * (ets - et0)
+    cos_i, sin_i = np.cos(np.radians(inclination)), np.sin(np.radians(inclination))
+    positions = radius * np.stack([np.cos(anomaly), np.sin(anomaly) * cos_i, np.sin(anomaly) * sin_i], axis=1)
+    velocities = radius * mean_motion * np.stack([-np.sin(anomaly), np.cos(anomaly) * cos_i, np.cos(anomaly) * sin_i], axis=1)
+    return np.hstack([positions, velocities])
+
+
+def _nadir_quaternions(states: np.ndarray) -> np.ndarray:
+    """Quaternions of J2000 -> bus rotations, +Z of the bus towards the centre of the Moon and +X along the velocity"""
+    quaternions = np.empty((len(states), 4))
+    for i, state in enumerate(states):
+        z = -state[:3] / np.linalg.norm(state[:3])
+        x = state[3:] - np.dot(state[3:], z) * z
+        x /= np.linalg.norm(x)
+        quaternions[i] = spice.m2q(np.array([x, np.cross(z, x), z]))
+    return quaternions
+
+
+def _write_orbit_segment(destination: str, index: int, et0: float, et_start: float, et_stop: float, altitude: float, inclination: float):
+    """SPK of the orbiter and CKs of its bus covering [et_start, et_stop]"""
+    ets = np.arange(et_start, et_stop + SAMPLE_CADENCE, SAMPLE_CADENCE)
+    states = _orbit_states(ets, et0, altitude, inclination)
+
+    spk_path = os.path.join(destination, "spk", f"lrorg_{index:03d}.bsp")
+    handle = spice.spkopn(spk_path, "synthetic orbit", 0)
+    spice.spkw09(handle, SYNTHETIC_SPACECRAFT_ID, 301, "J2000", ets[0], ets[-1], "synthetic orbit", 7, len(ets), states, ets)
+    spice.spkcls(handle)
+    _write_label(spk_path, ets[0], ets[-1])
+
+    sclks = np.array([spice.sce2c(SYNTHETIC_SPACECRAFT_ID, et) for et in ets])
+    ck_path = os.path.join(destination, "ck", f"lrosc_{index:03d}.bc")
+    handle = spice.ckopn(ck_path, "synthetic attitude", 0)
+    spice.ckw03(
+        handle, sclks[0], sclks[-1], -999000, "J2000", True, "synthetic attitude", len(sclks), sclks,
+        _nadir_quaternions(states), np.zeros((len(sclks), 3)), 1, sclks[:1],
+    )
+    spice.ckcls(handle)
+    _write_label(ck_path, ets[0], ets[-1])
+    # The instrument is fixed to the bus, its CK series carries the same attitude
+    instrument_ck_path = os.path.join(destination, "ck", f"lrodv_{index:03d}.bc")
+    shutil.copyfile(ck_path, instrument_ck_path)
+    _write_label(instrument_ck_path, ets[0], ets[-1])
+
+
+def _write_dsk(path: str, bump_amplitude: float, n_latitudes: int = 90, n_longitudes: int = 180):
+    """Latitude/longitude grid of plates, radius varies by `bump_amplitude` (km) along a smooth pattern"""
+    latitudes = np.linspace(-np.pi / 2, np.pi / 2, n_latitudes)[1:-1]
+    longitudes = np.linspace(-np.pi, np.pi, n_longitudes, endpoint=False)
+    lat_grid, lon_grid = np.meshgrid(latitudes, longitudes, indexing="ij")
+    radii = LUNAR_RADIUS + bump_amplitude * np.sin(3 * lat_grid) * np.cos(4 * lon_grid)
+    ring_vertices = np.stack(
+        [radii * np.cos(lat_grid) * np.cos(lon_grid), radii * np.cos(lat_grid) * np.sin(lon_grid), radii * np.sin(lat_grid)], axis=-1
+    ).reshape(-1, 3)
+    vertices = np.vstack([[0, 0, -LUNAR_RADIUS], ring_vertices, [0, 0, LUNAR_RADIUS]])
+
+    # Vertex ids are 1-based, the south pole is 1 and the north pole the last one
+    def vertex(ring: int, j: int) -> int:
+        return 2 + ring * n_longitudes + j % n_longitudes
+
+    n_rings = len(latitudes)
+    plates = [[1, vertex(0, j + 1), vertex(0, j)] for j in range(n_longitudes)]
+    for ring in range(n_rings - 1):
+        for j in range(n_longitudes):
+            a, b, c, d = vertex(ring, j), vertex(ring, j + 1), vertex(ring + 1, j), vertex(ring + 1, j + 1)
+            plates += [[a, b, d], [a, d, c]]
+    plates += [[vertex(n_rings - 1, j), vertex(n_rings - 1, j + 1), len(vertices)] for j in range(n_longitudes)]
+    plates = np.array(plates)
+
+    spaixd, spaixi = spice.dskmi2(vertices, plates, 5.0, 4, 1_000_000, 1_000_000, 1_000_000, True, 3_000_000)
+    handle = spice.dskopn(path, "synthetic Moon", 0)
+    spice.dskw02(
+        handle, DSK_FILE_CENTER_BODY_ID, DSK_FILESURFACE_ID, DCLASS, MOON_REF_FRAME_STR_ID, 1, np.zeros(10),
+        -np.pi, np.pi, -np.pi / 2, np.pi / 2, LUNAR_RADIUS - bump_amplitude - 1, LUNAR_RADIUS + bump_amplitude + 1,
+        -1e10, 1e10, vertices, plates, spaixd, spaixi,
+    )
+    spice.dskcls(handle, True)
+
+
+def write_synthetic_kernels(
+    destination: str,
+    days: int = 2,
+    altitude: float = 50.0,
+    inclination: float = 89.0,
+    bump_amplitude: float = 0.0,
+) -> Dict:
+    """
+    Writes synthetic kernels covering `days` days (one SPK/CK per day) into `destination`
+
+    Kernels are written only if `destination` doesn't hold kernels of the same parameters already, so benchmarks
+    of different commits run on identical inputs. Returns the manifest of the kernels
+    """
+    manifest = {
+        "days": days,
+        "altitude": altitude,
+        "inclination": inclination,
+        "bump_amplitude": bump_amplitude,
+        "start_utc": SYNTHETIC_START_UTC,
+    }
+    manifest_path = os.path.join(destination, MANIFEST_FILENAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            if json.load(f) == manifest:
+                return manifest
+        # Only kernels written here are replaced, caches stored alongside them (e.g. by benchmark.py) are kept
+        for folder in KERNEL_FOLDERS:
+            shutil.rmtree(os.path.join(destination, folder), ignore_errors=True)
+        for filename in (PLANETS_SPK, MANIFEST_FILENAME):
+            if os.path.exists(path := os.path.join(destination, filename)):
+                os.remove(path)
+
+    logger.info("Writing synthetic kernels into %s", destination)
+    for folder in KERNEL_FOLDERS:
+        os.makedirs(os.path.join(destination, folder), exist_ok=True)
+    text_kernels = [("lsk/synthetic.tls", LSK), ("sclk/synthetic.tsc", SCLK), ("fk/synthetic.tf", FK), ("ik/synthetic.ti", IK)]
+    for filename, content in text_kernels:
+        with open(os.path.join(destination, filename), "w") as f:
+            f.write(content)
+
+    try:
+        for filename, _ in text_kernels:
+            spice.furnsh(os.path.join(destination, filename))
+        et0 = spice.str2et(SYNTHETIC_START_UTC)
+        for day in range(days):
+            _write_orbit_segment(destination, day, et0, et0 + day * spice.spd(), et0 + (day + 1) * spice.spd(), altitude, inclination)
+
+        # Stationary Moon and Sun w.r.t. the solar system barycentre, so aberration corrections can be computed
+        ets = np.array([et0 - 1e8, et0 + 1e8])
+        handle = spice.spkopn(os.path.join(destination, PLANETS_SPK), "synthetic planets", 0)
+        spice.spkw09(handle, 301, 0, "J2000", ets[0], ets[-1], "moon", 1, 2, np.array([[1.5e8, 0, 0, 0, 0, 0]] * 2), ets)
+        spice.spkw09(handle, 10, 0, "J2000", ets[0], ets[-1], "sun", 1, 2, np.zeros((2, 6)), ets)
+        spice.spkcls(handle)
+
+        _write_dsk(os.path.join(destination, SYNTHETIC_DSK), bump_amplitude)
+    finally:
+        spice.kclear()
+
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    return manifest
@@ -0,0 +1,149 @@
+"""
+Detection of overflight windows - time intervals a point of interest is within the treshold from the projected
+boresight or footprint of an instrument
+
+Entry and exit times are refined by root finding on the distance function and the closest approach by bounded
+minimization, in the manner of SPICE GF geometry finder routines.
+"""
+import logging
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Union
+
+import numpy as np
+from scipy.optimize import brentq, minimize_scalar
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class OverflightWindow:
+    target_id: int
+    # Epochs of the last sample outside and the first sample inside the treshold
+    et_outside_before: float
+    et_first_inside: float
+    et_last_inside: float
+    # Closest sample
+    et_closest: float
+    min_distance: float
+
+
+class OverflightWindowFinder:
+    """
+    Tracks samples of the sweep and turns them into one window per overflight of each point of interest
+
+    Samples have to be fed in time order, each with distances of targets within the treshold. A window is opened
+    once a target gets within the treshold and closed with the first sample it's not within anymore. Epochs of
+    entry, exit and the closest approach are then refined with `distance`, which evaluates the distance of
+    a target at given epoch (None on failure), e.g. from the boresight intercept or the footprint.
+    The treshold is either shared by all targets or an array of tresholds by target id
+    """
+
+    def __init__(
+        self,
+        treshold: Union[float, np.ndarray],
+        distance: Callable[[float, int], Optional[float]],
+        tolerance: float,
+    ):
+        self.treshold = treshold
+        self.distance = distance
+        self.tolerance = tolerance
+
+        self.open_windows: Dict[int, OverflightWindow] = {}
+        self.closed_windows: List[Dict] = []
+        self._last_et: Optional[float] = None
+        self.refinement_evaluations_cnt = 0
+
+    def update(self, et: float, inside: Dict[int, float]):
+        """Feeds a sample - distances of targets within the treshold at given epoch by their ids"""
+        for target_id in [target_id for target_id in self.open_windows if target_id not in inside]:
+            self._close(self.open_windows.pop(target_id), et)
+
+        for target_id, distance in inside.items():
+            if (window := self.open_windows.get(target_id)) is None:
+                et_outside_before = et if self._last_et is None else self._last_et
+                self.open_windows[target_id] = OverflightWindow(target_id, et_outside_before, et, et, et, distance)
+            else:
+                window.et_last_inside = et
+                if distance < window.min_distance:
+                    window.et_closest, window.min_distance = et, distance
+        self._last_et = et
+
+    def finalize(self):
+        """Closes windows still open at the end of the sweep, their exit is the last sample inside"""
+        for window in self.open_windows.values():
+            self._close(window, None)
+        self.open_windows = {}
+
+    def reset(self, last_et: Optional[float] = None):
+        """
+        Closes open windows and forgets the last sample, next samples are not contiguous with the previous ones.
+        Resumed sweeps pass the epoch of their last sample as `last_et`
+        """
+        self.finalize()
+        self._last_et = last_et
+
+    @property
+    def last_et(self) -> Optional[float]:
+        return self._last_et
+
+    def pop_closed(self) -> List[Dict]:
+        closed, self.closed_windows = self.closed_windows, []
+        return closed
+
+    def _distance(self, et: float, target_id: int) -> float:
+        self.refinement_evaluations_cnt += 1
+        if (distance := self.distance(et, target_id)) is None:
+            raise ValueError(f"Distance of target {target_id} could not be evaluated at {et}")
+        return distance
+
+    def _treshold(self, target_id: int) -> float:
+        return float(self.treshold) if np.ndim(self.treshold) == 0 else float(self.treshold[target_id])
+
+    def _crossing(self, et_outside: float, et_inside: float, target_id: int) -> float:
+        """Epoch of the treshold crossing within the bracket, the inside sample on failure"""
+        if et_outside == et_inside:
+            return et_inside
+        try:
+            return brentq(
+                lambda et: self._distance(et, target_id) - self._treshold(target_id),
+                min(et_outside, et_inside),
+                max(et_outside, et_inside),
+                xtol=self.tolerance,
+            )
+        except ValueError as e:
+            logger.debug("Crossing refinement failed for target %d: %s", target_id, e)
+            return et_inside
+
+    def _closest(self, window: OverflightWindow, et_enter: float, et_exit: float) -> None:
+        if et_enter >= et_exit:
+            return
+        try:
+            result = minimize_scalar(
+                lambda et: self._distance(et, window.target_id),
+                bounds=(et_enter, et_exit),
+                method="bounded",
+                options={"xatol": self.tolerance},
+            )
+        except ValueError as e:
+            logger.debug("Closest approach refinement failed for target %d: %s", window.target_id, e)
+            return
+        if result.success and result.fun < window.min_distance:
+            window.et_closest, window.min_distance = float(result.x), float(result.fun)
+
+    def _close(self, window: OverflightWindow, et_outside_after: Optional[float]):
+        et_enter = self._crossing(window.et_outside_before, window.et_first_inside, window.target_id)
+        if et_outside_after is None:
+            et_exit, is_open = window.et_last_inside, True
+        else:
+            et_exit, is_open = self._crossing(et_outside_after, window.et_last_inside, window.target_id), False
+        self._closest(window, et_enter, et_exit)
+        self.closed_windows.append(
+            {
+                "target_id": window.target_id,
+                "et": window.et_closest,
+                "et_enter": et_enter,
+                "et_exit": et_exit,
+                "min_distance": window.min_distance,
+                "meta": {"open": is_open},
+            }
+        )
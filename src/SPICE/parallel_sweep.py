@@ -0,0 +1,160 @@
+"""
+This script splits the mission timeline into shards aligned to dynamic kernel boundaries
+and sweeps them in parallel, each shard in its own process with its own SPICE kernel pool.
+"""
+import os
+import sys
+import logging
+import multiprocessing as mp
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Type
+
+sys.path.insert(0, "/".join(__file__.split("/")[:-3]))
+
+import numpy as np
+import spiceypy as spice
+from tqdm import tqdm
+
+from src.global_config import TQDM_NCOLS
+from src.SPICE.config import SIMULATION_BATCH_SIZE, SWEEP_SHARD_OVERRUN, SWEEP_SHARDS_PER_PROCESS, TIME_STEP
+from src.SPICE.instruments.base_instrument import Instrument
+from src.SPICE.pit_catalog import PitCatalog
+from src.db.mongo.interface import Sessions
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SweepShard:
+    shard_id: int
+    # Swept interval [start_et, stop_et) in ephemeris time
+    start_et: float
+    stop_et: float
+
+
+def plan_shards(instrument: Instrument, n_shards: int) -> List[SweepShard]:
+    """
+    Splits the sweep interval of the instrument into roughly equally long shards
+
+    Shard boundaries are snapped to the nearest start of a dynamic kernel, so each worker furnishes
+    mostly disjoint set of CK/SPK files
+    """
+    start_et = instrument.current_simulation_timestamp_et
+    stop_et = instrument.max_time
+    kernel_starts = instrument.sweep_iterator.kernel_boundaries(start_et, stop_et)
+
+    boundaries = [start_et]
+    if len(kernel_starts):
+        for target in np.linspace(start_et, stop_et, n_shards + 1)[1:-1]:
+            boundary = kernel_starts[np.argmin(np.abs(kernel_starts - target))]
+            if boundary > boundaries[-1]:
+                boundaries.append(float(boundary))
+    boundaries.append(stop_et)
+
+    return [SweepShard(i, start, stop) for i, (start, stop) in enumerate(zip(boundaries[:-1], boundaries[1:]))]
+
+
+def in_view(instrument: Instrument, window: Dict, et: float) -> bool:
+    """Whether the pit of an overflight window is within the detection treshold of the instrument at `et`"""
+    target_id = int(np.flatnonzero(np.asarray(instrument._target_names).astype(str) == window["pit"])[0])
+    instrument._refresh_kernels(et)
+    distance = instrument._target_distance(et, target_id)
+    return distance is not None and distance <= instrument._detection_tresholds[target_id]
+
+
+def sweep_shard(
+    instrument_class: Type[Instrument], shard: SweepShard, batch_size: Optional[int], pit_catalog_directory: Optional[str] = None
+) -> List[Dict]:
+    """
+    Worker entrypoint, sweeps a single shard with a freshly furnished kernel pool and the shared pit catalogue.
+    Only static kernels required by the shard (and SWEEP_SHARD_OVERRUN past it) are furnished
+
+    Overflight windows belong to the shard they start in. Windows open at the stop of a shard are swept past it until
+    they close, the following shard drops windows of pits already in view at its start, so no window is cut in two
+    """
+    instrument = instrument_class(
+        pit_catalog=None if pit_catalog_directory is None else PitCatalog(pit_catalog_directory),
+        start_et=shard.start_et,
+        stop_et=shard.stop_et + SWEEP_SHARD_OVERRUN,
+    )
+    points = [
+        point
+        for batch in instrument.sweep(
+            batch_size=batch_size, start_et=shard.start_et, stop_et=shard.stop_et, show_progress=False, close_windows=True
+        )
+        for point in batch
+        # The last step of a shard may overshoot into the following one
+        if point.get("et_enter", point["et"]) < shard.stop_et
+    ]
+    if instrument.overflight_windows and shard.shard_id > 0:
+        # Windows opened with the first sample of the shard have no entry refined, they may continue one of the previous shard
+        points = [
+            point
+            for point in points
+            if point["et_enter"] > shard.start_et + TIME_STEP or not in_view(instrument, point, shard.start_et)
+        ]
+    return points
+
+
+class ParallelSweepRunner:
+    """
+    Sweeps the whole loaded time interval of an instrument with a pool of worker processes
+
+    Workers are spawned (not forked), so SPICE global state is never shared between them. Shards finish
+    out of order, results are written into the simulation collection strictly in time order
+    """
+
+    def __init__(
+        self,
+        instrument_class: Type[Instrument],
+        processes: Optional[int] = None,
+        n_shards: Optional[int] = None,
+        batch_size: Optional[int] = SIMULATION_BATCH_SIZE,
+    ):
+        self.instrument_class = instrument_class
+        self.processes = os.cpu_count() if processes is None else processes
+        self.batch_size = batch_size
+
+        # Instrument in the main process is used only to plan the shards and build the pit catalogue workers attach to
+        instrument = instrument_class()
+        self.pit_catalog_directory = instrument.pit_catalog.directory
+        self.shards = plan_shards(instrument, self.processes * SWEEP_SHARDS_PER_PROCESS if n_shards is None else n_shards)
+        logger.info("Planned %d shards for %d processes", len(self.shards), self.processes)
+
+    def run_simulation(self, collection_slug: Optional[str] = None):
+        simulation_collection = Sessions._prepare_simulation_collection(collection_slug)
+        finished_shards: Dict[int, List[Dict]] = {}
+        next_shard_to_store = 0
+        found_cnt = 0
+
+        with mp.get_context("spawn").Pool(self.processes) as pool, tqdm(
+            total=len(self.shards), ncols=TQDM_NCOLS, desc="Sweeping shards"
+        ) as pbar:
+            pending = {
+                shard.shard_id: pool.apply_async(sweep_shard, (self.instrument_class, shard, self.batch_size, self.pit_catalog_directory))
+                for shard in self.shards
+            }
+            while pending:
+                for shard_id in [shard_id for shard_id, result in pending.items() if result.ready()]:
+                    finished_shards[shard_id] = pending.pop(shard_id).get()
+                    found_cnt += len(finished_shards[shard_id])
+                    shard = self.shards[shard_id]
+                    logger.debug(
+                        "Shard %d (%s - %s) finished with %d points",
+                        shard_id,
+                        spice.et2utc(shard.start_et, "ISOC", 0),
+                        spice.et2utc(shard.stop_et, "ISOC", 0),
+                        len(finished_shards[shard_id]),
+                    )
+                    pbar.update(1)
+
+                # Store all consecutive finished shards to keep the collection in time order
+                while next_shard_to_store in finished_shards:
+                    Sessions.insert_simulation_results(
+                        finished_shards.pop(next_shard_to_store), collection=simulation_collection
+                    )
+                    next_shard_to_store += 1
+                pbar.set_postfix(found=found_cnt, stored_shards=next_shard_to_store)
+
+                if pending:
+                    next(iter(pending.values())).wait(timeout=1)
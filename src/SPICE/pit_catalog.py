@@ -0,0 +1,132 @@
+"""
+Catalogue of points of interest shared by all instruments and worker processes
+
+Names, coordinates, surface points (see pit_surface_points), unit vectors and radii of pits are stored as memory-mapped
+NumPy files keyed by the catalogue and the DSK. The catalogue is built once (by the process fetching pits from the
+database), other processes attach to it by its directory, so all of them share the same pages of the page cache.
+"""
+import os
+import sys
+import json
+import hashlib
+import logging
+from typing import Optional
+
+sys.path.insert(0, "/".join(__file__.split("/")[:-3]))
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from src.SPICE.config import PIT_CATALOG_DESTINATION, PIT_SURFACE_DESTINATION
+from src.SPICE.pit_surface import pit_surface_points
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = "index.json"
+ARRAYS = ("names", "latitudes", "longitudes", "points", "unit_vectors", "radii")
+# Columns of diameters (metres) pit radii are derived from, later ones are preferred
+DIAMETER_COLUMNS = ("inner_max_diameter", "funnel_max_diameter")
+
+
+def pit_radii(pits: pd.DataFrame) -> np.ndarray:
+    """Radii of pits (km), the funnel is preferred over the inner diameter, NaN where the atlas states neither"""
+    diameters = np.full(len(pits), np.nan)
+    for column in DIAMETER_COLUMNS:
+        if column in pits:
+            column_diameters = pd.to_numeric(pits[column], errors="coerce").to_numpy(dtype=float)
+            diameters = np.where(np.isnan(column_diameters), diameters, column_diameters)
+    return diameters / 2000
+
+
+class PitCatalog:
+    """
+    Read-only arrays of a catalogue of points of interest, row i of each array describes the pit with id i
+
+    - names: pit names (fixed width unicode)
+    - latitudes, longitudes: planetocentric coordinates (degrees)
+    - points: (N, 3) surface points in the frame of the DSK (km), NaN where the DSK wasn't intersected
+    - unit_vectors: (N, 3) directions of the pits from the centre of the Moon
+    - radii: radii of pits (km), NaN where unknown
+
+    The KD-Tree of surface points is built on first use in each process, it takes milliseconds for the whole atlas
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, INDEX_FILENAME), "r") as f:
+            index = json.load(f)
+        self.key = index["key"]
+        self.dsk = index["dsk"]
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r"))
+        self._kd_tree: Optional[cKDTree] = None
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @property
+    def kd_tree(self) -> cKDTree:
+        if self._kd_tree is None:
+            self._kd_tree = cKDTree(self.points)
+        return self._kd_tree
+
+    @staticmethod
+    def catalog_key(pits: pd.DataFrame, dsk_path: str) -> str:
+        dsk_stat = os.stat(dsk_path)
+        key = hashlib.sha1(f"{os.path.basename(dsk_path)}:{dsk_stat.st_size}:{dsk_stat.st_mtime_ns}".encode())
+        key.update("\n".join(map(str, pits.index)).encode())
+        for values in (pits["latitude"], pits["longitude"], pit_radii(pits)):
+            key.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+        return key.hexdigest()
+
+    @classmethod
+    def build(
+        cls,
+        pits: pd.DataFrame,
+        dsk_path: str,
+        destination: str = PIT_CATALOG_DESTINATION,
+        surface_destination: str = PIT_SURFACE_DESTINATION,
+    ) -> "PitCatalog":
+        """Stores the catalogue of `pits` (in the format of Sessions.get_all_pits_points) into `destination`"""
+        key = cls.catalog_key(pits, dsk_path)
+        directory = os.path.join(destination, key)
+        os.makedirs(directory, exist_ok=True)
+
+        latitudes = pits["latitude"].to_numpy(dtype=float)
+        longitudes = pits["longitude"].to_numpy(dtype=float)
+        lat_rad, lon_rad = np.radians(latitudes), np.radians(longitudes)
+        arrays = {
+            "names": np.array([str(name) for name in pits.index], dtype=str),
+            "latitudes": latitudes,
+            "longitudes": longitudes,
+            "points": pit_surface_points(dsk_path, latitudes, longitudes, surface_destination),
+            "unit_vectors": np.column_stack([np.cos(lat_rad) * np.cos(lon_rad), np.cos(lat_rad) * np.sin(lon_rad), np.sin(lat_rad)]),
+            "radii": pit_radii(pits),
+        }
+        # Arrays are written under temporary names first, concurrent processes may build the same catalogue
+        for name, values in arrays.items():
+            with open(temporary_path := os.path.join(directory, f"{name}.npy.{os.getpid()}"), "wb") as f:
+                np.save(f, values)
+            os.replace(temporary_path, os.path.join(directory, f"{name}.npy"))
+
+        # The index is written last, a catalogue without it is incomplete
+        with open(temporary_path := os.path.join(directory, f"{INDEX_FILENAME}.{os.getpid()}"), "w") as f:
+            json.dump({"key": key, "dsk": os.path.basename(dsk_path), "pits": len(pits)}, f)
+        os.replace(temporary_path, os.path.join(directory, INDEX_FILENAME))
+        logger.info("Catalogue of %d pits stored in %s", len(pits), directory)
+        return cls(directory)
+
+    @classmethod
+    def load_or_build(
+        cls,
+        pits: pd.DataFrame,
+        dsk_path: str,
+        destination: str = PIT_CATALOG_DESTINATION,
+        surface_destination: str = PIT_SURFACE_DESTINATION,
+    ) -> "PitCatalog":
+        """Opens the catalogue of `pits` on given DSK, builds it if missing"""
+        directory = os.path.join(destination, cls.catalog_key(pits, dsk_path))
+        if os.path.exists(os.path.join(directory, INDEX_FILENAME)):
+            return cls(directory)
+        return cls.build(pits, dsk_path, destination, surface_destination)
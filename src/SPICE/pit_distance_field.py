@@ -0,0 +1,230 @@
+"""
+Precomputed field of distances to the closest point of interest over the whole lunar surface
+
+The surface is split into equal-area cells of the HEALPix grid (ring scheme). For the centre of each cell, the field
+stores the great-circle (angular) distance to the closest point of interest and its id. Arrays are stored as
+memory-mapped NumPy files keyed by the points of interest and resolution, so the field is built once per catalogue.
+
+The closest point to the centre of a cell isn't necessarily the closest one to any point within it, so lookups
+return lower bounds of distances (lowered by the maximal cell radius), exact distances still need the KD-Tree.
+"""
+import os
+import sys
+import math
+import json
+import hashlib
+import logging
+from typing import Tuple
+
+sys.path.insert(0, "/".join(__file__.split("/")[:-3]))
+
+import numpy as np
+from scipy.spatial import cKDTree
+from tqdm import tqdm
+
+from src.global_config import TQDM_NCOLS
+from src.SPICE.config import PIT_DISTANCE_FIELD_DESTINATION, PIT_DISTANCE_FIELD_RESOLUTION
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = "index.json"
+DISTANCES_FILENAME = "distances.npy"
+IDS_FILENAME = "ids.npy"
+# Cell centres are queried in chunks to keep the memory bounded
+BUILD_CHUNK_SIZE = 1 << 20
+
+
+def healpix_nside(resolution: float, radius: float) -> int:
+    """Smallest HEALPix nside with cells of at most `resolution` ** 2 area on a sphere of `radius`"""
+    # 12 * nside ** 2 cells cover 4 * pi * radius ** 2
+    return int(np.ceil(np.sqrt(np.pi / 3) * radius / resolution))
+
+
+def healpix_max_pixrad(nside: int) -> float:
+    """Maximal angular distance (rad) of any point of a cell to its centre (as healpix_base::max_pixrad)"""
+    va = np.array([np.sqrt(1 - (2 / 3) ** 2) * np.cos(np.pi / (4 * nside)), np.sqrt(1 - (2 / 3) ** 2) * np.sin(np.pi / (4 * nside)), 2 / 3])
+    z = 1 - (1 - 1 / nside) ** 2 / 3
+    vb = np.array([np.sqrt(1 - z**2), 0.0, z])
+    return float(np.arctan2(np.linalg.norm(np.cross(va, vb)), va @ vb))
+
+
+def healpix_zphi2pix(nside: int, z: np.ndarray, phi: np.ndarray) -> np.ndarray:
+    """Ring scheme cell indices of directions given by z (cosine of colatitude) and longitude phi, vectorized ang2pix_ring"""
+    za = np.abs(z)
+    tt = np.mod(phi, 2 * np.pi) * (2 / np.pi)  # In [0, 4)
+    ncap = 2 * nside * (nside - 1)
+    npix = 12 * nside * nside
+
+    # Both branches are evaluated for all directions, selecting afterwards is cheaper than masking
+    # Equatorial belt
+    temp1 = nside * (0.5 + tt)
+    temp2 = nside * z * 0.75
+    jp = (temp1 - temp2).astype(np.int64)  # Index of ascending edge line
+    jm = (temp1 + temp2).astype(np.int64)  # Index of descending edge line
+    ir = nside + 1 + jp - jm  # Ring number counted from z = 2/3, in [1, 2 * nside + 1]
+    kshift = 1 - (ir & 1)
+    equatorial = ncap + (ir - 1) * 4 * nside + np.mod((jp + jm - nside + kshift + 1) // 2, 4 * nside)
+
+    # Polar caps
+    tp = tt - np.floor(tt)
+    tmp = nside * np.sqrt(3 * np.maximum(1 - za, 0))
+    jp = (tp * tmp).astype(np.int64)
+    jm = ((1 - tp) * tmp).astype(np.int64)
+    ir = jp + jm + 1  # Ring number counted from the closest pole
+    ip = np.mod((tt * ir).astype(np.int64), 4 * ir)
+    polar = np.where(z > 0, 2 * ir * (ir - 1) + ip, npix - 2 * ir * (ir + 1) + ip)
+    return np.where(za <= 2 / 3, equatorial, polar)
+
+
+def healpix_zphi2pix_scalar(nside: int, z: float, phi: float) -> int:
+    """Scalar counterpart of healpix_zphi2pix, the vectorized one is dominated by NumPy overhead for single directions"""
+    za = abs(z)
+    tt = (phi % (2 * math.pi)) * (2 / math.pi)
+    if za <= 2 / 3:
+        temp1 = nside * (0.5 + tt)
+        temp2 = nside * z * 0.75
+        jp, jm = int(temp1 - temp2), int(temp1 + temp2)
+        ir = nside + 1 + jp - jm
+        kshift = 1 - (ir & 1)
+        return 2 * nside * (nside - 1) + (ir - 1) * 4 * nside + ((jp + jm - nside + kshift + 1) // 2) % (4 * nside)
+    tp = tt - math.floor(tt)
+    tmp = nside * math.sqrt(3 * (1 - za))
+    jp, jm = int(tp * tmp), int((1 - tp) * tmp)
+    ir = jp + jm + 1
+    ip = int(tt * ir) % (4 * ir)
+    return 2 * ir * (ir - 1) + ip if z > 0 else 12 * nside * nside - 2 * ir * (ir + 1) + ip
+
+
+def healpix_pix2vec(nside: int, pixels: np.ndarray) -> np.ndarray:
+    """(N, 3) unit vectors of centres of ring scheme cells, vectorized pix2ang_ring"""
+    pixels = np.asarray(pixels, dtype=np.int64)
+    ncap = 2 * nside * (nside - 1)
+    npix = 12 * nside * nside
+    z, phi = np.empty(len(pixels)), np.empty(len(pixels))
+
+    north = pixels < ncap
+    ring = ((1 + np.sqrt(1 + 2 * pixels[north])) / 2).astype(np.int64)
+    z[north] = 1 - ring**2 / (3 * nside**2)
+    phi[north] = (pixels[north] + 1 - 2 * ring * (ring - 1) - 0.5) * np.pi / (2 * ring)
+
+    equatorial = (pixels >= ncap) & (pixels < npix - ncap)
+    ip = pixels[equatorial] - ncap
+    ring = ip // (4 * nside) + nside
+    odd_shift = np.where((ring + nside) & 1, 1.0, 0.5)
+    z[equatorial] = (2 * nside - ring) * 2 / (3 * nside)
+    phi[equatorial] = (np.mod(ip, 4 * nside) + 1 - odd_shift) * np.pi / (2 * nside)
+
+    south = pixels >= npix - ncap
+    ip = npix - pixels[south]
+    ring = ((1 + np.sqrt(2 * ip - 1)) / 2).astype(np.int64)
+    z[south] = -1 + ring**2 / (3 * nside**2)
+    phi[south] = (4 * ring + 1 - (ip - 2 * ring * (ring - 1)) - 0.5) * np.pi / (2 * ring)
+
+    sin_theta = np.sqrt(np.clip(1 - z**2, 0, None))
+    return np.column_stack([sin_theta * np.cos(phi), sin_theta * np.sin(phi), z])
+
+
+class PitDistanceField:
+    """
+    Constant time lookup of distances to the closest point of interest
+
+    Build the field with `PitDistanceField.build` (or `load_or_build`) from Cartesian points of interest in the lunar
+    body-fixed frame, missing points (NaN rows) are skipped. Ids in the field are row indices of the points
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, INDEX_FILENAME), "r") as f:
+            index = json.load(f)
+        self.nside = index["nside"]
+        self.key = index["key"]
+        self.max_pixrad = index["max_pixrad"]
+        # Points of interest lie at least this far from the centre of the Moon (km)
+        self.min_radius = index["min_radius"]
+        # Plain ndarray views of the memory maps, they're cheaper to index
+        self._distances = np.asarray(np.load(os.path.join(directory, DISTANCES_FILENAME), mmap_mode="r"))
+        self._ids = np.asarray(np.load(os.path.join(directory, IDS_FILENAME), mmap_mode="r"))
+
+    @staticmethod
+    def field_key(points: np.ndarray, nside: int) -> str:
+        return hashlib.sha1(np.ascontiguousarray(points, dtype=np.float64).tobytes() + str(nside).encode()).hexdigest()
+
+    @classmethod
+    def build(cls, points: np.ndarray, nside: int, destination: str = PIT_DISTANCE_FIELD_DESTINATION) -> "PitDistanceField":
+        """Computes the field for all cell centres and stores it into `destination`"""
+        key = cls.field_key(points, nside)
+        directory = os.path.join(destination, key)
+        os.makedirs(directory, exist_ok=True)
+
+        valid_ids = np.flatnonzero(~np.isnan(points).any(axis=1))
+        radii = np.linalg.norm(points[valid_ids], axis=1)
+        kd_tree = cKDTree(points[valid_ids] / radii[:, None])
+
+        npix = 12 * nside * nside
+        distances = np.lib.format.open_memmap(os.path.join(directory, DISTANCES_FILENAME), mode="w+", dtype=np.float32, shape=(npix,))
+        ids = np.lib.format.open_memmap(os.path.join(directory, IDS_FILENAME), mode="w+", dtype=np.int32, shape=(npix,))
+        for start in tqdm(range(0, npix, BUILD_CHUNK_SIZE), ncols=TQDM_NCOLS, desc="Building pit distance field"):
+            pixels = np.arange(start, min(start + BUILD_CHUNK_SIZE, npix))
+            if not len(valid_ids):
+                distances[pixels], ids[pixels] = np.inf, -1
+                continue
+            chords, nearest = kd_tree.query(healpix_pix2vec(nside, pixels))
+            distances[pixels] = 2 * np.arcsin(np.clip(chords / 2, 0, 1))
+            ids[pixels] = valid_ids[nearest]
+        distances.flush()
+        ids.flush()
+        del distances, ids
+
+        # The index is written last, a field without it is incomplete
+        with open(os.path.join(directory, INDEX_FILENAME), "w") as f:
+            json.dump(
+                {
+                    "key": key,
+                    "nside": nside,
+                    "points": int(len(valid_ids)),
+                    "max_pixrad": healpix_max_pixrad(nside),
+                    "min_radius": float(radii.min()) if len(radii) else 0.0,
+                },
+                f,
+            )
+        logger.info("Pit distance field of %d points with %d cells stored in %s", len(valid_ids), npix, directory)
+        return cls(directory)
+
+    @classmethod
+    def load_or_build(
+        cls,
+        points: np.ndarray,
+        radius: float,
+        resolution: float = PIT_DISTANCE_FIELD_RESOLUTION,
+        destination: str = PIT_DISTANCE_FIELD_DESTINATION,
+    ) -> "PitDistanceField":
+        """Opens the field of `points` with cells of about `resolution` km on a sphere of `radius`, builds it if missing"""
+        nside = healpix_nside(resolution, radius)
+        directory = os.path.join(destination, cls.field_key(points, nside))
+        if os.path.exists(os.path.join(directory, INDEX_FILENAME)):
+            return cls(directory)
+        return cls.build(points, nside, destination)
+
+    def lookup(self, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Lower bounds of distances (km) from (N, 3) points in the lunar body-fixed frame to the closest point of interest,
+        and ids of points of interest closest to centres of their cells
+        """
+        points = np.atleast_2d(points)
+        radii = np.sqrt(np.einsum("ij,ij->i", points, points))
+        pixels = healpix_zphi2pix(self.nside, points[:, 2] / radii, np.arctan2(points[:, 1], points[:, 0]))
+        angles = np.maximum(self._distances[pixels] - self.max_pixrad, 0)
+        # Chord between points at different radii is at least the chord at the smaller one
+        with np.errstate(invalid="ignore"):
+            distances = np.where(np.isinf(angles), np.inf, 2 * np.minimum(radii, self.min_radius) * np.sin(angles / 2))
+        return distances, self._ids[pixels]
+
+    def lookup_one(self, point: np.ndarray) -> Tuple[float, int]:
+        """Scalar counterpart of lookup for a single point"""
+        x, y, z = float(point[0]), float(point[1]), float(point[2])
+        radius = math.sqrt(x * x + y * y + z * z)
+        pixel = healpix_zphi2pix_scalar(self.nside, z / radius, math.atan2(y, x))
+        angle = float(self._distances[pixel])
+        if math.isinf(angle):
+            return math.inf, -1
+        return 2 * min(radius, self.min_radius) * math.sin(max(angle - self.max_pixrad, 0) / 2), int(self._ids[pixel])
@@ -0,0 +1,208 @@
+"""
+Pit-centric (reverse) visibility query - when did an instrument see given points of interest
+
+Instead of sweeping the whole mission, sub-spacecraft points are sampled every PIT_QUERY_CADENCE seconds (only SPK
+kernels are furnished) and passes are found where the nadir ground track, the great-circle arcs between consecutive
+samples, comes within a cross-track distance of a queried pit. Only these passes are swept with the geometry of the
+instrument (see Instrument.sweep), so a new pit candidate is analysed in seconds rather than by a mission-long sweep:
+
+    python src/SPICE/pit_query.py --pits "Marius Hills Hole" --start 2010-01-01 --stop 2011-01-01
+"""
+import os
+import sys
+import glob
+import json
+import logging
+import argparse
+from typing import Dict, Iterable, List, Optional, Tuple, Type
+
+sys.path.insert(0, "/".join(__file__.split("/")[:-3]))
+
+import numpy as np
+import pandas as pd
+import spiceypy as spice
+from tqdm import tqdm
+
+from src.global_config import TQDM_NCOLS
+from src.SPICE.config import PIT_QUERY_CADENCE, PIT_QUERY_CROSS_TRACK_MARGIN, PIT_QUERY_PASS_MARGIN
+from src.SPICE.instruments import DIVINERInstrument
+from src.SPICE.instruments.base_instrument import Instrument
+from src.SPICE.kernels.coverage import merge_intervals
+
+logger = logging.getLogger(__name__)
+
+# Arcs of the ground track measured against pits at once, bounds memory of mission-long queries
+GROUND_TRACK_BLOCK_SIZE = 100_000
+
+
+def ground_track_distances(directions: np.ndarray, targets: np.ndarray, radius: float) -> np.ndarray:
+    """
+    Distances (km) of targets (P, 3 unit vectors) from great-circle arcs between consecutive sub-spacecraft points
+    (S + 1, 3 unit vectors) on a sphere of `radius`, as (S, P) array. The distance is cross-track where the closest
+    point of the great circle lies within the arc, to the nearer end of the arc otherwise. NaN for missing samples
+    """
+    starts, ends = directions[:-1], directions[1:]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        normals = np.cross(starts, ends)
+        normals /= np.linalg.norm(normals, axis=1)[:, None]
+        cross_track = np.arcsin(np.clip(np.abs(normals @ targets.T), 0, 1))
+        within = (np.cross(normals, starts) @ targets.T >= 0) & (np.cross(ends, normals) @ targets.T >= 0)
+    to_ends = np.arccos(np.clip(np.maximum(starts @ targets.T, ends @ targets.T), -1, 1))
+    return radius * np.where(within, cross_track, to_ends)
+
+
+def extrapolate_missing_samples(ets: np.ndarray, directions: np.ndarray, max_step: float) -> np.ndarray:
+    """
+    Sub-spacecraft points missing next to two consecutive samples no more than `max_step` seconds apart (e.g. at the
+    very end of SPK coverage) extrapolated along the ground track, so passes at coverage edges are not lost
+    """
+    directions = directions.copy()
+    missing = np.isnan(directions).any(axis=1)
+    for i in np.flatnonzero(missing):
+        for j, k in ((i - 1, i - 2), (i + 1, i + 2)):
+            if 0 <= min(j, k) and max(j, k) < len(ets) and not missing[j] and not missing[k] and abs(ets[j] - ets[k]) <= max_step:
+                direction = directions[j] + (directions[j] - directions[k]) * (ets[i] - ets[j]) / (ets[j] - ets[k])
+                directions[i] = direction / np.linalg.norm(direction)
+                break
+    return directions
+
+
+class PitVisibilityQuery:
+    """
+    Finds when `instrument_class` saw `pits` (in the format of Sessions.get_all_pits_points, e.g. candidates not in
+    the atlas yet) without sweeping the whole mission
+
+    The instrument is created with the queried pits as its only points of interest and without the pit distance
+    field (the KD-Tree of a few pits is just as fast). Results are documents of Instrument.sweep - overflight windows
+    or hits, as set by overflight_windows of the instrument. Passes are found from the nadir ground track, so
+    `cross_track_distance` (rough treshold of the instrument plus PIT_QUERY_CROSS_TRACK_MARGIN by default) has to
+    cover off-nadir pointing of the boresight
+
+    With `start_et` and `stop_et`, only static kernels required between them are furnished and they are the default
+    interval of the query
+    """
+
+    def __init__(
+        self,
+        pits: pd.DataFrame,
+        instrument_class: Type[Instrument] = DIVINERInstrument,
+        cross_track_distance: Optional[float] = None,
+        cadence: float = PIT_QUERY_CADENCE,
+        pass_margin: float = PIT_QUERY_PASS_MARGIN,
+        start_et: Optional[float] = None,
+        stop_et: Optional[float] = None,
+    ):
+        query_class = type(
+            instrument_class.__name__,
+            (instrument_class,),
+            {"pit_source": staticmethod(lambda: pits), "pit_distance_field_lookups": False},
+        )
+        self.instrument: Instrument = query_class(start_et=start_et, stop_et=stop_et)
+        self.sweep_iterator = self.instrument.sweep_iterator
+        self.cross_track_distance = (
+            self.instrument.rough_treshold + PIT_QUERY_CROSS_TRACK_MARGIN if cross_track_distance is None else cross_track_distance
+        )
+        self.cadence = cadence
+        self.pass_margin = pass_margin
+        self.start_et, self.stop_et = start_et, stop_et
+
+    @classmethod
+    def from_names(cls, names: Iterable[str], instrument_class: Type[Instrument] = DIVINERInstrument, **kwargs) -> "PitVisibilityQuery":
+        """Query of pits from pit_source of the instrument (the atlas by default) by their names"""
+        return cls(instrument_class.pit_source().loc[list(names)], instrument_class, **kwargs)
+
+    def _interval(self, start_et: Optional[float], stop_et: Optional[float]) -> Tuple[float, float]:
+        """Defaults to the interval of the query, the interval a sweep of the instrument would cover without it"""
+        start_et = self.start_et if start_et is None else start_et
+        stop_et = self.stop_et if stop_et is None else stop_et
+        start_et = self.instrument.current_simulation_timestamp_et if start_et is None else start_et
+        return start_et, self.instrument.max_time if stop_et is None else stop_et
+
+    def sample_ground_track(self, start_et: float, stop_et: float) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Epochs every `cadence` seconds within coverage of dynamic kernels between `start_et` and `stop_et` and unit
+        vectors of sub-spacecraft points at them (NaN where the SPK is missing). Only SPK kernels are refreshed, once
+        per chunk of epochs between their starts
+        """
+        ets = np.concatenate(
+            [np.empty(0)]
+            + [
+                np.append(np.arange(interval_start, interval_stop, self.cadence), interval_stop)
+                for interval_start, interval_stop in np.clip(self.sweep_iterator.coverage.intervals, start_et, stop_et)
+                if interval_start < interval_stop
+            ]
+        )
+        spk_loaders = [loader for loader in self.sweep_iterator.dynamic_kernels if loader.resource == "spk"]
+        kernel_starts = np.unique([kernel.time_start for loader in spk_loaders for kernel in loader.kernel_pool])
+        directions = np.full((len(ets), 3), np.nan)
+        chunks = [chunk for chunk in np.split(np.arange(len(ets)), np.searchsorted(ets, kernel_starts)) if len(chunk)]
+        for chunk in tqdm(chunks, ncols=TQDM_NCOLS, desc="Sampling ground track", disable=len(chunks) < 2):
+            for loader in spk_loaders:
+                loader.refresh_SPICE_for_given_time(float(ets[chunk[0]]))
+            positions = self.instrument.spacecraft_positions_batch(ets[chunk])
+            directions[chunk] = positions / np.linalg.norm(positions, axis=1)[:, None]
+        return ets, directions
+
+    def passes(self, start_et: Optional[float] = None, stop_et: Optional[float] = None) -> Dict[str, np.ndarray]:
+        """(K, 2) intervals (ET) of passes over each queried pit by its name, extended by the pass margin"""
+        start_et, stop_et = self._interval(start_et, stop_et)
+        with self.instrument.metrics.stage("ground_track"):
+            ets, directions = self.sample_ground_track(start_et, stop_et)
+            directions = extrapolate_missing_samples(ets, directions, 1.5 * self.cadence)
+            catalog = self.instrument.pit_catalog
+            targets, radius = np.asarray(catalog.unit_vectors), self.instrument.moon_radii.mean()
+            # Arcs between samples across coverage gaps don't follow the ground track
+            near = (np.diff(ets) <= 1.5 * self.cadence)[:, None] & np.ones(len(targets), dtype=bool)
+            for block_start in range(0, len(near), GROUND_TRACK_BLOCK_SIZE):
+                block = slice(block_start, min(block_start + GROUND_TRACK_BLOCK_SIZE, len(near)))
+                distances = ground_track_distances(directions[block.start : block.stop + 1], targets, radius)
+                near[block] &= distances < self.cross_track_distance
+        passes = {}
+        for target_id, name in enumerate(catalog.names):
+            arcs = np.flatnonzero(near[:, target_id])
+            intervals = merge_intervals(np.column_stack([ets[arcs] - self.pass_margin, ets[arcs + 1] + self.pass_margin]))
+            passes[str(name)] = np.clip(intervals, start_et, stop_et)
+        return passes
+
+    def run(self, start_et: Optional[float] = None, stop_et: Optional[float] = None, show_progress: bool = True) -> List[Dict]:
+        """Documents of the instrument for the queried pits (see Instrument.sweep), swept only over their passes"""
+        passes = self.passes(start_et, stop_et)
+        intervals = merge_intervals(np.concatenate(list(passes.values())))
+        logger.info(
+            "%d passes over %d pits, sweeping %.1f hours",
+            sum(len(pit_passes) for pit_passes in passes.values()),
+            len(passes),
+            (intervals[:, 1] - intervals[:, 0]).sum() / 3600,
+        )
+        documents = []
+        for interval_start, interval_stop in tqdm(intervals, ncols=TQDM_NCOLS, desc="Sweeping passes", disable=not show_progress):
+            # Passes are not contiguous, each of them is swept from the start (see Instrument._set_time)
+            for batch in self.instrument.sweep(start_et=float(interval_start), stop_et=float(interval_stop), show_progress=False):
+                documents.extend(batch)
+        return sorted(documents, key=lambda document: document["et"])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Find when DIVINER saw given pits, sweeping only passes over them")
+    parser.add_argument("--pits", nargs="+", required=True, help="Names of pits in the atlas")
+    parser.add_argument("--start", default=None, help="UTC start of the query, the start of loaded kernels by default")
+    parser.add_argument("--stop", default=None, help="UTC stop of the query, the end of loaded kernels by default")
+    parser.add_argument("--cross-track-distance", type=float, default=None, help="Distance (km) of the ground track from a pit")
+    parser.add_argument("--cadence", type=float, default=PIT_QUERY_CADENCE, help="Sampling cadence (s) of the ground track")
+    args = parser.parse_args()
+
+    # Leap seconds are needed to parse the interval before the query furnishes static kernels planned for it
+    for leapseconds in glob.glob(os.path.join(DIVINERInstrument.sweep_iterator_class.destination, "lsk", "*.tls")):
+        spice.furnsh(leapseconds)
+    start_et = None if args.start is None else spice.str2et(args.start)
+    stop_et = None if args.stop is None else spice.str2et(args.stop)
+    query = PitVisibilityQuery.from_names(
+        args.pits, cross_track_distance=args.cross_track_distance, cadence=args.cadence, start_et=start_et, stop_et=stop_et
+    )
+    for document in query.run():
+        print(json.dumps(document, default=str))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
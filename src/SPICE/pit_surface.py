@@ -0,0 +1,80 @@
+"""
+Cartesian coordinates of points of interest on the detailed model of the Moon
+
+Points are found as DSK intercepts of rays from far above the surface towards the centre of the Moon, all of them in
+a single dskxv call. Results are stored as NumPy files keyed by the DSK (name, size, mtime) and the coordinates of
+points, so each catalogue is intersected once per DSK and later sweeps, shards and workers only load them.
+"""
+import os
+import sys
+import hashlib
+import logging
+
+sys.path.insert(0, "/".join(__file__.split("/")[:-3]))
+
+import numpy as np
+import spiceypy as spice
+
+from src.SPICE.config import PIT_SURFACE_DESTINATION
+
+logger = logging.getLogger(__name__)
+
+# Rays start this far (km) from the centre of the Moon, intercepts can't be computed from within the surface
+RAY_VERTEX_DISTANCE = 10_000
+
+
+def surface_key(dsk_path: str, latitudes: np.ndarray, longitudes: np.ndarray) -> str:
+    dsk_stat = os.stat(dsk_path)
+    key = hashlib.sha1(f"{os.path.basename(dsk_path)}:{dsk_stat.st_size}:{dsk_stat.st_mtime_ns}".encode())
+    key.update(np.ascontiguousarray(latitudes, dtype=np.float64).tobytes())
+    key.update(np.ascontiguousarray(longitudes, dtype=np.float64).tobytes())
+    return key.hexdigest()
+
+
+def intersect_surface(dsk_path: str, latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+    """
+    (N, 3) surface points at planetocentric latitudes and longitudes (radians) in the frame of the first segment of
+    the DSK, NaN where the ray misses. The DSK has to be furnished, intercepts are searched in all of its segments
+    with the surface and centre body of the first one
+    """
+    dsk_handle = spice.dasopr(dsk_path)
+    try:
+        descriptor = spice.dskgd(dsk_handle, spice.dlabfs(dsk_handle))
+    finally:
+        spice.dascls(dsk_handle)
+
+    directions = np.column_stack([np.cos(latitudes) * np.cos(longitudes), np.cos(latitudes) * np.sin(longitudes), np.sin(latitudes)])
+    points = np.full((len(directions), 3), np.nan)
+    if not len(directions):
+        return points
+    intercepts, found = spice.dskxv(
+        False,
+        spice.bodc2n(descriptor.center),
+        [descriptor.surfce],
+        0.0,
+        spice.frmnam(descriptor.frmcde),
+        np.ascontiguousarray(directions * RAY_VERTEX_DISTANCE),
+        np.ascontiguousarray(-directions),
+    )
+    found = np.asarray(found, dtype=bool)
+    points[found] = np.asarray(intercepts)[found]
+    return points
+
+
+def pit_surface_points(dsk_path: str, latitudes: np.ndarray, longitudes: np.ndarray, destination: str = PIT_SURFACE_DESTINATION) -> np.ndarray:
+    """(N, 3) surface points of points of interest at latitudes and longitudes (degrees), computed once per DSK"""
+    latitudes, longitudes = np.radians(np.asarray(latitudes, dtype=float)), np.radians(np.asarray(longitudes, dtype=float))
+    path = os.path.join(destination, surface_key(dsk_path, latitudes, longitudes) + ".npy")
+    if os.path.exists(path):
+        return np.load(path)
+
+    points = intersect_surface(dsk_path, latitudes, longitudes)
+    for lat, lon in zip(latitudes[np.isnan(points).any(axis=1)], longitudes[np.isnan(points).any(axis=1)]):
+        logger.warning(f"No surface intercept found for lat: {lat}, lon: {lon}")
+    os.makedirs(destination, exist_ok=True)
+    # Written under a temporary name first, concurrent processes may compute the same points
+    with open(temporary_path := f"{path}.{os.getpid()}", "wb") as f:
+        np.save(f, points)
+    os.replace(temporary_path, path)
+    logger.info("Surface points of %d points of interest stored in %s", len(points), path)
+    return points
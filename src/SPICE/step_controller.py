@@ -0,0 +1,197 @@
+"""
+Adaptive timestep controller deriving the boresight footprint ground speed from the spacecraft state
+"""
+import sys
+import logging
+from functools import lru_cache
+from typing import Dict, List, NamedTuple, Optional
+
+sys.path.insert(0, "/".join(__file__.split("/")[:-3]))
+
+import numpy as np
+import spiceypy as spice
+
+from src.SPICE.config import (
+    MOON_STR_ID,
+    MOON_REF_FRAME_STR_ID,
+    TIME_STEP,
+    MAX_TIME_STEP,
+    STEP_SPEED_SAFETY_FACTOR,
+    MIN_EMISSION_COSINE,
+    MAX_SPACECRAFT_ANGULAR_RATE,
+    STEP_CHECK_CADENCE,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=16)
+def spacecraft_state(satellite: str, et: float) -> np.ndarray:
+    """State of the spacecraft w.r.t. the Moon in the lunar body-fixed frame, cached so instruments swept together share it"""
+    state, _ = spice.spkezr(satellite, et, MOON_REF_FRAME_STR_ID, "NONE", MOON_STR_ID)
+    state = np.array(state)
+    state.setflags(write=False)
+    return state
+
+
+class SkipInterval(NamedTuple):
+    # Interval (et_start, et_stop) no epoch was evaluated in
+    et_start: float
+    et_stop: float
+    # Lower bound of distance to the closest point of interest at et_start
+    distance: float
+    # Footprint ground speed bound (km/s) assumed for the whole interval
+    speed_bound: float
+
+
+class StepController:
+    """
+    Chooses the largest timestep which can not skip a point of interest within the treshold
+
+    The footprint of the boresight moves because of spacecraft motion (SPK velocity) and attitude changes
+    (CK angular rate). Its worst case ground speed is bounded from the SPK velocity and the range of the footprint,
+    assuming the attitude rotates at MAX_SPACECRAFT_ANGULAR_RATE (the slew limit) in the worst direction, so a slew
+    which starts and stops within a step is covered by the bound. The step is chosen so that the footprint can not
+    travel further than (distance - treshold) during it.
+
+    The range and the emission angle the bound is derived from change during the step. Once the next footprint is
+    known, the bound is verified at its end, every STEP_CHECK_CADENCE seconds within the step (at ellipsoid
+    intercepts) and against the average speed along the chord between both footprints. If any of them exceeds the
+    bound (or the attitude rotated faster than the slew limit), the step is rejected and retaken shorter from its
+    beginning.
+
+    Accepted steps longer than TIME_STEP are recorded as skip intervals, so the coverage can be audited
+    """
+
+    def __init__(self, instrument):
+        self.instrument = instrument
+        self.skip_intervals: List[SkipInterval] = []
+        self.rejected_steps_cnt = 0
+        # Last epoch with evaluated footprint - the beginning of currently pending step
+        self._last_et: Optional[float] = None
+        self._last_point: Optional[np.ndarray] = None
+        self._last_distance: Optional[float] = None
+        self._last_speed_bound: Optional[float] = None
+
+    @property
+    def last_et(self) -> Optional[float]:
+        return self._last_et
+
+    def reset(self):
+        """Forgets the pending step, e.g. when the simulation clock is set"""
+        self._last_et = self._last_point = self._last_distance = self._last_speed_bound = None
+
+    def state(self) -> Dict:
+        """Pending step as a plain dictionary, so it could be checkpointed"""
+        return {
+            "last_et": self._last_et,
+            "last_point": None if self._last_point is None else list(map(float, self._last_point)),
+            "last_distance": self._last_distance,
+            "last_speed_bound": self._last_speed_bound,
+        }
+
+    def restore(self, state: Dict):
+        self._last_et, self._last_distance, self._last_speed_bound = (
+            state["last_et"],
+            state["last_distance"],
+            state["last_speed_bound"],
+        )
+        self._last_point = None if state["last_point"] is None else np.array(state["last_point"])
+
+    def footprint_speed(self, et: float, point: np.ndarray, worst_case: bool = False) -> float:
+        """
+        Ground speed (km/s) of the boresight footprint located at `point` (body-fixed, km) at given epoch. With
+        `worst_case`, an upper bound of the speed for any attitude rotation within MAX_SPACECRAFT_ANGULAR_RATE
+        """
+        with self.instrument.metrics.stage("sxform"):
+            if (geometry_cache := self.instrument.geometry_cache) is not None:
+                (state,), (rotation,), (rotation_rate,) = geometry_cache.evaluate([et], rates=True)
+            else:
+                state = spacecraft_state(self.instrument.satellite_frame, et)
+                xform = spice.sxform(self.instrument.uniform_sub_instrument_frame, MOON_REF_FRAME_STR_ID, et)
+                rotation, rotation_rate = xform[:3, :3], xform[3:, :3]
+
+        boresight = self.instrument.boresight / np.linalg.norm(self.instrument.boresight)
+        direction = rotation @ boresight
+        direction_rate = rotation_rate @ boresight
+        spacecraft_position, spacecraft_velocity = state[:3], state[3:]
+
+        # Velocity of the point on the ray at the footprint range
+        footprint_range = np.linalg.norm(point - spacecraft_position)
+        ray_velocity = spacecraft_velocity + footprint_range * direction_rate
+        # Project it along the ray onto the local (spherical) horizontal plane at the footprint
+        normal = point / np.linalg.norm(point)
+        emission_cosine = -np.dot(direction, normal)
+        if emission_cosine < MIN_EMISSION_COSINE:
+            return np.inf
+
+        def ground_speed(velocity: np.ndarray) -> float:
+            return np.linalg.norm(velocity + np.dot(velocity, normal) / emission_cosine * direction)
+
+        speed = ground_speed(ray_velocity)
+        if not worst_case:
+            return speed
+        # The projection stretches velocities at most 1 / emission_cosine times, whatever direction the slew takes
+        angular_rate = max(MAX_SPACECRAFT_ANGULAR_RATE, np.linalg.norm(direction_rate))
+        return max(speed, ground_speed(spacecraft_velocity) + footprint_range * angular_rate / emission_cosine)
+
+    def _within_step_speeds(self, et: float) -> List[float]:
+        """Worst case footprint speeds every STEP_CHECK_CADENCE seconds within the pending step ending in `et`"""
+        substeps = int(np.ceil((et - self._last_et) / STEP_CHECK_CADENCE))
+        ets = np.linspace(self._last_et, et, substeps + 1)[1:-1]
+        if not len(ets):
+            return []
+        points, found, _, _ = self.instrument.compute_views_instrument_boresight_coarse(ets)
+        speeds = []
+        for substep_et, point, point_found in zip(ets, points, found):
+            try:
+                speeds.append(self.footprint_speed(float(substep_et), point, worst_case=True) if point_found else np.inf)
+            except spice.SpiceyError:
+                speeds.append(np.inf)
+        return speeds
+
+    def accept(self, et: float, point: np.ndarray, record: bool = True) -> bool:
+        """
+        Validates the pending step ending in `et` with footprint `point`
+
+        Returns False when the footprint moved faster than assumed. The controller then expects the clock to be
+        set back to `last_et` and the (shorter) step from `next_step` to be taken again. Without `record`, an
+        accepted step is not recorded as a skip interval until `record_step` is called, e.g. once all instruments
+        swept together accepted it
+        """
+        if self._last_et is None or et - self._last_et <= TIME_STEP:
+            return True
+
+        step = et - self._last_et
+        speed = max([self.footprint_speed(et, point, worst_case=True)] + self._within_step_speeds(et))
+        average_speed = np.linalg.norm(point - self._last_point) / step
+        if max(speed, average_speed) <= self._last_speed_bound:
+            if record:
+                self.record_step(et)
+            return True
+
+        self.rejected_steps_cnt += 1
+        self._last_speed_bound = STEP_SPEED_SAFETY_FACTOR * max(speed, average_speed, self._last_speed_bound)
+        logger.debug("Step %.1f s from %.3f rejected, new speed bound %.3f km/s", step, self._last_et, self._last_speed_bound)
+        return False
+
+    def record_step(self, et: float):
+        """Records the accepted pending step ending in `et` as a skip interval"""
+        if self._last_et is not None and et - self._last_et > TIME_STEP:
+            self.skip_intervals.append(SkipInterval(self._last_et, et, self._last_distance, self._last_speed_bound))
+
+    def next_step(self, et: Optional[float] = None, point: Optional[np.ndarray] = None, distance: float = np.inf) -> float:
+        """
+        The largest safe step from an epoch with footprint `point` and given distance lower bound to the closest
+        point of interest. Without arguments, returns the step to retake after a rejection
+        """
+        if et is not None:
+            self._last_et, self._last_point, self._last_distance = et, point, distance
+            margin = distance - self.instrument.rough_treshold
+            if margin <= 0:
+                self._last_speed_bound = np.inf
+                return TIME_STEP
+            self._last_speed_bound = STEP_SPEED_SAFETY_FACTOR * self.footprint_speed(et, point, worst_case=True)
+
+        margin = self._last_distance - self.instrument.rough_treshold
+        return min(max(TIME_STEP, margin / self._last_speed_bound), MAX_TIME_STEP)
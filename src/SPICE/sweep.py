@@ -1,77 +1,55 @@
 """
-This script processes SPICE data to identify time intervals when LRO DIVINER
-is within areas of interest.
+This script processes SPICE data to identify time intervals when LRO instruments
+are within areas of interest, sweeping all of them in a single pass.
 """
 import logging
 import sys
-from typing import Optional
+from typing import Dict, Iterator, List, Optional, Sequence, Type
 
 sys.path.insert(0, "/".join(__file__.split("/")[:-3]))
 
 import numpy as np
-from astropy.time import Time, TimeDelta
-import spiceypy as spice
 from tqdm import tqdm
-from scipy.spatial import cKDTree
 
 from src.global_config import TQDM_NCOLS
 from src.SPICE.instruments import DIVINERInstrument
-from src.SPICE.config import TIME_STEP, MOON_STR_ID, LRO_SPEED, MAX_TIME_STEP
+from src.SPICE.instruments.base_instrument import Instrument, HandledExpeption, attach_utc_timestamps
+from src.SPICE.config import TIME_STEP, SIMULATION_BATCH_SIZE, SIMULATION_FLUSH_SIZE, SWEEP_METRICS_PROMETHEUS_PORT
+from src.SPICE.sweep_metrics import SweepMetrics, start_prometheus_exporter
 from src.db.mongo.interface import Sessions
-from src.SPICE.sweep_iterator import SweepIterator
+from src.db.mongo.background_writer import BackgroundWriter
 
 logger = logging.getLogger(__name__)
 
 
 class Sweeper:
     """
-    Iterates through SPICE data to update instrument distances to areas of interest,
-    adjusts simulation timesteps, and records detections (points of interest) into MongoDB.
-
-    For each simulation step:
-      1. It projects the instrument’s boresight to get a first set of feasible target points.
-      2. It then computes sub-instrument boresight projections and uses these to compute distances
-         from each sub-instrument to the feasible points.
-      3. If any sub-instrument yields a minimum distance below a defined (finer) threshold,
-         the detection is recorded (with instrument name, simulation ET, best distance, and sub-instrument ID).
-         
-    """
-
-    def __init__(self):
-        self.sweep_iterator = SweepIterator()
-        self.computation_timedelta = TimeDelta(TIME_STEP, format="sec")
-        self.current_simulation_timestamp = self.sweep_iterator.min_loaded_time + self.computation_timedelta
-        self.current_simulation_timestamp_et = spice.str2et(self.current_simulation_timestamp.utc.iso)
-        self.current_simulation_step = 0
+    Sweeps several instruments of the spacecraft with one shared simulation clock.
 
-        # Load instruments
-        self.instruments = [DIVINERInstrument()]
+    The first instrument furnishes the kernels and loads points of interest, the others share them (see
+    Instrument.__init__). For each evaluated epoch (or dense block of epochs near points of interest):
+      1. Dynamic kernels are refreshed and the spacecraft position is computed once for all instruments.
+      2. Each instrument projects its boresight with its own attitude and finds the closest point of interest
+         in the shared KD-Tree, keeping its own tresholds, step controller and overflight windows.
+      3. The shared timestep is the shortest of timesteps the instruments adjusted to.
 
-        # Get points of interest and build a KD-Tree for fast spatial searches
-        self._load_target_points()
-
-        # Set simulation start time considering instrument offset
-        offset = max(instrument.offset_days for instrument in self.instruments)
-        self._set_time(self.sweep_iterator.min_loaded_time + TimeDelta(offset, format="jd"))
-        self.sweep_iterator.initiate_sweep(self.current_simulation_timestamp)
+    Each instrument stores its results into its own collection.
+    """
 
-        # Tracking lists
-        self._found_timestamps, self._found_timestamps_cnt = [], 0
-        self._boresight_projections = []
-        self._failed_timestamps, self._failed_timestamps_cnt = [], 0
-        self.adjusted_timesteps = []
-        self.min_distances = []
+    def __init__(self, instrument_classes: Sequence[Type[Instrument]] = (DIVINERInstrument,)):
+        first, *others = instrument_classes
+        self.instruments: List[Instrument] = [first()]
+        self.instruments += [instrument_class(shared_from=self.instruments[0]) for instrument_class in others]
+        self.sweep_iterator = self.instruments[0].sweep_iterator
+        # Stages and failures of the shared clock, instruments keep their own metrics
+        self.metrics = SweepMetrics("+".join(instrument.name for instrument in self.instruments))
 
-    @property
-    def data(self):
-        return {
-            "found": self._found_timestamps,
-            "failed": self._failed_timestamps,
-            "adjusted_timesteps": self.adjusted_timesteps,
-            "min_distances": self.min_distances,
-            "boresight_projections": self._boresight_projections,
-        }
+        # Each instrument sets its clock considering its offset, the sweep starts once all of them can
+        self.computation_timestep = TIME_STEP
+        self._set_time(max(instrument.current_simulation_timestamp_et for instrument in self.instruments))
+        self.sweep_iterator.initiate_sweep(self.current_simulation_timestamp_et)
 
+        self._failed_timestamps_cnt = 0
 
     @property
     def min_time(self):
@@ -81,104 +59,185 @@ class Sweeper:
     def max_time(self):
         return self.sweep_iterator.max_loaded_time
 
-    def _load_target_points(self):
-        """Fetches crater points and converts lat/lon to Cartesian coordinates."""
-        points = Sessions.get_all_pits_points()
-        lat_rad = np.radians(points["latitude"])
-        lon_rad = np.radians(points["longitude"])
-
-        moon_id = spice.bodn2c(MOON_STR_ID)
-        cartesian_points = np.array([spice.srfrec(moon_id, lon, lat) for lat, lon in zip(lat_rad, lon_rad)])
-
-        points["X"], points["Y"], points["Z"] = cartesian_points.T
-        self._target_points = points[["X", "Y", "Z"]].values
-        self._target_ids = np.arange(len(self._target_points))
-        self.kd_tree = cKDTree(self._target_points)
+    @property
+    def _widest_instrument(self) -> Instrument:
+        return max(self.instruments, key=lambda instrument: instrument.rough_treshold)
 
     def _step_time(self):
-        self.current_simulation_timestamp += self.computation_timedelta
-        self.current_simulation_timestamp_et = spice.str2et(self.current_simulation_timestamp.utc.iso)
+        et = self.current_simulation_timestamp_et + self.computation_timestep
+        # Instruments restart their timesteps after a coverage gap, so the shared one has to as well
+        covered_et = max(instrument._skip_coverage_gap(et) for instrument in self.instruments)
+        if covered_et != et:
+            self.computation_timestep = TIME_STEP
+        self.current_simulation_timestamp_et = covered_et
         self.current_simulation_step += 1
-        self.sweep_iterator.step(self.current_simulation_timestamp)
+        self.instruments[0]._refresh_kernels(self.current_simulation_timestamp_et)
+        for instrument in self.instruments:
+            instrument.current_simulation_timestamp_et = self.current_simulation_timestamp_et
 
-    def _set_time(self, time: Time, timestep: Optional[int] = None):
-        self.current_simulation_timestamp = time
-        self.current_simulation_timestamp_et = spice.str2et(time.utc.iso)
+    def _set_time(self, et: float, timestep: Optional[int] = None):
+        self.current_simulation_timestamp_et = et
         self.current_simulation_step = 0 if timestep is None else timestep
-        self.sweep_iterator.step(self.current_simulation_timestamp)
+        for instrument in self.instruments:
+            instrument._set_time(et, timestep)
 
-    def compute_distances_from_projected_vector(self, points, boresight):
+    def _accept_step(self, et: float, projections: Dict[Instrument, tuple]) -> bool:
         """
-        Compute distances from the instrument's boresight to given points.
+        Validates the step leading to `et` for all state aware instruments. The step is recorded as a skip interval
+        only once all of them accept it. If any of them rejects it, the clock is rewound to the beginning of the step
+        and the shortened step is retaken by all instruments
         """
-        return np.linalg.norm(points - boresight, axis=1)
-
-    def find_nearby_pits(self, instrument):
+        validated = {
+            instrument: instrument.step_controller.accept(et, boresights[0], record=False)
+            for instrument, (boresights, found, _) in projections.items()
+            if instrument.state_aware_timestep and found[0]
+        }
+        rejected = [instrument for instrument, accepted in validated.items() if not accepted]
+        if not rejected:
+            for instrument in validated:
+                instrument.step_controller.record_step(et)
+            return True
+        self.current_simulation_timestamp_et = max(instrument.step_controller.last_et for instrument in rejected)
+        self.computation_timestep = min(
+            [self.computation_timestep] + [instrument.step_controller.next_step() for instrument in rejected]
+        )
+        # Pending steps beginning elsewhere than the retaken one are forgotten, by all instruments
+        for instrument in self.instruments:
+            if instrument.step_controller.last_et != self.current_simulation_timestamp_et:
+                instrument.step_controller.reset()
+        return False
+
+    def simulation_step_inference(self, ets: np.ndarray):
+        """Projects epochs in `ets` for all instruments, their hits are recorded into their hit buffers"""
+        # Make sure kernels covering the end of the block are furnished as well
+        self.instruments[0]._refresh_kernels(ets[-1])
+        # The spacecraft is shared, so is its position
+        positions = self.instruments[0].spacecraft_positions_batch(ets)
+
+        projections = {}
+        for instrument in self.instruments:
+            try:
+                projections[instrument] = instrument.compute_views_instrument_boresight_batch(ets, positions)
+            except Exception as e:
+                instrument._failed_timestamps_cnt += len(ets)
+                instrument.metrics.count_exception("failed", e)
+
+        if len(ets) == 1 and not self._accept_step(float(ets[0]), projections):
+            return
+
+        self.current_simulation_timestamp_et = float(ets[-1])
+        self.current_simulation_step += len(ets) - 1
+        for instrument, (boresights, found, min_distances) in projections.items():
+            instrument.current_simulation_timestamp_et = self.current_simulation_timestamp_et
+            instrument.current_simulation_step = self.current_simulation_step
+            try:
+                instrument.record_batch_inference(ets, boresights, found, min_distances, positions)
+            except HandledExpeption as e:
+                instrument.metrics.count_exception("failed", e)
+        self.computation_timestep = min(instrument.computation_timestep for instrument in self.instruments)
+
+    def sweep(
+        self,
+        max_steps: Optional[int] = None,
+        batch_size: Optional[int] = SIMULATION_BATCH_SIZE,
+        stop_et: Optional[float] = None,
+        show_progress: bool = True,
+    ) -> Iterator[Dict[str, List[Dict]]]:
         """
-        Uses the KD-Tree to find pits within the instrument's rough detection threshold.
+        Sweep through the time interval with all instruments, yields batches of their results by instrument name
 
-        Returns:
-        - nearby_points: Points within range
-        - nearby_ids: Corresponding indices
-        - boresight: Current instrument boresight position
+        Mirrors Instrument.sweep - far from points of interest, single epochs are evaluated with the shared adaptive
+        timestep, near them dense blocks long enough for the instrument with the widest treshold
         """
-        intersection = instrument.compute_views_instrument_boresight(self.current_simulation_timestamp_et)
-        boresight = intersection["boresight"]
-        nearby_indices = self.kd_tree.query_ball_point(boresight, instrument.rough_treshold)
-        return self._target_points[nearby_indices], self._target_ids[nearby_indices], boresight
-
-    def adjust_timestep(self, boresights):
-        min_distance = min(self.kd_tree.query(boresight)[0] for boresight in boresights)
-        distance_discount = max([instrument.rough_treshold for instrument in self.instruments])
-        new_time_step = (min_distance - distance_discount) / LRO_SPEED
-        self.computation_timedelta = TimeDelta(min(max(TIME_STEP, new_time_step), MAX_TIME_STEP), format="sec")
-        self.adjusted_timesteps.append(new_time_step)
-        self.min_distances.append(min_distance)
-
-    def run_simulation(self, max_steps: Optional[int] = None):
-        # Prepare misc
-        total_seconds = (self.max_time - self.min_time).to_value("sec")
-        pbar_format_string = ("" if max_steps is None else f"/{max_steps}")
-
-        # Here we store our points of interest to dump them into DB, eventually
-        points_of_interest_batch = []
-
-        # Run the main simulation loop
-        with tqdm(total=total_seconds, ncols=TQDM_NCOLS, desc="Running simulation") as pbar:
-
-            while self.current_simulation_timestamp <= self.max_time:
-            
+        stop_et = self.max_time if stop_et is None else stop_et
+        total_seconds = stop_et - self.current_simulation_timestamp_et
+        pbar_format_string = "" if max_steps is None else f"/{max_steps}"
+
+        batches = {instrument.name: [] for instrument in self.instruments}
+        with tqdm(total=total_seconds, ncols=TQDM_NCOLS, desc="Running simulation", disable=not show_progress) as pbar:
+
+            while self.current_simulation_timestamp_et <= stop_et:
+
                 # TQDM instrumentation
-                pbar.update(self.computation_timedelta.to_value("sec"))
+                last_et = self.current_simulation_timestamp_et
                 if self.current_simulation_step % 256 == 0:
                     step_info = f"Simulation step:{self.current_simulation_step}"
-                    failed_found_info = f"; failed: {len(self._failed_timestamps)}; found: {len(self._found_timestamps)}"
-                    pbar.set_description(step_info + pbar_format_string + failed_found_info)
+                    found_info = "".join(
+                        f"; {instrument.name}: {instrument._found_timestamps_cnt}" for instrument in self.instruments
+                    )
+                    pbar.set_description(step_info + pbar_format_string + f"; failed: {self._failed_timestamps_cnt}" + found_info)
 
                 # Check if we reached the maximum number of steps
                 if max_steps is not None and self.current_simulation_step >= max_steps:
                     break
 
                 try:
-                    # Perform the simulation step
                     self._step_time()
-
-                    # Compute projection of boresight for each instrument
-                    for instrument in self.instruments:
-                        # Projects to the lunar surface and looks for closest points (may be empty)
-                        feasible_points, _, boresight = self.find_nearby_pits(instrument)
-                        new_distances = self.compute_distances_from_projected_vector(feasible_points, boresight)
-                        
-                        
-                        if any(new_distances < instrument.rough_treshold):
-                            self._found_timestamps.append((boresight, self.current_simulation_timestamp, self.current_simulation_step))
-                            self._found_timestamps_cnt += 1
-                            #logging.info("Found!")
-                    self.adjust_timestep(boresights)
+                    if batch_size is None or self.computation_timestep > TIME_STEP:
+                        self.simulation_step_inference(np.array([self.current_simulation_timestamp_et]))
+                    elif len(ets := self._widest_instrument._next_batch_ets(batch_size, stop_et)):
+                        self.simulation_step_inference(ets)
                 except Exception as e:
-                    # logger.exception(
-                    #     f"Error at step {self.current_simulation_step}: {e}"
-                    # )
-                    self._failed_timestamps.append((self.current_simulation_timestamp, self.current_simulation_step))
                     self._failed_timestamps_cnt += 1
-        return
+                    self.metrics.count_exception("failed", e)
+                pbar.update(self.current_simulation_timestamp_et - last_et)
+
+                for instrument in self.instruments:
+                    if instrument.overflight_windows:
+                        batches[instrument.name].extend(instrument._overflight_documents(instrument.window_finder.pop_closed()))
+
+                if any(len(batches[instrument.name]) + len(instrument.hits) > SIMULATION_FLUSH_SIZE for instrument in self.instruments):
+                    yield self._attach_utc_timestamps(batches)
+                    batches = {instrument.name: [] for instrument in self.instruments}
+
+                if self.metrics.due():
+                    self.log_metrics()
+
+            for instrument in self.instruments:
+                if instrument.overflight_windows:
+                    instrument.window_finder.finalize()
+                    batches[instrument.name].extend(instrument._overflight_documents(instrument.window_finder.pop_closed()))
+            if any(batches.values()) or any(len(instrument.hits) for instrument in self.instruments):
+                yield self._attach_utc_timestamps(batches)
+            self.log_metrics()
+
+    def log_metrics(self):
+        """Logs JSON line snapshots of the shared clock and of all instruments"""
+        self.metrics.log(et=self.current_simulation_timestamp_et, step=self.current_simulation_step, failed=self._failed_timestamps_cnt)
+        for instrument in self.instruments:
+            instrument.log_metrics()
+
+    def _attach_utc_timestamps(self, batches: Dict[str, List[Dict]]) -> Dict[str, List[Dict]]:
+        """Converts UTC timestamps of overflight windows and adds documents of buffered hits of each instrument"""
+        et_keys = {"et": "timestamp_utc", "et_enter": "timestamp_utc_enter", "et_exit": "timestamp_utc_exit"}
+        for instrument in self.instruments:
+            with instrument.metrics.stage("time_conversion"):
+                attach_utc_timestamps(batches[instrument.name], et_keys)
+            batches[instrument.name] += instrument._hit_documents()
+        return batches
+
+    def run_simulation(
+        self,
+        max_steps: Optional[int] = None,
+        collection_slug: Optional[str] = None,
+        batch_size: Optional[int] = SIMULATION_BATCH_SIZE,
+    ):
+        """Sweep through the loaded time interval, results of each instrument are stored into its own collection"""
+        if SWEEP_METRICS_PROMETHEUS_PORT is not None:
+            start_prometheus_exporter(SWEEP_METRICS_PROMETHEUS_PORT)
+        collections = {
+            instrument.name: Sessions._prepare_simulation_collection(
+                instrument.name if collection_slug is None else f"{instrument.name}_{collection_slug}"
+            )
+            for instrument in self.instruments
+        }
+        with BackgroundWriter() as writer:
+            for batches in self.sweep(max_steps=max_steps, batch_size=batch_size):
+                for instrument in [instrument for instrument in self.instruments if batches[instrument.name]]:
+                    with self.metrics.stage("writer_backpressure"):
+                        writer.submit(
+                            Sessions.insert_simulation_results,
+                            batches[instrument.name],
+                            collections[instrument.name],
+                            timer=instrument.metrics.stage("mongo_insert"),
+                        )
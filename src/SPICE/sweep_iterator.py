@@ -5,10 +5,12 @@ intervals LRO DIVINER is within area of interests
 
 import os
 import logging
+import hashlib
 import sys
+from typing import Dict, List, Optional
 
 sys.path.insert(0, "/".join(__file__.split("/")[:-3]))
-from astropy.time import Time
+import numpy as np
 import spiceypy as spice
 from tqdm import tqdm
 
@@ -17,70 +19,147 @@ from src.SPICE.config import (
     DESTINATION,
     LONE_KERNELS,
     LUNAR_MODEL,
+    META_KERNEL_DESTINATION,
 )
-from src.db.mongo.interface import Sessions
 from src.SPICE.kernels.dynamic_kernel_loader import DynamicKernelLoader
+from src.SPICE.kernels.coverage import CoverageMap
+from src.SPICE.kernels.kernel_planner import KernelPlanner
 
 from src.global_config import TQDM_NCOLS
 
 logger = logging.getLogger(__name__)
 
-points = Sessions.get_all_pits_points()
-
 
 class SweepIterator:
     """
     This SweepIterator ensures we have correct SPICE files loaded for given datetime
     """
 
+    # Root of the kernel archive (see fetch.py for its layout), kernels outside of it and the detailed model of the Moon
+    destination = DESTINATION
+    lone_kernels = LONE_KERNELS
+    dsk_path = LUNAR_MODEL["dsk_path"]
+    # Static kernels by folder (None is the root of the archive) and suffix, dynamic kernels in them are skipped when
+    # static kernels are loaded lazily
+    static_kernel_folders = [
+        ("sclk", ".tsc"),
+        ("spk", ".bsp"),
+        ("ik", ".ti"),
+        ("fk", ".tf"),
+        ("lsk", ".tls"),
+        ("pck", ".bpc"),
+        (None, ".bpc"),
+        (None, ".bsp"),
+        (None, ".dsk"),
+    ]
+    # Only static kernels required by the sweep are furnished, from a meta-kernel generated by KernelPlanner
+    lazy_static_kernels = True
+    meta_kernel_destination = META_KERNEL_DESTINATION
+    # NAIF IDs of bodies static SPKs are planned for, None plans SPKs of any body covering the sweep
+    required_bodies: Optional[List[int]] = None
+    # Coverage of dynamic kernels is read from the kernels (ckcov/spkcov) instead of their labels, slower but it
+    # finds gaps within kernels as well
+    coverage_from_kernels = False
+
     @property
-    def min_loaded_time(self) -> Time:
+    def min_loaded_time(self) -> float:
         return max([kernel.min_loaded_time for kernel in self.dynamic_kernels])
 
     @property
-    def max_loaded_time(self) -> Time:
+    def max_loaded_time(self) -> float:
         return min([kernel.max_loaded_time for kernel in self.dynamic_kernels])
 
-    def __init__(self):
-        """Loads all SPICE metadata"""
-        # Load larger dynamically loaded SPICE kernels
-        self.dynamic_kernels = [
-            DynamicKernelLoader("ck/lrodv", "ck", startswith="lrodv"),  # Radiometer position
-            DynamicKernelLoader("ck/lrosc", "ck", startswith="lrosc"),  # LRO position (probably)
-            DynamicKernelLoader("spk", "spk"),
-        ]
-
+    def __init__(self, start_et: Optional[float] = None, stop_et: Optional[float] = None):
+        """
+        Loads all SPICE metadata. With `lazy_static_kernels`, only static kernels required between `start_et` and
+        `stop_et` (coverage of dynamic kernels by default) are furnished
+        """
         # Load smaller static SPICE kernels
         def compose_kernel_path(folder, suffix: str):
-            file_path = os.path.join(DESTINATION, folder) if folder is not None else DESTINATION
+            file_path = os.path.join(self.destination, folder) if folder is not None else self.destination
             return [os.path.join(file_path, kernel) for kernel in os.listdir(file_path) if kernel.endswith(suffix)]
 
-        kernel_args = [
-            ("sclk", ".tsc"),
-            ("spk", ".bsp"),
-            ("ik", ".ti"),
-            ("fk", ".tf"),
-            ("lsk", ".tls"),
-            ("pck", ".bpc"),
-            (None, ".bpc"),  # None means in root of the SPICE kernel folder
-            (None, ".bsp"),
-            (None, ".dsk"),
-        ]
+        kernels = [kernel for args in self.static_kernel_folders for kernel in compose_kernel_path(*args)]
+        kernels += [kernel["path"] for kernel in self.lone_kernels] + [self.dsk_path]
 
-        kernels = [kernel for args in kernel_args for kernel in compose_kernel_path(*args)]
+        if not self.lazy_static_kernels:
+            for kernel in tqdm(kernels, ncols=TQDM_NCOLS, desc="Loading static SPICE kernels"):
+                spice.furnsh(kernel)
+        else:
+            # Leap seconds are needed to parse labels of dynamic kernels
+            leapseconds = compose_kernel_path("lsk", ".tls")
+            for kernel in leapseconds:
+                spice.furnsh(kernel)
 
-        for kernel in tqdm(kernels, ncols=TQDM_NCOLS, desc="Loading static SPICE kernels from folders"):
-            spice.furnsh(kernel)
+        # Load larger dynamically loaded SPICE kernels (parsing their coverage in ET requires LSK loaded above)
+        self.dynamic_kernels = [
+            DynamicKernelLoader("ck/lrodv", "ck", startswith="lrodv", destination=self.destination),  # Radiometer position
+            DynamicKernelLoader("ck/lrosc", "ck", startswith="lrosc", destination=self.destination),  # LRO position (probably)
+            DynamicKernelLoader("spk", "spk", destination=self.destination),
+        ]
 
-        for kernel in tqdm(LONE_KERNELS, ncols=TQDM_NCOLS, desc="Loading lone SPICE kernels from files"):
-            spice.furnsh(kernel["path"])
+        self.meta_kernel = None
+        if self.lazy_static_kernels:
+            dynamic = [kernel.filename for loader in self.dynamic_kernels for kernel in loader.kernel_pool]
+            planner = KernelPlanner(self.destination, kernels, exclude=leapseconds + dynamic)
+            start_et = self.min_loaded_time if start_et is None else start_et
+            stop_et = self.max_loaded_time if stop_et is None else stop_et
+            self.meta_kernel = planner.write_meta_kernel(
+                planner.plan(start_et, stop_et, self.required_bodies),
+                self.meta_kernel_destination,
+                f"Static kernels required from {spice.et2utc(start_et, 'ISOC', 0)} to {spice.et2utc(stop_et, 'ISOC', 0)}",
+            )
+            logger.info("Loading static SPICE kernels from %s", self.meta_kernel)
+            spice.furnsh(self.meta_kernel)
+        # Epochs covered by all dynamic kernels, the sweep jumps over the rest
+        self.coverage = CoverageMap.intersection([loader.coverage(self.coverage_from_kernels) for loader in self.dynamic_kernels])
+        if gaps := self.coverage_gaps():
+            logger.info("Dynamic kernels have %d coverage gaps, %.2f days in total", len(gaps), sum(gap["duration"] for gap in gaps) / spice.spd())
 
-        logging.info("Loading detailed model of the Moon")
-        spice.furnsh(LUNAR_MODEL["dsk_path"])
+    @property
+    def dynamic_kernels_fingerprint(self) -> str:
+        """Hash of names and coverage of all dynamic kernels, changes whenever a kernel is added or replaced"""
+        fingerprint = hashlib.sha1()
+        for loader in self.dynamic_kernels:
+            for kernel in loader.kernel_pool:
+                fingerprint.update(f"{os.path.basename(kernel.filename)}:{kernel.time_start}:{kernel.time_stop}".encode())
+        return fingerprint.hexdigest()
+
+    def kernel_boundaries(self, start_et: float, stop_et: float) -> np.ndarray:
+        """Sorted starts of dynamic kernels within (start_et, stop_et)"""
+        return np.unique(
+            [
+                kernel.time_start
+                for loader in self.dynamic_kernels
+                for kernel in loader.kernel_pool
+                if start_et < kernel.time_start < stop_et
+            ]
+        )
+
+    def kernel_stats(self) -> Dict[str, Dict]:
+        """Loads, unloads, prefetch hits and stall time of each dynamic kernel loader (see DynamicKernelLoader.stats)"""
+        return {loader.name: loader.stats for loader in self.dynamic_kernels}
+
+    def coverage_gaps(self, min_duration: float = 0) -> List[Dict]:
+        """Gaps in coverage of dynamic kernels (between min and max loaded time) at least `min_duration` seconds long"""
+        return [
+            {
+                "et_start": gap_start,
+                "et_stop": gap_stop,
+                "utc_start": spice.et2utc(gap_start, "ISOC", 3),
+                "utc_stop": spice.et2utc(gap_stop, "ISOC", 3),
+                "duration": gap_stop - gap_start,
+            }
+            for gap_start, gap_stop in self.coverage.gaps(self.min_loaded_time, self.max_loaded_time)
+            if gap_stop - gap_start >= min_duration
+        ]
 
-    def step(self, time: Time):
-        return all([kernel.refresh_SPICE_for_given_time(time) for kernel in self.dynamic_kernels])
+    def step(self, et: float):
+        # Epochs in gaps would scan the whole kernel pool of each loader
+        if not self.coverage.covered(et):
+            return False
+        return all([kernel.refresh_SPICE_for_given_time(et) for kernel in self.dynamic_kernels])
 
-    def initiate_sweep(self, starting_datetime: Time) -> None:
-        if not self.step(starting_datetime):
+    def initiate_sweep(self, starting_et: float) -> None:
+        if not self.step(starting_et):
             raise ValueError("Some of dynamic SPICE kernels were not loaded for required time")
@@ -0,0 +1,121 @@
+"""
+Low-overhead stage timers and counters of the sweep hot loop
+
+Each instrument owns SweepMetrics. Stages are timed with reusable perf_counter context managers and counters are
+plain dict increments, so instrumentation costs well under a microsecond per call. Snapshots are logged as JSON lines
+every SWEEP_METRICS_INTERVAL seconds and, when SWEEP_METRICS_PROMETHEUS_PORT is set, exported to Prometheus.
+"""
+import sys
+import json
+import time
+import logging
+from collections import defaultdict
+from typing import Dict, Optional
+
+sys.path.insert(0, "/".join(__file__.split("/")[:-3]))
+from src.SPICE.config import SWEEP_METRICS_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Prometheus metrics are process-wide, created once the exporter is started (see start_prometheus_exporter)
+_prometheus_metrics: Optional[Dict] = None
+
+
+class StageTimer:
+    """Accumulates wall time and number of calls of a stage, reused for every call (stages must not nest in themselves)"""
+
+    __slots__ = ("seconds", "calls", "_start")
+
+    def __init__(self):
+        self.seconds, self.calls, self._start = 0.0, 0, 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds += time.perf_counter() - self._start
+        self.calls += 1
+        return False
+
+
+class SweepMetrics:
+    """
+    Timers of sweep stages (kernel refresh, time conversion, pxform, sincpt, KD-Tree queries, ...) and counters
+    of events (e.g. failed steps by exception type) of one instrument
+    """
+
+    def __init__(self, instrument: str, interval: float = SWEEP_METRICS_INTERVAL):
+        self.instrument = instrument
+        self.interval = interval
+        self.stages: Dict[str, StageTimer] = defaultdict(StageTimer)
+        self.counters: Dict[str, int] = defaultdict(int)
+        self._started = time.monotonic()
+        self._last_log = self._started
+        self._published: Dict[tuple, float] = defaultdict(float)
+
+    def stage(self, name: str) -> StageTimer:
+        """Context manager timing a stage - `with metrics.stage("pxform"): ...`"""
+        return self.stages[name]
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] += n
+
+    def count_exception(self, kind: str, exception: BaseException):
+        """Counts an exception by its type, wrapped exceptions (`raise ... from e`) are counted by their cause"""
+        self.counters[f"{kind}.{type(exception.__cause__ or exception).__name__}"] += 1
+
+    def snapshot(self, **extra) -> Dict:
+        """Current totals - seconds and calls per stage, counters and `extra` values (e.g. counters of the instrument)"""
+        return {
+            "instrument": self.instrument,
+            "elapsed": time.monotonic() - self._started,
+            "stages": {name: {"seconds": timer.seconds, "calls": timer.calls} for name, timer in self.stages.items()},
+            "counters": dict(self.counters),
+            **extra,
+        }
+
+    def due(self) -> bool:
+        return time.monotonic() - self._last_log >= self.interval
+
+    def log(self, **extra):
+        """Logs the snapshot as a single JSON line and exports it to Prometheus, if the exporter was started"""
+        snapshot = self.snapshot(**extra)
+        logger.info(json.dumps(snapshot, default=str))
+        if _prometheus_metrics is not None:
+            self._publish(snapshot)
+        self._last_log = time.monotonic()
+
+    def _publish(self, snapshot: Dict):
+        """Prometheus counters only increase, so they're advanced by the difference since the last publish"""
+        for name, stage in snapshot["stages"].items():
+            for key, metric in (("seconds", "stage_seconds"), ("calls", "stage_calls")):
+                self._increment(metric, stage[key], stage=name)
+        for name, value in snapshot["counters"].items():
+            self._increment("events", value, event=name)
+        for name, value in snapshot.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                _prometheus_metrics["values"].labels(instrument=self.instrument, value=name).set(value)
+
+    def _increment(self, metric: str, total: float, **labels):
+        key = (metric, *labels.items())
+        if total > self._published[key]:
+            _prometheus_metrics[metric].labels(instrument=self.instrument, **labels).inc(total - self._published[key])
+            self._published[key] = total
+
+
+def start_prometheus_exporter(port: int):
+    """Serves sweep metrics of this process on `port`, requires prometheus_client. Repeated calls do nothing"""
+    global _prometheus_metrics
+    if _prometheus_metrics is not None:
+        return
+    from prometheus_client import Counter, Gauge, start_http_server
+
+    _prometheus_metrics = {
+        "stage_seconds": Counter("sweep_stage_seconds", "Wall time spent in sweep stages", ["instrument", "stage"]),
+        "stage_calls": Counter("sweep_stage_calls", "Number of calls of sweep stages", ["instrument", "stage"]),
+        "events": Counter("sweep_events", "Sweep events, e.g. failed steps by exception type", ["instrument", "event"]),
+        "values": Gauge("sweep_value", "Current values of sweep counters and state", ["instrument", "value"]),
+    }
+    start_http_server(port)
+    logger.info("Sweep metrics exported to Prometheus on port %d", port)
@@ -0,0 +1,51 @@
+"""
+Spatial index of points of interest with individual detection radii
+"""
+from typing import List
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class RadiusClassIndex:
+    """
+    Finds points of interest within their own radius from query points
+
+    A single KD-Tree would have to be queried with the largest radius of all points. Here points are grouped into
+    classes of similar radii (the largest radius of a class is at most `ratio` times the smallest one), each class
+    has its own KD-Tree queried with its largest radius. Points with NaN coordinates are never returned
+    """
+
+    def __init__(self, points: np.ndarray, radii: np.ndarray, ratio: float):
+        self.points = points
+        self.radii = np.asarray(radii, dtype=float)
+        valid = np.flatnonzero(~np.isnan(points).any(axis=1))
+        self.classes = []
+        if not len(valid):
+            return
+        classes = np.floor(np.log(self.radii[valid] / self.radii[valid].min()) / np.log(ratio)).astype(int)
+        for radius_class in np.unique(classes):
+            ids = valid[classes == radius_class]
+            self.classes.append((ids, cKDTree(points[ids]), float(self.radii[ids].max())))
+
+    @property
+    def max_radius(self) -> float:
+        return max((radius for _, _, radius in self.classes), default=0.0)
+
+    def query_ball_point(self, points: np.ndarray) -> List[np.ndarray]:
+        """Ids of points of interest within their radius from each of (N, 3) query points"""
+        neighbours = [[] for _ in range(len(points))]
+        for ids, kd_tree, radius in self.classes:
+            for i, class_neighbours in enumerate(kd_tree.query_ball_point(points, radius)):
+                if class_neighbours:
+                    neighbours[i].append(ids[class_neighbours])
+
+        results = []
+        for point, point_neighbours in zip(points, neighbours):
+            if not point_neighbours:
+                results.append(np.empty(0, dtype=int))
+                continue
+            candidates = np.concatenate(point_neighbours)
+            distances = np.linalg.norm(self.points[candidates] - point, axis=1)
+            results.append(candidates[distances <= self.radii[candidates]])
+        return results
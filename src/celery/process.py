@@ -167,6 +167,25 @@ class DivinerRDRDownloader:
         collection = session['simulation_points_DIVINER_test_full']
 
         threshold = 12.5  # Set your threshold value
+        os.makedirs(BASE_HDD_PATH, exist_ok=True)
+
+        # Sweeps with overflight windows store the intervals directly, no need to cluster timestamps
+        windows = list(collection.find(
+            {"et_enter": {"$exists": True}, "min_distance": {"$lt": threshold}},
+            {"timestamp_utc_enter": 1, "timestamp_utc_exit": 1, "_id": 0}
+        ).sort("timestamp_utc_enter", 1))
+        if windows:
+            self.flagged_data_intervals = [(window["timestamp_utc_enter"], window["timestamp_utc_exit"]) for window in windows]
+            # Windows longer than a fragment span fragments in between their entry and exit as well
+            self.flagged_data_fragments = sorted({
+                fragment
+                for start, end in self.flagged_data_intervals
+                for fragment in self.fragments_between(start, end)
+            })
+            self._timestamp_clusters = None
+            session.client.close()
+            del session, collection
+            return
 
         # Query only timestamp_utc where min_distance is less than the threshold
         timestamps = list(collection.find(
@@ -182,7 +201,6 @@ class DivinerRDRDownloader:
             timestamp_set.add(f"{timestamp[:-1]}0")
 
         self.flagged_data_fragments = sorted(timestamp_set)
-        os.makedirs(BASE_HDD_PATH, exist_ok=True)
 
         diff = timedelta(seconds=1.4)
         timestamp_clusters = [[timestamp_list[0]]]
@@ -200,6 +218,16 @@ class DivinerRDRDownloader:
 
 
 
+    @staticmethod
+    def fragments_between(start: datetime, end: datetime) -> List[str]:
+        """Names of all 10 minute data fragments from the one containing `start` to the one containing `end`"""
+        fragment = start.replace(minute=start.minute - start.minute % 10, second=0, microsecond=0)
+        fragments = []
+        while fragment <= end:
+            fragments.append(fragment.strftime("%Y%m%d%H%M"))
+            fragment += timedelta(minutes=10)
+        return fragments
+
     @staticmethod
     def data_fragment_name_to_url(fragment_name: str) -> str:
         base_url = YEARLY_DATA_URLS[fragment_name[:4]]
@@ -213,18 +241,11 @@ class DivinerRDRDownloader:
 
     @staticmethod
     def merge_entries_and_timewindows(entries: List[str], timewindows: List[Tuple[datetime, datetime]]):
-        delta = timedelta(minutes=10)
         entry_map = {entry: [] for entry in entries}
 
         for window in tqdm(timewindows, desc="Assigning intervals to dataset fragmenrs"):
-            min_time_string = window[0].strftime("%Y%m%d%H%M")[:-1] + "0"
-            max_time_string = window[1].strftime("%Y%m%d%H%M")[:-1] + "0"
-            
-            entry_map[min_time_string].append(window)
-
-            while min_time_string != max_time_string:
-                min_time_string = (window[0] + delta).strftime("%Y%m%d%H%M")[:-1] + "0"
-                entry_map[min_time_string].append(window)
+            for fragment in DivinerRDRDownloader.fragments_between(*window):
+                entry_map[fragment].append(window)
 
         for entry in tqdm(entries, desc="Sorting timewindows"):
             entry_map[entry].sort(key=lambda x: x[0])
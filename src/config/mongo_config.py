@@ -71,6 +71,8 @@ BROWSER_HEADERS = {
 ### Simulation data
 SIMULATION_DB_NAME = "astro-simulation"
 SIMULATION_POINTS_COLLECTION = "simulation_points"
+SIMULATION_RUNS_COLLECTION = "simulation_runs"  # Checkpoints of sweeps, so they could be resumed
+SIMULATION_WRITER_QUEUE_SIZE = 16  # Pending writes of the background writer, the sweep blocks once it's full
 
 RDR_DIVINER_DB = "rdr_diviner"
 RDR_DIVINER_COLLECTION = "rdr_diviner_filtered" # Here, surely the querried area have to be added as a suffix
@@ -0,0 +1,91 @@
+"""
+Background writer of simulation results, so the sweep doesn't wait for MongoDB round trips
+"""
+import queue
+import signal
+import logging
+import threading
+from contextlib import nullcontext
+from typing import Callable, Optional
+
+from src.config.mongo_config import SIMULATION_WRITER_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundWriter:
+    """
+    Executes database writes (inserts, checkpoints) in a single thread, strictly in the order they were submitted
+
+    The queue is bounded - once SIMULATION_WRITER_QUEUE_SIZE writes are pending, `submit` blocks until the thread
+    catches up. After a failed write the following ones are dropped (a checkpoint must never be saved past results
+    which were not inserted) and the error is raised in the submitting thread by the next `submit`, `flush` or `close`.
+
+    Use it as a context manager - pending writes are flushed on exit, including exceptions and SIGTERM, which is
+    turned into SystemExit while the writer is open (only in the main thread).
+    """
+
+    def __init__(self, maxsize: int = SIMULATION_WRITER_QUEUE_SIZE):
+        self._queue: queue.Queue = queue.Queue(maxsize=maxsize)
+        self._error: Optional[BaseException] = None
+        self._previous_sigterm_handler = None
+        self._thread = threading.Thread(target=self._run, name="simulation-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:  # Exit signal
+                    return
+                function, args, timer = task
+                if self._error is None:
+                    with timer or nullcontext():
+                        function(*args)
+            except BaseException as e:
+                logger.error("Background write failed, dropping the following writes: %s", e)
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError("Background write of simulation results failed") from self._error
+
+    def submit(self, function: Callable, *args, timer=None):
+        """Queues `function(*args)`, blocks while the queue is full. `timer` (see SweepMetrics.stage) times the write"""
+        self._raise_error()
+        self._queue.put((function, args, timer))
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def flush(self):
+        """Waits until all submitted writes are done"""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def _terminate(self, signum, frame):
+        raise SystemExit(f"Terminated by signal {signum}")
+
+    def __enter__(self) -> "BackgroundWriter":
+        if threading.current_thread() is threading.main_thread():
+            self._previous_sigterm_handler = signal.signal(signal.SIGTERM, self._terminate)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is not None:
+                logger.info("Flushing %d pending writes before exiting", self.pending)
+            self.close()
+        finally:
+            if self._previous_sigterm_handler is not None:
+                signal.signal(signal.SIGTERM, self._previous_sigterm_handler)
+        return False
@@ -1,4 +1,5 @@
-from typing import List
+from datetime import datetime
+from typing import Dict, List, Optional
 import pandas as pd
 from pymongo import MongoClient, errors
 from src.config.mongo_config import (
@@ -7,6 +8,7 @@ from src.config.mongo_config import (
     PIT_COLLECTION_NAME,
     SIMULATION_DB_NAME,
     SIMULATION_POINTS_COLLECTION,
+    SIMULATION_RUNS_COLLECTION,
 )
 
 
@@ -16,7 +18,7 @@ class Sessions:
 
     This class provides methods to:
       - Retrieve lunar pit locations as a Pandas DataFrame.
-      - Insert simulation result documents into a MongoDB timeseries collection synchronously.
+      - Insert simulation result documents into a MongoDB collection (see BackgroundWriter to do it asynchronously).
 
     Simulation results are stored in a timeseries collection with indexes on:
       - astro_timestamp (ephemeris time, ET, as a float)
@@ -26,6 +28,8 @@ class Sessions:
     client: MongoClient = None
     sessions = {}
     lunar_pit_locations = None
+    # Collections with indexes already ensured by this process, by name
+    prepared_collections = {}
 
     @staticmethod
     def get_db_session(db_name: str):
@@ -37,7 +41,7 @@ class Sessions:
         if Sessions.client is None:
             Sessions.client = MongoClient(MONGO_URI)
 
-        if hasattr(Sessions.sessions, db_name):
+        if db_name in Sessions.sessions:
             return Sessions.sessions[db_name]
 
         if db_name not in Sessions.client.list_database_names():
@@ -51,19 +55,22 @@ class Sessions:
         """
         Fetches all lunar pit locations from the MongoDB collection and returns them as a Pandas DataFrame.
 
-        The resulting DataFrame uses the pit 'name' as its index and includes 'latitude' and 'longitude' columns.
+        The resulting DataFrame uses the pit 'name' as its index and includes 'latitude' and 'longitude' columns,
+        'funnel_max_diameter' and 'inner_max_diameter' (meters) are NaN where the atlas doesn't state them.
         """
         if Sessions.lunar_pit_locations is not None:
             return Sessions.lunar_pit_locations
 
         session = Sessions.get_db_session(PIT_ATLAS_PARSED_DB_NAME)
         collection = session[PIT_COLLECTION_NAME]
-        query_results = list(collection.find({}, {"location": 1, "name": 1}))
+        query_results = list(collection.find({}, {"location": 1, "name": 1, "funnel_max_diameter": 1, "inner_max_diameter": 1}))
         data = [
             {
                 "name": item["name"],
                 "latitude": item["location"]["coordinates"][1],
-                "longitude": item["location"]["coordinates"][0]
+                "longitude": item["location"]["coordinates"][0],
+                "funnel_max_diameter": item.get("funnel_max_diameter"),
+                "inner_max_diameter": item.get("inner_max_diameter"),
             }
             for item in query_results
         ]
@@ -72,29 +79,36 @@ class Sessions:
         return Sessions.lunar_pit_locations
 
     @staticmethod
-    def _prepare_simulation_collection():
+    def _prepare_simulation_collection(collection_slug: Optional[str] = None):
         """
         Ensures that the simulation results collection exists.
+        - `collection_slug` is appended to the collection name, so different runs could be stored separately.
         - Stores `et` as a float (ephemeris time) instead of BSON datetime.
         - Keeps `instrument` as a direct field.
         - Stores `sub_instrument` inside the `meta` dictionary.
+        The collection and its indexes are prepared only once per process.
         """
+        collection_name = SIMULATION_POINTS_COLLECTION if collection_slug is None else f"{SIMULATION_POINTS_COLLECTION}_{collection_slug}"
+        if collection_name in Sessions.prepared_collections:
+            return Sessions.prepared_collections[collection_name]
+
         session = Sessions.get_db_session(SIMULATION_DB_NAME)
-        if SIMULATION_POINTS_COLLECTION not in session.list_collection_names():
+        if collection_name not in session.list_collection_names():
             try:
-                session.create_collection(SIMULATION_POINTS_COLLECTION)  # Regular collection, not time-series
+                session.create_collection(collection_name)  # Regular collection, not time-series
             except errors.CollectionInvalid:
                 pass  # Collection already exists
-        collection = session[SIMULATION_POINTS_COLLECTION]
+        collection = session[collection_name]
 
         # Indexes for efficient queries
         collection.create_index("instrument")  # Faster instrument filtering
         collection.create_index("et")  # Index for ephemeris time queries
         collection.create_index("min_distance")  # Index for proximity queries
+        Sessions.prepared_collections[collection_name] = collection
         return collection
 
     @staticmethod
-    def insert_simulation_results(results: List[dict]):
+    def insert_simulation_results(results: List[dict], collection=None):
         """
         Inserts a batch of simulation result documents into MongoDB.
 
@@ -114,12 +128,52 @@ class Sessions:
         
         - `et`: Stored as a float (not BSON datetime).
         - `meta.sub_instrument`: Optional field inside the `meta` dictionary.
+        - `collection`: Collection prepared by `_prepare_simulation_collection`, the default one is used if omitted.
+        - Inserts are unordered, the server may apply them in parallel (documents don't depend on each other).
         """
-        collection = Sessions._prepare_simulation_collection()
+        if collection is None:
+            collection = Sessions._prepare_simulation_collection()
         if results:
             for result in results:
                 # Ensure the required fields exist
                 result.setdefault("meta", {})  # Ensure meta exists
                 result["meta"].setdefault("sub_instrument", None)  # Default sub_instrument to None if missing
             
-            collection.insert_many(results)
+            collection.insert_many(results, ordered=False)
+
+    @staticmethod
+    def _prepare_simulation_runs_collection():
+        """Ensures the collection of sweep checkpoints exists, runs are keyed by instrument, collection slug and kernel fingerprint"""
+        if SIMULATION_RUNS_COLLECTION in Sessions.prepared_collections:
+            return Sessions.prepared_collections[SIMULATION_RUNS_COLLECTION]
+        session = Sessions.get_db_session(SIMULATION_DB_NAME)
+        collection = session[SIMULATION_RUNS_COLLECTION]
+        collection.create_index([("instrument", 1), ("collection_slug", 1), ("fingerprint", 1)], unique=True)
+        Sessions.prepared_collections[SIMULATION_RUNS_COLLECTION] = collection
+        return collection
+
+    @staticmethod
+    def get_sweep_checkpoint(run_key: Dict) -> Optional[Dict]:
+        """Returns the last checkpoint of the sweep run identified by `run_key`, None if the run was never checkpointed"""
+        return Sessions._prepare_simulation_runs_collection().find_one(run_key, {"_id": 0})
+
+    @staticmethod
+    def save_sweep_checkpoint(run_key: Dict, checkpoint: Dict):
+        """
+        Stores the checkpoint of the sweep run identified by `run_key`, replacing the previous one.
+
+        Has to be called only once results of all batches up to `checkpoint["last_batch_id"]` are inserted.
+        """
+        Sessions._prepare_simulation_runs_collection().update_one(
+            run_key, {"$set": {**checkpoint, "updated_at": datetime.utcnow()}}, upsert=True
+        )
+
+    @staticmethod
+    def discard_simulation_results(collection, run_key: Dict, after_batch_id: int):
+        """
+        Removes results of batches the sweep run identified by `run_key` inserted after its last checkpoint, e.g. when
+        a sweep crashed right after the insert. Results of other runs in the collection are kept
+        """
+        collection.delete_many(
+            {"instrument": run_key["instrument"], "run_fingerprint": run_key["fingerprint"], "batch_id": {"$gt": after_batch_id}}
+        )